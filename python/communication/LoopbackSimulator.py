@@ -0,0 +1,536 @@
+##############################################################################
+##
+## This file is part of Sardana
+##
+## http://www.tango-controls.org/static/sardana/latest/doc/html/index.html
+##
+## Copyright 2011 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+## Sardana is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Sardana is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with Sardana.  If not, see <http://www.gnu.org/licenses/>.
+##
+##############################################################################
+
+"""Local loopback simulators of the hardware spoken to by the socket and
+serial based controllers, so they can be exercised and benchmarked without
+the real hardware.
+
+A simulated device only knows its command set: it gets one command line and
+answers the reply (or None). The loopback servers give it a transport, a TCP
+port on localhost (:class:`TCPLoopback`) or a pseudo terminal
+(:class:`PtyLoopback`), and delay every reply by a configurable latency and
+jitter.
+
+Example, an IcePAP system for IcepapController (Host=localhost, Port=5000)::
+
+    python LoopbackSimulator.py icepap --port 5000 --latency 0.002
+
+or the E516 serial protocol on a pseudo terminal for E516Ctrl::
+
+    python LoopbackSimulator.py e516 --pty
+
+With --bench N, N queries are sent through the SocketComCtrl transport and
+the query rate is printed.
+"""
+
+import os
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+
+class SimulatedDevice(object):
+    """Base class of the simulated command sets."""
+
+    #: terminator appended to every reply
+    terminator = "\n"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def process(self, line):
+        """Thread safe handling of one command line (without terminator)
+        @return the reply, with terminator, or None"""
+        with self.lock:
+            ans = self.handle(line)
+        if ans is None:
+            return None
+        return ans + self.terminator
+
+    def handle(self, line):
+        raise NotImplementedError
+
+
+class SimulatedAxis(object):
+    """An axis moving at constant velocity, positions in steps (IcePAP)
+    or in microns (E516)."""
+
+    def __init__(self, position=0, velocity=1000.0):
+        self.velocity = float(velocity)
+        self.acctime = 0.1
+        self.power = True
+        self._origin = position
+        self._target = position
+        self._start = 0.0
+
+    def position(self):
+        if not self.moving():
+            return self._target
+        step = self.velocity * (time.time() - self._start)
+        if self._target < self._origin:
+            step = -step
+        return self._origin + step
+
+    def moving(self):
+        if self._target == self._origin or self.velocity <= 0:
+            return False
+        duration = abs(self._target - self._origin) / self.velocity
+        return time.time() - self._start < duration
+
+    def move(self, target):
+        self._origin = self.position()
+        self._target = target
+        self._start = time.time()
+
+    def stop(self):
+        self.set_position(self.position())
+
+    def set_position(self, position):
+        self._origin = self._target = position
+
+
+class IcePAPSimulator(SimulatedDevice):
+    """Subset of the IcePAP system command set used by IcepapController:
+    multi-axis queries (?FSTATUS, ?FPOS, ?POS/?ENC [register] axes...),
+    axis queries (n:?CMD), grouped MOVE, STOP/ABORT and the '#'
+    acknowledge prefix. All the ?POS/?ENC registers answer the axis position.
+    """
+
+    terminator = "\r\n"
+
+    REGISTERS = ['AXIS', 'INDEXER', 'SHFTENC', 'TGTENC', 'ENCIN', 'INPOS',
+                 'ABSENC', 'MOTOR', 'MEASURE', 'PARAM', 'CTRLENC']
+
+    # status register bits
+    PRESENT = 1 << 0
+    ALIVE = 1 << 1
+    READY = 1 << 9
+    MOVING = 1 << 10
+    POWER5V = 1 << 21
+    POWERON = 1 << 23
+
+    def __init__(self, axes=range(1, 9), version='3.17'):
+        SimulatedDevice.__init__(self)
+        self.version = version
+        self.axes = dict([(axis, SimulatedAxis()) for axis in axes])
+
+    def status(self, axis):
+        status = self.PRESENT | self.ALIVE | self.POWER5V
+        if self.axes[axis].power:
+            status |= self.POWERON
+        if self.axes[axis].moving():
+            status |= self.MOVING
+        else:
+            status |= self.READY
+        return '0x%08x' % status
+
+    def handle(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        ack = line.startswith('#')
+        if ack:
+            line = line[1:]
+        prefix = ''
+        axis = None
+        if ':' in line.split()[0]:
+            prefix, line = line.split(':', 1)
+            prefix += ':'
+            axis = int(prefix[:-1])
+        words = line.split()
+        cmd = words[0].upper()
+        args = words[1:]
+        try:
+            if axis is not None and axis not in self.axes:
+                raise ValueError('Board not present')
+            if cmd.startswith('?'):
+                ans = self.query(cmd, args, axis)
+            else:
+                self.command(cmd, args, axis)
+                if not ack:
+                    return None
+                ans = 'OK'
+        except Exception, e:
+            ans = 'ERROR %s' % e
+        return '%s%s %s' % (prefix, cmd, ans)
+
+    def _axes(self, args):
+        axes = map(int, args)
+        for axis in axes:
+            if axis not in self.axes:
+                raise ValueError('Board not present')
+        return axes
+
+    def query(self, cmd, args, axis):
+        if args and args[0].upper() in self.REGISTERS:
+            args = args[1:]
+        axes = [axis] if axis is not None else self._axes(args)
+        if cmd in ('?FSTATUS', '?STATUS'):
+            values = [self.status(a) for a in axes]
+        elif cmd in ('?FPOS', '?POS', '?ENC'):
+            values = [str(int(self.axes[a].position())) for a in axes]
+        elif cmd == '?VELOCITY':
+            values = [str(self.axes[a].velocity) for a in axes]
+        elif cmd == '?ACCTIME':
+            values = [str(self.axes[a].acctime) for a in axes]
+        elif cmd == '?POWER':
+            values = [self.axes[a].power and 'ON' or 'OFF' for a in axes]
+        elif cmd == '?MODE':
+            values = ['OPER']
+        elif cmd == '?VER':
+            values = [self.version]
+        else:
+            raise ValueError('Unknown command')
+        return ' '.join(values)
+
+    def command(self, cmd, args, axis):
+        if cmd == 'MOVE':
+            if args and args[0].upper() in ('GROUP', 'STRICT'):
+                args = args[1:]
+            if axis is not None:
+                args = [str(axis)] + args
+            pairs = zip(self._axes(args[0::2]), map(float, args[1::2]))
+            for a, target in pairs:
+                self.axes[a].move(target)
+        elif cmd in ('STOP', 'ABORT'):
+            axes = [axis] if axis is not None else self._axes(args)
+            for a in axes:
+                self.axes[a].stop()
+        elif cmd == 'POS':
+            if args and args[0].upper() in self.REGISTERS:
+                args = args[1:]
+            self.axes[axis].set_position(float(args[0]))
+        elif cmd in ('VELOCITY', 'ACCTIME'):
+            if axis is not None:
+                args = [str(axis)] + args
+            for a, value in zip(self._axes(args[0::2]), args[1::2]):
+                setattr(self.axes[a], cmd.lower(), float(value))
+        elif cmd == 'POWER':
+            on = args[0].upper() == 'ON'
+            axes = [axis] if axis is not None else self._axes(args[1:])
+            for a in axes:
+                self.axes[a].power = on
+        else:
+            raise ValueError('Unknown command')
+
+
+class E516Simulator(SimulatedDevice):
+    """The PI E-516 serial command set used by E516Ctrl: set commands
+    (ONL, VCO, SVO, MOV, SVA, VEL, STP) reply nothing and leave the error
+    code for ERR?; POS?, VOL?, NLM?, VMI?, PLM? and VMA? without axis
+    answer one line per axis, the non last ones ending with a space."""
+
+    AXES = ['A', 'B', 'C']
+    ERR_SYNTAX = 1
+    ERR_AXIS = 23
+
+    def __init__(self, vxmicron=1.0, lower=0.0, upper=100.0):
+        SimulatedDevice.__init__(self)
+        self.error = 0
+        self.online = False
+        self.vxmicron = vxmicron
+        self.axes = dict([(name, SimulatedAxis(velocity=100.0))
+                          for name in self.AXES])
+        self.servo = dict([(name, False) for name in self.AXES])
+        self.limits = dict([(name, (lower, upper)) for name in self.AXES])
+
+    def _axis_value(self, arg):
+        name = arg[0].upper()
+        if name not in self.axes:
+            raise KeyError(name)
+        return name, arg[1:]
+
+    def value(self, cmd, name):
+        axis = self.axes[name]
+        lower, upper = self.limits[name]
+        if cmd == 'POS?':
+            return axis.position()
+        elif cmd == 'VOL?':
+            return axis.position() * self.vxmicron
+        elif cmd == 'NLM?':
+            return lower
+        elif cmd == 'VMI?':
+            return lower * self.vxmicron
+        elif cmd == 'PLM?':
+            return upper
+        elif cmd == 'VMA?':
+            return upper * self.vxmicron
+        elif cmd == 'VEL?':
+            return axis.velocity
+        raise ValueError(cmd)
+
+    def handle(self, line):
+        words = line.strip().split()
+        if not words:
+            return None
+        cmd = words[0].upper()
+        args = words[1:]
+        try:
+            if cmd == 'ERR?':
+                error, self.error = self.error, 0
+                return str(error)
+            if cmd.endswith('?'):
+                if args:
+                    name, rest = self._axis_value(args[0])
+                    return '%g' % self.value(cmd, name)
+                values = ['%g' % self.value(cmd, name) for name in self.AXES]
+                return ' \n'.join(values)
+            self.command(cmd, args)
+        except KeyError:
+            self.error = self.ERR_AXIS
+        except Exception:
+            self.error = self.ERR_SYNTAX
+        return None
+
+    def command(self, cmd, args):
+        if cmd == 'ONL':
+            self.online = args[0] == '1'
+            return
+        name, value = self._axis_value(args[0])
+        axis = self.axes[name]
+        if cmd == 'STP':
+            axis.stop()
+        elif cmd in ('VCO', 'SVO'):
+            if cmd == 'SVO':
+                self.servo[name] = value == '1'
+        elif cmd == 'MOV':
+            lower, upper = self.limits[name]
+            axis.move(min(max(float(value), lower), upper))
+        elif cmd == 'SVA':
+            axis.move(float(value) / self.vxmicron)
+        elif cmd == 'VEL':
+            axis.velocity = float(value)
+        else:
+            raise ValueError(cmd)
+
+
+class LoopbackServer(object):
+    """Serve a simulated device, delaying each reply by latency seconds plus
+    a uniform random jitter in [-jitter, jitter]."""
+
+    def __init__(self, device, latency=0.0, jitter=0.0):
+        self.device = device
+        self.latency = latency
+        self.jitter = jitter
+        self.running = False
+        self.queries = 0
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def serve(self, read, write):
+        """Read commands, '\\r' or '\\n' terminated, and write the replies
+        until the connection is closed or the server stopped."""
+        buf = ''
+        while self.running:
+            data = read()
+            if data is None:
+                continue
+            if not data:
+                break
+            buf += data.replace('\r\n', '\n').replace('\r', '\n')
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                self.queries += 1
+                ans = self.device.process(line)
+                if ans is not None:
+                    self.delay()
+                    write(ans)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+class TCPLoopback(LoopbackServer):
+    """A simulated device listening on localhost. With port 0 a free port
+    is chosen, see the port member after start()."""
+
+    def __init__(self, device, port=0, host='127.0.0.1', **kwargs):
+        LoopbackServer.__init__(self, device, **kwargs)
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        LoopbackServer.start(self)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self._start_thread(self._accept)
+        return self
+
+    def _accept(self):
+        server = self.server
+        while self.running:
+            try:
+                if not select.select([server], [], [], 0.1)[0]:
+                    continue
+                client = server.accept()[0]
+            except (socket.error, select.error):
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._start_thread(self._client, client)
+
+    def _client(self, client):
+        def read():
+            if not select.select([client], [], [], 0.1)[0]:
+                return None
+            try:
+                return client.recv(4096)
+            except socket.error:
+                return ''
+        try:
+            self.serve(read, client.sendall)
+        except socket.error:
+            pass
+        finally:
+            client.close()
+
+    def stop(self):
+        LoopbackServer.stop(self)
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+class PtyLoopback(LoopbackServer):
+    """A simulated device behind a raw pseudo terminal, for the serial line
+    controllers. Open the port member (e.g. /dev/pts/5) as the serial
+    device."""
+
+    def __init__(self, device, **kwargs):
+        LoopbackServer.__init__(self, device, **kwargs)
+        self.master = self.slave = None
+        self.port = None
+        self.thread = None
+
+    def start(self):
+        LoopbackServer.start(self)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.thread = self._start_thread(self._run)
+        return self
+
+    def _run(self):
+        master = self.master
+        def read():
+            try:
+                if not select.select([master], [], [], 0.1)[0]:
+                    return None
+                return os.read(master, 4096)
+            except (OSError, select.error):
+                return ''
+        def write(data):
+            while data:
+                data = data[os.write(master, data):]
+        self.serve(read, write)
+
+    def stop(self):
+        LoopbackServer.stop(self)
+        # the file descriptors must not be reused while still being read
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+
+SIMULATORS = {'icepap': IcePAPSimulator, 'e516': E516Simulator}
+
+
+def benchmark(host, port, query, n, terminator='LF'):
+    """Send n queries through the SocketComCtrl transport.
+    @return the number of queries per second"""
+    from SocketCommunicationController import Socket
+    sk = Socket()
+    sk.sethost(host)
+    sk.setport(port)
+    sk.setterminator(terminator)
+    sk.settimeout(3)
+    start = time.time()
+    for i in range(n):
+        if not sk.sendrecv(query + '\n', -1):
+            raise Exception('No reply to %s' % query)
+    elapsed = time.time() - start
+    sk.disconnect()
+    return n / elapsed
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] ' + '|'.join(SIMULATORS))
+    parser.add_option('--port', type='int', default=0,
+                      help='TCP port (default: any free port)')
+    parser.add_option('--pty', action='store_true',
+                      help='serve on a pseudo terminal instead of TCP')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='reply latency in seconds')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='reply jitter in seconds')
+    parser.add_option('--bench', type='int', default=0,
+                      help='send BENCH queries and print the query rate')
+    parser.add_option('--query', default='?FSTATUS 1 2 3 4',
+                      help='query used by --bench')
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in SIMULATORS:
+        parser.error('choose one simulator')
+
+    device = SIMULATORS[args[0]]()
+    kwargs = dict(latency=options.latency, jitter=options.jitter)
+    if options.pty:
+        server = PtyLoopback(device, **kwargs).start()
+    else:
+        server = TCPLoopback(device, port=options.port, **kwargs).start()
+    print "%s simulator on %s" % (args[0], server.port)
+
+    try:
+        if options.bench:
+            rate = benchmark('127.0.0.1', server.port, options.query,
+                             options.bench)
+            print "%d queries, %.1f queries/s" % (options.bench, rate)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
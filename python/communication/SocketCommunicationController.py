@@ -1,8 +1,9 @@
 from pool import CommunicationController
 import socket
+import select
 import time
 import array
-from threading import Lock
+from threading import Lock, RLock
 import PyTango
 
 class SocketComCtrl(CommunicationController):
@@ -13,7 +14,8 @@ class SocketComCtrl(CommunicationController):
     ctrl_extra_attributes = {
        'Host'     : {'Type':'PyTango.DevString', 'R/W Type':'PyTango.READ_WRITE'},
        'Port'     : {'Type':'PyTango.DevLong',   'R/W Type':'PyTango.READ_WRITE'},
-       'Timeout'  : {'Type':'PyTango.DevLong',   'R/W Type':'PyTango.READ_WRITE'}}
+       'Timeout'  : {'Type':'PyTango.DevLong',   'R/W Type':'PyTango.READ_WRITE'},
+       'Terminator' : {'Type':'PyTango.DevString', 'R/W Type':'PyTango.READ_WRITE'}}
 
     def __init__(self,inst,props):
         CommunicationController.CommunicationController.__init__(self,inst,props)
@@ -43,6 +45,8 @@ class SocketComCtrl(CommunicationController):
             sk.sethost(value)
         elif name == "Port":
             sk.setport(value)
+        elif name == "Terminator":
+            sk.setterminator(value)
 
     def GetExtraAttributePar(self,ind,name):
 
@@ -54,6 +58,8 @@ class SocketComCtrl(CommunicationController):
             return sk.host
         elif name == "Port":
             return int(sk.port)
+        elif name == "Terminator":
+            return sk.terminator
 
     def GetState(self,ind):
         print "[SocketComCtrl]",self.inst_name,"In GetState"
@@ -103,7 +109,7 @@ class SocketComCtrl(CommunicationController):
 
     def ReadLineOne(self,ind):
         sk = self.socket_data[ind-1]
-        return sk.recv(-1)
+        return sk.recv(0)
 
     def SendToCtrl(self,in_data):
         pass
@@ -113,14 +119,49 @@ class SocketComCtrl(CommunicationController):
 
 
 class Socket:
+    """A persistent TCP connection with framed replies.
+
+    Replies are read until the terminator (or max_read_len bytes) arrives,
+    waiting with select up to the timeout; the rest of a reply longer than
+    max_read_len is discarded. With a terminator several callers may have
+    requests in flight on the same connection: the replies are handed out in
+    the order the requests were sent. Without terminator (NONE, the default)
+    the end of a reply is not known, so there is only one request in flight:
+    the reply is what arrives (up to max_read_len bytes) until nothing more
+    comes for GAP seconds. The connection is reopened on demand after it has
+    been lost or closed."""
+
+    TERMINATORS = {"LF/CR":"\n\r", "CR/LF":"\r\n", "CR":"\r", "LF":"\n",
+                   "NONE":""}
+
+    # without terminator, the silence (s) that ends a reply
+    GAP = 0.05
+
     def __init__(self):
 
-         self.available = False
-         self.connected = False
-         self.timeout   = 1.0
-         self.lock      = Lock()
-         self.host      = None
-         self.port      = None
+         self.available  = False
+         self.connected  = False
+         self.timeout    = 1.0
+         self.terminator = "NONE"
+         self.host       = None
+         self.port       = None
+         self.socket     = None
+
+         # reset takes both, always send_lock first
+         self.send_lock  = RLock()
+         self.recv_lock  = Lock()
+         self.rbuf       = ""
+         # while the rest of a truncated reply is discarded, the end of it
+         # (it may hold the beginning of the terminator)
+         self.skip       = None
+         # set when the framing is lost, until reset
+         self.broken     = False
+         # requests are numbered in send order; the replies are read in the
+         # same order and kept in answers until their caller picks them up
+         self.next_request = 0
+         self.next_answer  = 0
+         self.readlens     = {}
+         self.answers      = {}
 
          try:
             self.socket    = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -129,39 +170,187 @@ class Socket:
             self.available = False
 
     def recv(self, readlen):
-         # what if readlen == -1 ? how to get the number of available characters?
-         readlen = 1024
-         return self.socket.recv(readlen)
+         """Read one reply that was not requested with sendrecv"""
+         if not self.connected:
+            return ""
+         self.recv_lock.acquire()
+         try:
+            try:
+               return self.readframe(readlen, time.time() + self.timeout)
+            except socket.timeout:
+               data, self.rbuf = self.rbuf, ""
+               return data
+         finally:
+            self.recv_lock.release()
 
     def send(self, buf):
          #print "[Socket] Socket send (%s) \n" % buf
-         self.socket.send(buf)
+         if not self.connected:
+            self.connect()
+            if not self.connected:
+               raise socket.error("Not connected to %s:%s" % (self.host, self.port))
+         self.socket.sendall(buf)
 
     def sendrecv(self, buf, readlen):
 
-         self.flush()
+         if not self.TERMINATORS.get(self.terminator, self.terminator):
+            return self.sendrecvraw(buf, readlen)
 
-         if readlen <= 0:
-            readlen = 512
+         self.send_lock.acquire()
+         try:
+            try:
+               if self.next_answer == self.next_request:
+                  self.flush()
+               self.send(buf)
+            except Exception,msg:
+               print "error sending to socket"
+               print msg
+               self.reset()
+               return ""
+            request = self.next_request
+            self.next_request += 1
+            self.readlens[request] = readlen
+         finally:
+            self.send_lock.release()
 
-         time.sleep(0.1)
-         #print "[Socket] sendrecv (readlen=%d) " % readlen
+         return self.waitanswer(request)
 
-         self.lock.acquire()
+    def sendrecvraw(self, buf, readlen):
+         """A request without terminator: the locks are held until its reply
+         is read, a split or merged reply can not be framed otherwise"""
+         self.send_lock.acquire()
+         self.recv_lock.acquire()
          try:
-            self.send(buf)
-            time.sleep(0.1)
-            data = self.recv(readlen)
-         except Exception,msg:
-            data = ""
-            print "error sending/reading socket" 
-            print msg
+            try:
+               self.flush()
+               self.send(buf)
+               return self.readframe(readlen, time.time() + self.timeout)
+            except Exception,msg:
+               print "error sending/reading socket"
+               print msg
          finally:
-            self.lock.release()
-            return data
-    
+            self.recv_lock.release()
+            self.send_lock.release()
+         self.reset()
+         return ""
+
+    def waitanswer(self, request):
+         """Read replies in order until the one for request is available"""
+         deadline = time.time() + self.timeout
+         while True:
+            self.recv_lock.acquire()
+            try:
+               if request in self.answers:
+                  return self.answers.pop(request)
+               if request < self.next_answer or self.broken:
+                  # lost in a reset
+                  return ""
+               try:
+                  readlen = self.readlens.pop(self.next_answer)
+                  data = self.readframe(readlen, deadline)
+               except Exception,msg:
+                  print "error reading socket"
+                  print msg
+                  self.broken = True
+               else:
+                  if self.next_answer == request:
+                     self.next_answer += 1
+                     return data
+                  self.answers[self.next_answer] = data
+                  self.next_answer += 1
+                  continue
+            finally:
+               self.recv_lock.release()
+            # the locks are taken in order by reset
+            self.reset()
+            return ""
+
+    def readframe(self, readlen, deadline):
+         """Read from the socket until the terminator or readlen bytes"""
+         terminator = self.TERMINATORS.get(self.terminator, self.terminator)
+         if not terminator:
+            return self.readraw(readlen, deadline)
+         while True:
+            if self.skipframe(terminator):
+               idx = self.rbuf.find(terminator)
+               if idx >= 0 and (readlen <= 0 or idx + len(terminator) <= readlen):
+                  return self.popbuffer(idx + len(terminator))
+               if readlen > 0 and len(self.rbuf) >= readlen:
+                  # the rest of the reply is discarded before the next one
+                  data = self.popbuffer(readlen)
+                  self.skip = data[len(data) - len(terminator) + 1:]
+                  return data
+            remaining = deadline - time.time()
+            if remaining <= 0:
+               raise socket.timeout("timeout waiting for a reply")
+            ready = select.select([self.socket], [], [], remaining)[0]
+            if not ready:
+               raise socket.timeout("timeout waiting for a reply")
+            chunk = self.socket.recv(4096)
+            if not chunk:
+               raise socket.error("connection closed by %s:%s" % (self.host, self.port))
+            self.rbuf += chunk
+
+    def readraw(self, readlen, deadline):
+         """Read from the socket until readlen bytes or a GAP of silence"""
+         while True:
+            if readlen > 0 and len(self.rbuf) >= readlen:
+               return self.popbuffer(readlen)
+            remaining = deadline - time.time()
+            if self.rbuf:
+               remaining = min(remaining, self.GAP)
+            if remaining <= 0 or \
+                  not select.select([self.socket], [], [], remaining)[0]:
+               if self.rbuf:
+                  return self.popbuffer(len(self.rbuf))
+               raise socket.timeout("timeout waiting for a reply")
+            chunk = self.socket.recv(4096)
+            if not chunk:
+               raise socket.error("connection closed by %s:%s" % (self.host, self.port))
+            self.rbuf += chunk
+
+    def skipframe(self, terminator):
+         """Discard the rest of a truncated reply from the buffer
+         @return True if it is discarded, False if its end has not arrived"""
+         if self.skip is None:
+            return True
+         data = self.skip + self.rbuf
+         idx = data.find(terminator)
+         if idx < 0:
+            self.skip = data[len(data) - len(terminator) + 1:]
+            self.rbuf = ""
+            return False
+         self.rbuf = data[idx + len(terminator):]
+         self.skip = None
+         return True
+
+    def popbuffer(self, length):
+         data = self.rbuf[:length]
+         self.rbuf = self.rbuf[length:]
+         return data
+
+    def reset(self):
+         """After an error the reply framing is lost: drop the connection
+         and fail all the requests in flight, it is reopened on demand"""
+         self.send_lock.acquire()
+         self.recv_lock.acquire()
+         try:
+            self.disconnect()
+            self.rbuf = ""
+            self.skip = None
+            self.broken = False
+            self.readlens = {}
+            self.answers = {}
+            self.next_answer = self.next_request
+         finally:
+            self.recv_lock.release()
+            self.send_lock.release()
+
     def connect(self):
-         # set timeout to something small 
+
+         if self.connected:
+             # opening it again must not drop the requests in flight
+             return
 
          if self.checkhost() == -1:
              return
@@ -169,46 +358,65 @@ class Socket:
          if self.available == False:
              return
 
-         #self.socket.settimeout(0.1)
-
          try:
+             if self.socket is None:
+                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+             self.socket.settimeout(self.timeout)
              self.socket.connect((self.host,self.port))
+             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
              self.connected = True
          except socket.error, reason:
-             self.connected = False
-             print "Error connecting to socket. Error is: ", reason[1]
-         #self.socket.settimeout(self.timeout)
+             self.disconnect()
+             print "Error connecting to socket. Error is: ", reason
 
     def disconnect(self):
-         self.socket.close()
+         if self.socket is not None:
+             self.socket.close()
+         # a closed socket can not be connected again
+         self.socket = None
          self.connected = False
 
     def flush(self):
-         return
+         """Discard late replies of requests that were already failed"""
          try:
-           #self.socket.settimeout(0.1)
-           bla = self.recv(512)
-           if bla != "":
-              print "[Socket] flush found had some crap (%s)" % bla
-           #self.socket.settimeout(self.timeout)
-         except socket.timeout:
-           pass
+            while self.connected and select.select([self.socket], [], [], 0)[0]:
+               bla = self.socket.recv(4096)
+               if bla == "":
+                  self.disconnect()
+                  break
+               print "[Socket] flush found had some crap (%s)" % bla
+               self.rbuf += bla
          except:
-           print "Flush failed"
+            print "Flush failed"
+            self.disconnect()
+         terminator = self.TERMINATORS.get(self.terminator, self.terminator)
+         if terminator:
+            # a truncated reply is still discarded if its end is late
+            self.skipframe(terminator)
+         self.rbuf = ""
 
     def gettimeout(self):
-         return self.socket.gettimeout()
+         return self.timeout
     
     def settimeout(self,timeout):
-         print "[Socket] setting timeout %d" % timeout
-         self.socket.settimeout(0.3)
-         self.timeout = timeout
+         self.timeout = float(timeout)
+         if self.socket is not None:
+             self.socket.settimeout(self.timeout)
+
+    def gethost(self):
+         return self.host
 
     def sethost(self, hostname):
          self.host = hostname
+         self.disconnect()
 
     def setport(self, portno):
          self.port = portno
+         self.disconnect()
+
+    def setterminator(self, terminator):
+         self.terminator = terminator
+         self.skip = None
 
     def checkhost(self):
          # check that hostname in DNS
@@ -0,0 +1,240 @@
+import array
+import os
+import select
+import sys
+import threading
+import time
+import unittest
+
+from LoopbackSimulator import (IcePAPSimulator, E516Simulator, TCPLoopback,
+                               PtyLoopback)
+from SocketCommunicationController import Socket, SocketComCtrl
+
+E516CTRL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'motor', 'E516Ctrl')
+
+
+class IcePAPLoopbackTestCase(unittest.TestCase):
+    """SocketComCtrl transport against the IcePAP simulator."""
+
+    def setUp(self):
+        self.server = TCPLoopback(IcePAPSimulator(axes=[1, 2, 3]),
+                                  latency=0.001, jitter=0.0005).start()
+        self.sk = Socket()
+        self.sk.sethost('127.0.0.1')
+        self.sk.setport(self.server.port)
+        self.sk.setterminator('LF')
+        self.sk.settimeout(2)
+
+    def tearDown(self):
+        self.sk.disconnect()
+        self.server.stop()
+
+    def test_multiple_status(self):
+        ans = self.sk.sendrecv('?FSTATUS 1 2 3\r', -1).split()
+        self.assertEqual(ans[0], '?FSTATUS')
+        self.assertEqual(len(ans), 4)
+
+    def test_move(self):
+        self.assertEqual(self.sk.sendrecv('#MOVE GROUP 1 10 2 -10\r', -1),
+                         'MOVE OK\r\n')
+        time.sleep(0.05)
+        self.assertEqual(self.sk.sendrecv('?POS AXIS 1 2 3\r', -1),
+                         '?POS 10 -10 0\r\n')
+        self.assertEqual(self.sk.sendrecv('2:?ENC\r', -1),
+                         '2:?ENC -10\r\n')
+
+    def test_error(self):
+        ans = self.sk.sendrecv('?POS 1 9\r', -1)
+        self.assertTrue('ERROR' in ans)
+
+    def test_truncated_reply(self):
+        # the rest of the first reply is not taken as the reply of the
+        # second request, sent while the first one is in flight
+        self.server.latency = 0.05
+        answers = {}
+
+        def query(name, cmd, readlen):
+            answers[name] = self.sk.sendrecv(cmd, readlen)
+        first = threading.Thread(target=query,
+                                 args=(1, '?POS AXIS 1 2 3\r', 10))
+        first.start()
+        time.sleep(0.01)
+        query(2, '?VER\r', -1)
+        first.join()
+        self.assertEqual(answers, {1: '?POS 0 0 0', 2: '?VER 3.17\r\n'})
+        self.assertEqual(self.sk.sendrecv('2:?ENC\r', -1), '2:?ENC 0\r\n')
+
+    def test_raw_reply(self):
+        # without terminator the reply is what has arrived
+        self.sk.setterminator('NONE')
+        self.assertEqual(self.sk.sendrecv('?VER\r', -1), '?VER 3.17\r\n')
+        self.assertEqual(self.sk.sendrecv('?VER\r', 4), '?VER')
+
+    def test_reconnect(self):
+        self.sk.disconnect()
+        self.assertEqual(self.sk.sendrecv('?VER\r', -1), '?VER 3.17\r\n')
+
+
+class SplitLoopback(TCPLoopback):
+    """Writes each reply in two halves, pause seconds apart."""
+
+    pause = 0.01
+
+    def serve(self, read, write):
+        def split(data):
+            half = len(data) / 2
+            write(data[:half])
+            time.sleep(self.pause)
+            write(data[half:])
+        TCPLoopback.serve(self, read, split)
+
+
+class MergeLoopback(TCPLoopback):
+    """Reads the commands every pause seconds and writes the replies of the
+    commands read together at once."""
+
+    pause = 0.05
+
+    def serve(self, read, write):
+        replies = []
+
+        def merge():
+            if replies:
+                write(''.join(replies))
+                del replies[:]
+            time.sleep(self.pause)
+            return read()
+        TCPLoopback.serve(self, merge, replies.append)
+
+
+class RawLoopbackTestCase(unittest.TestCase):
+    """SocketComCtrl transport without terminator."""
+
+    def start(self, server):
+        self.server = server.start()
+        self.sk = Socket()
+        self.sk.sethost('127.0.0.1')
+        self.sk.setport(self.server.port)
+        self.sk.settimeout(2)
+
+    def tearDown(self):
+        self.sk.disconnect()
+        self.server.stop()
+
+    def test_split_reply(self):
+        self.start(SplitLoopback(IcePAPSimulator(axes=[1, 2, 3])))
+        self.assertEqual(self.sk.sendrecv('?VER\r', -1), '?VER 3.17\r\n')
+        self.assertEqual(self.sk.sendrecv('2:?ENC\r', -1), '2:?ENC 0\r\n')
+
+    def test_merged_reply(self):
+        # the second request is not sent until the first reply is read
+        self.start(MergeLoopback(IcePAPSimulator(axes=[1, 2, 3])))
+        answers = {}
+
+        def query(name, cmd):
+            answers[name] = self.sk.sendrecv(cmd, -1)
+        first = threading.Thread(target=query, args=(1, '?VER\r'))
+        first.start()
+        time.sleep(0.01)
+        query(2, '2:?ENC\r')
+        first.join()
+        self.assertEqual(answers, {1: '?VER 3.17\r\n', 2: '2:?ENC 0\r\n'})
+
+
+class E516LoopbackTestCase(unittest.TestCase):
+    """E516 serial protocol on a pseudo terminal."""
+
+    def setUp(self):
+        self.server = PtyLoopback(E516Simulator()).start()
+        self.fd = os.open(self.server.port, os.O_RDWR | os.O_NOCTTY)
+
+    def tearDown(self):
+        os.close(self.fd)
+        self.server.stop()
+
+    def query(self, cmd, lines=1):
+        os.write(self.fd, cmd + '\n')
+        ans = ''
+        while ans.count('\n') < lines:
+            self.assertTrue(select.select([self.fd], [], [], 2)[0])
+            ans += os.read(self.fd, 1024)
+        return ans
+
+    def test_positions(self):
+        os.write(self.fd, 'MOV B50\n')
+        self.assertEqual(self.query('ERR?'), '0\n')
+        time.sleep(0.6)
+        self.assertEqual(self.query('POS?', 3), '0 \n50 \n0\n')
+
+    def test_error(self):
+        os.write(self.fd, 'MOV D50\n')
+        self.assertEqual(self.query('ERR?'), '23\n')
+
+
+class ComChannel(object):
+    """Pool communication channel on an axis of a SocketComCtrl. The
+    commands are ended with a new line, as the serial line does."""
+
+    def __init__(self, ctrl, axis):
+        self.ctrl = ctrl
+        self.axis = axis
+
+    def open(self):
+        self.ctrl.OpenOne(self.axis)
+
+    def write(self, data):
+        buf = data.tostring() + '\n'
+        self.ctrl.WriteOne(self.axis, buf, len(buf))
+
+    def writeread(self, data):
+        buf = data.tostring() + '\n'
+        return self.ctrl.WriteReadOne(self.axis, buf, len(buf), -1)
+
+    def readline(self):
+        return array.array('B', self.ctrl.ReadLineOne(self.axis))
+
+
+class E516ControllerTestCase(unittest.TestCase):
+    """E516Ctrl through SocketComCtrl against the E516 simulator."""
+
+    def setUp(self):
+        self.server = TCPLoopback(E516Simulator()).start()
+        self.com = SocketComCtrl('test', {})
+        self.com.AddDevice(1)
+        self.com.SetExtraAttributePar(1, 'Host', '127.0.0.1')
+        self.com.SetExtraAttributePar(1, 'Port', self.server.port)
+        self.com.SetExtraAttributePar(1, 'Terminator', 'LF')
+        self.com.SetExtraAttributePar(1, 'Timeout', 2)
+        sys.path.insert(0, E516CTRL_PATH)
+        try:
+            from E516Ctrl import E516Controller
+        finally:
+            sys.path.remove(E516CTRL_PATH)
+        # without Pool, the communication channel is given to the controller
+        self.ctrl = E516Controller.__new__(E516Controller)
+        channel = ComChannel(self.com, 1)
+        self.ctrl.getComChannel = lambda: channel
+        for axis in (1, 2, 3):
+            self.ctrl.AddDevice(axis)
+
+    def tearDown(self):
+        self.com.CloseOne(1)
+        self.server.stop()
+
+    def test_state(self):
+        self.ctrl.StateAll()
+        # at the lower limit
+        self.assertEqual(self.ctrl.StateOne(2)[1], 4)
+        self.assertEqual(self.ctrl.GetPar(2, 'velocity'), 100.0)
+
+    def test_move(self):
+        self.ctrl.StartOne(2, 50)
+        time.sleep(0.6)
+        self.ctrl.ReadAll()
+        self.assertEqual([self.ctrl.ReadOne(axis) for axis in (1, 2, 3)],
+                         [0.0, 50.0, 0.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
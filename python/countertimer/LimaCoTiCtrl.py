@@ -64,6 +64,15 @@ class LimaCoTiCtrl(CounterTimerController):
                          'SavingFolderName',
             Access: DataAccess.ReadWrite,
             Memorize: Memorized},
+        'ReferenceOnly': {
+            Type: bool,
+            Description: 'Compute the LastImageName from the saving '
+                         'configured by the controller instead of reading '
+                         'it from the LimaCCD (the images can be read from '
+                         'the files with LimaFileLib)',
+            Access: DataAccess.ReadWrite,
+            Memorize: Memorized,
+            DefaultValue: False},
         }
 
     axis_attributes = {}
@@ -106,6 +115,14 @@ class LimaCoTiCtrl(CounterTimerController):
         self._det_name = ''
         self._saving_folder_name = ''
         self._synchronization = AcqSynch.SoftwareTrigger
+        self._reference_only = False
+        # (directory, prefix, suffix) of the saving configured by the
+        # controller, with the index format and the next number read when
+        # the acquisition starts, and the images acquired since then
+        self._saving = None
+        self._index_format = None
+        self._next_number = None
+        self._images_acquired = 0
 
     def _clean_acquisition(self):
         if self._last_image_read != -1:
@@ -135,8 +152,11 @@ class LimaCoTiCtrl(CounterTimerController):
             self._limaccd.write_attribute('saving_mode', 'Auto_Frame')
             self._limaccd.write_attribute('saving_prefix', prefix)
             self._limaccd.write_attribute('saving_suffix', '.' + suffix)
+            self._saving = (path, prefix, '.' + suffix)
+            self._next_number = None
         else:
             self._limaccd.write_attribute('saving_mode', 'Manual')
+            self._saving = None
 
     def AddDevice(self, axis):
         if axis != 1:
@@ -196,6 +216,12 @@ class LimaCoTiCtrl(CounterTimerController):
 
     def PreStartAll(self):
         self._limaccd.prepareAcq()
+        self._images_acquired = 0
+        if self._saving is not None and self._reference_only:
+            attrs = ['saving_index_format', 'saving_next_number']
+            values = self._limaccd.read_attributes(attrs)
+            self._index_format = values[0].value
+            self._next_number = values[1].value
         return True
 
     def StartAll(self):
@@ -215,6 +241,7 @@ class LimaCoTiCtrl(CounterTimerController):
                 self._new_data = False
                 return
             self._data_buff[axis] = [self._int_time]
+            self._images_acquired = 1
         elif self._synchronization == AcqSynch.HardwareTrigger:
             attr = 'last_image_ready'
             new_image_ready = self._limaccd.read_attribute(attr).value
@@ -226,6 +253,7 @@ class LimaCoTiCtrl(CounterTimerController):
             if new_image_ready == 0:
                 new_data = 1
             self._data_buff[axis] = [self._int_time] * new_data
+            self._images_acquired = new_image_ready + 1
         self._last_image_read = new_image_ready
         self._log.debug('Leaving ReadAll %r' % self._data_buff[1])
 
@@ -264,6 +292,9 @@ class LimaCoTiCtrl(CounterTimerController):
             self._expected_saving_images = value
         elif param == 'savingfoldername':
             self._saving_folder_name = value
+        elif param == 'referenceonly':
+            self._reference_only = value
+            self._next_number = None
         else:
             super(LimaCoTiCtrl, self).SetCtrlPar(parameter, value)
 
@@ -271,6 +302,12 @@ class LimaCoTiCtrl(CounterTimerController):
         param = parameter.lower()
         if param == 'filename':
             value = self._filename
+        elif param == 'lastimagename' and self._reference_only and \
+                self._saving is not None and self._next_number is not None:
+            path, prefix, suffix = self._saving
+            nr = self._next_number + self._images_acquired - 1
+            nr_formated = self._index_format % nr
+            value = '%s/%s%s%s' % (path, prefix, nr_formated, suffix)
         elif param == 'lastimagename':
             path = self._limaccd.read_attribute('saving_directory').value
             prefix = self._limaccd.read_attribute('saving_prefix').value
@@ -288,6 +325,8 @@ class LimaCoTiCtrl(CounterTimerController):
             value = self._expected_saving_images
         elif param == 'savingfoldername':
             value = self._saving_folder_name
+        elif param == 'referenceonly':
+            value = self._reference_only
         else:
             value = super(LimaCoTiCtrl, self).GetCtrlPar(parameter)
         return value
@@ -0,0 +1,140 @@
+##############################################################################
+##
+## This file is part of Sardana
+##
+## http://www.tango-controls.org/static/sardana/latest/doc/html/index.html
+##
+## Copyright 2011 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+## Sardana is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Sardana is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with Sardana.  If not, see <http://www.gnu.org/licenses/>.
+##
+##############################################################################
+
+"""Access to the images saved by Lima (e.g. the LastImageName of
+LimaCoTiCtrl) without transferring them through Tango: the frames of the
+EDF and uncompressed HDF5 files are memory mapped, so only the pixels used
+are read from the disk. Reading HDF5 files needs h5py.
+"""
+
+import numpy
+
+EDF_BLOCK = 512
+
+EDF_TYPES = {'unsignedbyte': numpy.uint8,
+             'signedbyte': numpy.int8,
+             'unsignedshort': numpy.uint16,
+             'signedshort': numpy.int16,
+             'unsignedinteger': numpy.uint32,
+             'signedinteger': numpy.int32,
+             'unsignedlong': numpy.uint32,
+             'signedlong': numpy.int32,
+             'unsigned64': numpy.uint64,
+             'signed64': numpy.int64,
+             'floatvalue': numpy.float32,
+             'float': numpy.float32,
+             'doublevalue': numpy.float64}
+
+# where Lima saves the frames in its HDF5 files
+HDF5_DATA_PATHS = ('entry_0000/measurement/data',)
+
+
+def _read_edf_header(f):
+    """Read the EDF header at the current position of the file.
+    @return (dictionary key: value, offset of the data)
+    """
+    start = f.tell()
+    header = ''
+    while '}' not in header:
+        block = f.read(EDF_BLOCK)
+        if not block:
+            raise IOError('Truncated EDF header in %s' % f.name)
+        header += block
+    # the header is padded to a multiple of the block size and ends
+    # with '}\n'
+    end = header.index('}') + 2
+    values = {}
+    for item in header[header.index('{') + 1:end - 2].split(';'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            values[key.strip()] = value.strip()
+    return values, start + end
+
+
+def open_edf(filename, index=0):
+    """Memory map a frame of an EDF file.
+    @param index of the frame in the file
+    @return read only numpy.memmap (height, width)
+    """
+    with open(filename, 'rb') as f:
+        for i in range(index + 1):
+            header, offset = _read_edf_header(f)
+            f.seek(offset + int(header['Size']))
+    dtype = numpy.dtype(EDF_TYPES[header['DataType'].lower()])
+    if header.get('ByteOrder', 'LowByteFirst') == 'HighByteFirst':
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+    shape = (int(header['Dim_2']), int(header['Dim_1']))
+    return numpy.memmap(filename, dtype, 'r', offset, shape)
+
+
+def _find_hdf5_data(f):
+    for path in HDF5_DATA_PATHS:
+        if path in f:
+            return f[path]
+    found = []
+
+    def visit(name, item):
+        if name.split('/')[-1] == 'data' and getattr(item, 'ndim', 0) == 3:
+            found.append(item)
+            return True
+    f.visititems(visit)
+    if not found:
+        raise ValueError('No image data in %s' % f.filename)
+    return found[0]
+
+
+def open_hdf5(filename, index=0, path=None):
+    """Access a frame of a Lima HDF5 file: memory mapped if the data is
+    contiguous and not compressed, otherwise (chunked data) only the frame
+    is read.
+    @param index of the frame in the file
+    @param path of the dataset (by default the Lima one)
+    @return numpy array (height, width)
+    """
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        if path is None:
+            dataset = _find_hdf5_data(f)
+        else:
+            dataset = f[path]
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.chunks is not None:
+            return dataset[index]
+        shape = dataset.shape[1:]
+        frame_size = int(numpy.prod(shape)) * dataset.dtype.itemsize
+        return numpy.memmap(filename, dataset.dtype, 'r',
+                            offset + index * frame_size, shape)
+
+
+def open_frame(filename, index=0):
+    """Access a frame saved by Lima, the format is given by the extension
+    of the file name (.edf or .h5).
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'edf':
+        return open_edf(filename, index)
+    elif extension in ('h5', 'hdf5', 'hdf'):
+        return open_hdf5(filename, index)
+    raise ValueError('Unsupported image format: %s' % filename)
@@ -1,4 +1,5 @@
 
+import numpy
 import PyTango
 from sardana import State
 from sardana.pool.controller import Type, Access, Description, Memorize, \
@@ -6,6 +7,38 @@ from sardana.pool.controller import Type, Access, Description, Memorize, \
 from sardana.pool import AcqSynch
 
 
+class GrowableArray(object):
+    """
+    Preallocated 1D array of values: the values are appended without
+    allocating a new array until the capacity is exhausted, then it is
+    doubled. Clearing it keeps the memory for the next acquisition.
+    """
+
+    def __init__(self, capacity=16, dtype=float):
+        self._array = numpy.empty(capacity, dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        self._size = 0
+
+    def extend(self, values):
+        size = self._size + len(values)
+        if size > len(self._array):
+            capacity = max(size, 2 * len(self._array))
+            array = numpy.empty(capacity, self._array.dtype)
+            array[:self._size] = self._array[:self._size]
+            self._array = array
+        self._array[self._size:size] = values
+        self._size = size
+
+    def values(self):
+        """@return a view of the values (overwritten after clear)"""
+        return self._array[:self._size]
+
+
 class LimaRoICounterCtrl(CounterTimerController):
     """
     This class is the Tango Sardana CounterTimer controller for getting the
@@ -59,6 +92,7 @@ class LimaRoICounterCtrl(CounterTimerController):
     IDX_STD_DEVIATION = 4
     IDX_MIN_PIXEL = 5
     IDX_MAX_PIXEL = 6
+    NR_COLUMNS = 7
 
     def __init__(self, inst, props, *args, **kwargs):
         CounterTimerController.__init__(self, inst, props, *args, **kwargs)
@@ -78,6 +112,12 @@ class LimaRoICounterCtrl(CounterTimerController):
         self._limaroi.write_attribute('BufferSize', self.LimaROIBufferSize)
         self._rois = {}
         self._rois_id = {}
+        # RoI changes applied in one go by apply_rois (at the latest in
+        # PreStartAll): axes whose RoI has to be created or set, and names
+        # of the RoIs to remove
+        self._new_rois = set()
+        self._changed_rois = set()
+        self._removed_rois = set()
         self._data_buff = {}
         self._state = None
         self._status = None
@@ -110,32 +150,52 @@ class LimaRoICounterCtrl(CounterTimerController):
         if state == 'ON':
             return
         self._limaroi.Start()
-        for axis in self._rois.keys():
-            self._create_roi(axis)
+        # the RoIs pending to be removed do not exist in the new server
+        self._removed_rois.clear()
+        self._new_rois.update(self._rois.keys())
+        self.apply_rois()
         self._recreate_flg = True
 
-    def _create_roi(self, axis):
-        roi_name = self._rois[axis]['name']
-        roi_id = self._limaroi.addNames([roi_name])[0]
-        self._rois[axis]['id'] = roi_id
-        self._rois_id[roi_id] = axis
-        roi = [roi_id] + self._rois[axis]['roi']
-        self._limaroi.setRois(roi)
+    def apply_rois(self):
+        """Send the pending RoI changes to the roicounter device: one
+        removeRois, one addNames and one setRois call for all the axes."""
+        if self._removed_rois:
+            self._limaroi.removeRois(sorted(self._removed_rois))
+            self._removed_rois.clear()
+        if self._new_rois:
+            axes = sorted(self._new_rois)
+            names = [self._rois[axis]['name'] for axis in axes]
+            for axis, roi_id in zip(axes, self._limaroi.addNames(names)):
+                self._rois[axis]['id'] = roi_id
+                self._rois_id[roi_id] = axis
+            self._changed_rois.update(axes)
+            self._new_rois.clear()
+        if self._changed_rois:
+            rois = []
+            for axis in sorted(self._changed_rois):
+                rois += [self._rois[axis]['id']] + self._rois[axis]['roi']
+            self._limaroi.setRois(rois)
+            self._changed_rois.clear()
 
     def AddDevice(self, axis):
         self._rois[axis] = {}
         roi_name = 'roi_%d' % axis
         self._rois[axis]['name'] = roi_name 
         self._rois[axis]['roi'] = [0, 0, 1, 1]
-        self._data_buff[axis] = []
-        self._create_roi(axis)
+        self._data_buff[axis] = GrowableArray()
+        self._removed_rois.discard(roi_name)
+        self._new_rois.add(axis)
 
     def DeleteDevice(self, axis):
         self._data_buff.pop(axis)
-        self._rois.pop(axis)
-        roi_id = self._rois[axis]['id']
-        self._rois_id.pop(roi_id)
-        
+        roi = self._rois.pop(axis)
+        self._new_rois.discard(axis)
+        self._changed_rois.discard(axis)
+        roi_id = roi.get('id')
+        if roi_id is not None:
+            self._rois_id.pop(roi_id, None)
+            self._removed_rois.add(roi['name'])
+
     def StateAll(self):
         attr = 'CounterStatus'
         self._last_image_ready = self._limaroi.read_attribute(attr).value
@@ -164,31 +224,40 @@ class LimaRoICounterCtrl(CounterTimerController):
             raise ValueError('LimaRoICoTiCtrl allows only Software or Hardware '
                              'triggering')
 
+    def PreStartAll(self):
+        self.apply_rois()
+
     def StartAll(self):
         self._start = True
 
     def ReadAll(self):
         if self._last_image_ready != self._last_image_read:
-            for axis in self._data_buff.keys():
-                self._data_buff[axis] = []
+            for data_buff in self._data_buff.values():
+                data_buff.clear()
             self._last_image_read += 1
             rois_data = self._limaroi.readCounters(self._last_image_read)
-            for base_idx in range(0, len(rois_data), 7):
-                roi_id_idx = base_idx + self.IDX_ROI_ID
-                roi_id = rois_data[roi_id_idx]
-                axis = self._rois_id[roi_id]
+            # one row per RoI and image, grouped by RoI keeping the order of
+            # the images
+            rows = numpy.asarray(rois_data).reshape(-1, self.NR_COLUMNS)
+            roi_ids = rows[:, self.IDX_ROI_ID].astype(int)
+            order = numpy.argsort(roi_ids, kind='mergesort')
+            roi_ids, starts = numpy.unique(roi_ids[order], return_index=True)
+            sums = numpy.split(rows[order, self.IDX_SUM], starts[1:])
+            for roi_id, roi_sums in zip(roi_ids, sums):
+                axis = self._rois_id.get(roi_id)
                 if axis in self._data_buff:
-                    sum_idx = base_idx + self.IDX_SUM
-                    self._data_buff[axis] += [rois_data[sum_idx]]
+                    self._data_buff[axis].extend(roi_sums)
             self._last_image_read = self._last_image_ready
 
     def ReadOne(self, axis):
+        data_buff = self._data_buff[axis]
         if self._synchronization == AcqSynch.SoftwareTrigger:
-            if len(self._data_buff[axis]) == 0:
+            if len(data_buff) == 0:
                 raise Exception('Acquisition did not finish correctly.')
-            value = self._data_buff[axis][0]
+            value = data_buff.values()[0]
         else:
-            value = self._data_buff[axis]
+            # the buffer is reused by the next ReadAll
+            value = data_buff.values().copy()
         return value
 
     def GetExtraAttributePar(self, axis, name):
@@ -219,6 +288,11 @@ class LimaRoICounterCtrl(CounterTimerController):
             elif name == "roiy2":
                 roi[3] = value
             self._rois[axis]['roi'] = roi
-            roi_id = self._rois[axis]['id']
-            new_roi = [roi_id] + roi
-            self._limaroi.setRois(new_roi)
+            if axis not in self._new_rois:
+                self._changed_rois.add(axis)
+
+    def SendToCtrl(self, cmd):
+        if cmd.strip().lower() == 'apply_rois':
+            self.apply_rois()
+            return 'RoIs applied'
+        return 'Unknown command'
@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import Queue
+
 import numpy
 
 import PyTango
@@ -61,6 +63,24 @@ def getPFINameFromFriendlyWords(counter):
         counter = getPFIName(ctr, signal)
     return counter
 
+class ListenerDataReady(object):
+    """Puts the index of the last acquired sample, received with the data
+    ready events of the channel buffer, in the queue."""
+
+    def __init__(self, queue, log=None):
+        self.queue = queue
+        self.log = log
+
+    def push_event(self, event):
+        if not event.err:
+            self.queue.put(event.ctr - 1)
+        else:
+            e = event.errors[0]
+            msg = ('Event error (reason: %s; desc: %s)' % (e.reason, e.desc))
+            if self.log:
+                self.log.error(msg)
+
+
 class Ni660XCTCtrl(object):
     """This class is the Ni600X counter Sardana CounterTimerController.
     It can work in step and continuous scan mode. 
@@ -108,9 +128,6 @@ class Ni660XCTCtrl(object):
     APP_TYPE = None
     SAMPLE_TIMING_TYPE = None
     CLK_SOURCE = None
-    # every QUERY_FILTER calls to ReadOne, the real read to the device will
-    # be executed
-    QUERY_FILTER = 1
  
     direct_attributes = tuple()
     cached_attributes = ('sampleclocksource')
@@ -124,7 +141,10 @@ class Ni660XCTCtrl(object):
         self.channels = {}
         self.counterName = {}
         self.index = {}
-        self.delay_counter = {}
+        self.hw_state = {}
+        self.last_index = {}
+        self._index_queue = {}
+        self._id_callback = {}
         self.aborted = {}
         self.attributes = {}
         self._repetitions = 0
@@ -190,7 +210,6 @@ class Ni660XCTCtrl(object):
         self.counterName[axis] = '/%s/%s' % (deviceName, counterName)
         self.index[axis] = 0
         self.aborted[axis] = False
-        self.delay_counter[axis] = 0
         # For input channels, initialize cache.
         if axis != 1:
             if app_type != self.APP_TYPE:
@@ -201,6 +220,10 @@ class Ni660XCTCtrl(object):
             channel = self.channels[axis]
             channel.addListener(self.counterEventReceived)
             self.ch_configured[axis] = False
+            self.hw_state[axis] = None
+            self.last_index[axis] = -1
+            self._index_queue[axis] = Queue.Queue()
+            self._id_callback[axis] = None
             self.attributes[axis] = {}
             for name in self.cached_attributes:
                 self.attributes[axis][name] = None
@@ -208,9 +231,14 @@ class Ni660XCTCtrl(object):
     def DeleteDevice(self, axis):
         # For input channels, remove cache.
         if axis != 1:
+            self._unsubscribeDataReady(axis)
             self.channels[axis].removeListener(self.counterEventReceived)
             self.attributes.pop(axis)
             self.ch_configured.pop(axis)
+            self.hw_state.pop(axis)
+            self.last_index.pop(axis)
+            self._index_queue.pop(axis)
+            self._id_callback.pop(axis)
         self.channels.pop(axis)
 
     def GetAxisExtraPar(self, axis, name):
@@ -276,6 +304,7 @@ class Ni660XCTCtrl(object):
     def StateOneMultiple(self, axis):
         if axis != 1:
             state = self.channels[axis].state()
+            self.hw_state[axis] = state
             # RUNNING state translates directly to MOVING
             if state == PyTango.DevState.RUNNING:
                 state = State.Moving
@@ -338,8 +367,8 @@ class Ni660XCTCtrl(object):
         self._log.debug("PreStartOneCT(%d): Entering..." % axis)
         self.index[axis] = 0
         self.aborted[axis] = False
-        self.delay_counter[axis] = 0
         if axis != 1:
+            self._unsubscribeDataReady(axis)
             channel = self.channels[axis]
             if channel.State() != PyTango.DevState.STANDBY:
                 channel.Stop()
@@ -377,6 +406,9 @@ class Ni660XCTCtrl(object):
         #self._log.debug("StartOneCT(%d): Entering..." % axis)
         if (axis != 1 or self._synchronization == AcqSynch.SoftwareTrigger):
             channel = self.channels[axis]
+            if (axis != 1 and
+                    self._synchronization != AcqSynch.SoftwareTrigger):
+                self._subscribeDataReady(axis)
             channel.start()
         #self._log.debug("StartOneCT(%d): Leaving..." % axis)
 
@@ -415,11 +447,70 @@ class Ni660XCTCtrl(object):
             channel = self.channels[axis]
             if channel.State() != PyTango.DevState.STANDBY:
                 channel.Stop()
+        if axis != 1:
+            self._unsubscribeDataReady(axis)
         self.aborted[axis] = True
 
+    def _subscribeDataReady(self, axis):
+        """Subscribe to the data ready events of the channel buffer. If the
+        channel does not push them, ReadOne reads the buffer at every call.
+        """
+        self.hw_state[axis] = None
+        self.last_index[axis] = -1
+        self._index_queue[axis] = Queue.Queue()
+        cb = ListenerDataReady(self._index_queue[axis], log=self._log)
+        event_type = PyTango.EventType.DATA_READY_EVENT
+        try:
+            self._id_callback[axis] = self.channels[axis].subscribe_event(
+                self.BUFFER_ATTR, event_type, cb)
+        except Exception, e:
+            self._log.debug('Could not subscribe to the data ready events '
+                            'of %s: %s' % (self.channelDevNamesList[axis-1],
+                                           e))
+            self._id_callback[axis] = None
+
+    def _unsubscribeDataReady(self, axis):
+        id_callback = self._id_callback.get(axis)
+        if id_callback is None:
+            return
+        self._id_callback[axis] = None
+        try:
+            self.channels[axis].unsubscribe_event(id_callback)
+        except Exception, e:
+            self._log.debug('Could not unsubscribe from the data ready events '
+                            'of %s: %s' % (self.channelDevNamesList[axis-1],
+                                           e))
+
+    def _getLastIndex(self, axis):
+        """@return the index of the last acquired sample of the channel, or
+                   None if it is not known (no data ready events)"""
+        if self._id_callback.get(axis) is None:
+            return None
+        if self.hw_state[axis] == PyTango.DevState.ON:
+            # the acquisition finished, all the samples are in the buffer
+            return self._repetitions - 1
+        queue = self._index_queue[axis]
+        new_index = self.last_index[axis]
+        while not queue.empty():
+            data_ready_index = queue.get()
+            if data_ready_index > new_index:
+                new_index = data_ready_index
+        self.last_index[axis] = new_index
+        return new_index
+
     def _calculate(self, axis, data, index):
         return data[index:]
 
+    def _readBuffer(self, axis):
+        """Read the whole buffer of the channel as a numpy array"""
+        channel = self.channels[axis]
+        attr = channel.read_attribute(self.BUFFER_ATTR,
+                                      extract_as=PyTango.ExtractAs.Numpy)
+        data = attr.value
+        if data is None:
+            data = numpy.array([])
+        return data
+
     def ReadOneSingle(self, axis):
         index = self.index[axis]
         #self._log.debug('ReadOne(%d) index = %d' % (axis, index))
@@ -427,21 +518,17 @@ class Ni660XCTCtrl(object):
             data = [self._integration_time]
         else:
             data = numpy.array([0])
-            self.delay_counter[axis] += 1
-            self.delay_counter[axis] %= self.QUERY_FILTER
-            if self.delay_counter[axis] == 0:
-                try:
-                    channel = self.channels[axis]
-                    data = channel.getAttribute(self.BUFFER_ATTR).read().value
-                    if data is None:
-                        data = numpy.array([0])
-                except Exception, e:
-                    msg = ('ReadOne(%d): Exception while reading' +
-                           ' buffer: %s' % (axis, e))
-                    self._log.error(msg)
-                if len(data) == 2:
-                    index = 1
-                    data = self._calculate(axis, data, index)
+            try:
+                data = self._readBuffer(axis)
+                if len(data) == 0:
+                    data = numpy.array([0])
+            except Exception, e:
+                msg = ('ReadOne(%d): Exception while reading' +
+                       ' buffer: %s' % (axis, e))
+                self._log.error(msg)
+            if len(data) == 2:
+                index = 1
+                data = self._calculate(axis, data, index)
         # values coming from CountBuffer are of type DevULong cast it to float
         data = float(data[0])
         sardana_value = SardanaValue(data)
@@ -452,8 +539,10 @@ class Ni660XCTCtrl(object):
         index = self.index[axis]
         self._log.debug('ReadOne(%d) index = %d' % (axis, index))
         if self.index[axis] == self._repetitions:
+            if axis != 1:
+                self._unsubscribeDataReady(axis)
             # Return empty data
-            return []
+            return numpy.array([])
 
         if axis == 1:
             max_index = max(self.index.values())
@@ -461,14 +550,13 @@ class Ni660XCTCtrl(object):
             data = numpy.tile(self._integration_time, rep)
         else:
             data = numpy.array([])
-            self.delay_counter[axis] += 1
-            self.delay_counter[axis] %= self.QUERY_FILTER
-            if self.delay_counter[axis] == 0:
+            last = self._getLastIndex(axis)
+            # the data ready events only avoid reading the buffer when there
+            # are no new samples: the channels have no command to read a
+            # range of it, so the whole buffer is transferred at every read
+            if last is None or last >= index:
                 try:
-                    channel = self.channels[axis]
-                    data = channel.getAttribute(self.BUFFER_ATTR).read().value
-                    if data is None:
-                        data = numpy.array([])
+                    data = self._readBuffer(axis)
                 except Exception, e:
                     msg = ('ReadOne(%d): Exception while reading buffer: %s'
                            % (axis, e))
@@ -476,8 +564,8 @@ class Ni660XCTCtrl(object):
                 if len(data) > 0:
                     data = self._calculate(axis, data, index)
         self.index[axis] = index + len(data)
-        idx = range(index, self.index[axis])
-        data = data.tolist()
+        # the samples are passed to sardana as a numpy array, there is no
+        # need to convert each of them to a python float
         self._log.debug('index: %r'% self.index[axis] )
         if self._repetitions == 1 and len(data) == 1:
             channel = self.channels[axis]
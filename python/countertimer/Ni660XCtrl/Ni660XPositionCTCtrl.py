@@ -17,7 +17,6 @@ class Ni660XPositionCTCtrl(Ni660XCTCtrl, CounterTimerController):
     "This class is the Ni600X position capture Sardana CounterTimerController"
 
     BUFFER_ATTR = 'PositionBuffer'
-    QUERY_FILTER = 1
     SAMPLE_TIMING_TYPE = 'SampClk'
     APP_TYPE = 'CIAngEncoderChan'
     CLK_SOURCE = 'sampleclocksource'
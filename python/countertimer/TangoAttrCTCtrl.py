@@ -5,7 +5,8 @@ from sardana import pool
 from sardana.pool import PoolUtil
 from sardana.pool.controller import CounterTimerController, ZeroDController
 
-import math
+from TangoAttrLib import (FormulaEngine, AttributeEventCache, to_value,
+                          read_attributes_concurrently)
 
 TANGO_ATTR = 'TangoAttribute'
 FORMULA = 'Formula'
@@ -13,6 +14,8 @@ DEVICE = 'Device'
 ATTRIBUTE = 'Attribute'
 EVALUATED_VALUE = 'Evaluated_value'
 INDEX_READ_ALL = 'Index_read_all'
+EVENT_TYPE = 'EventType'
+EVENT_MAX_AGE = 'EventMaxAge'
 
 
 class ReadTangoAttributes():
@@ -27,6 +30,14 @@ class ReadTangoAttributes():
                             FORMULA:
                             {'Type':'PyTango.DevString'
                              ,'Description':'The Formula to get the desired value.\ne.g. "math.sqrt(VALUE)"'
+                             ,'R/W Type':'PyTango.READ_WRITE'},
+                            EVENT_TYPE:
+                            {'Type':'PyTango.DevString'
+                             ,'Description':'Take the value from "change" or "periodic" events instead of reading it (empty to always read it)'
+                             ,'R/W Type':'PyTango.READ_WRITE'},
+                            EVENT_MAX_AGE:
+                            {'Type':'PyTango.DevDouble'
+                             ,'Description':'Max age (s) of the event value, if older it is read (0 for no limit)'
                              ,'R/W Type':'PyTango.READ_WRITE'}
                             }
     
@@ -36,24 +47,42 @@ class ReadTangoAttributes():
         self.devices_to_read = {}
         self.axis_to_update = {}
         self.devs_values = []
+        self.formulas = FormulaEngine(globals())
+        self.events = AttributeEventCache()
+        self.event_values = {}
 
     def add_device(self, axis):
         self._log.debug('AddDevice %d' % axis)
+        self.events.log = self._log
         self.devsExtraAttributes[axis] = {}
         self.devsExtraAttributes[axis][FORMULA] = 'VALUE'
         self.devsExtraAttributes[axis][TANGO_ATTR] = None
         self.devsExtraAttributes[axis][EVALUATED_VALUE] = None
+        self.devsExtraAttributes[axis][EVENT_TYPE] = ''
+        self.devsExtraAttributes[axis][EVENT_MAX_AGE] = 0.0
+        self.formulas.set_formula(axis, 'VALUE')
 
     def delete_device(self, axis):
         del self.devsExtraAttributes[axis]
+        self.formulas.remove(axis)
+        self.events.unsubscribe(axis)
 
     def state_one(self, axis):
         return (DevState.ON, 'Always ON, just reading external Tango Attribute')
 
     def pre_read_all(self):
         self.devices_to_read = {}
+        self.event_values = {}
 
     def pre_read_one(self, axis):
+        # In event mode take the last pushed value, if not too old
+        if self.devsExtraAttributes[axis][EVENT_TYPE]:
+            tango_attr = self.devsExtraAttributes[axis][TANGO_ATTR]
+            max_age = self.devsExtraAttributes[axis][EVENT_MAX_AGE]
+            value = self.events.get(tango_attr, max_age)
+            if value is not None:
+                self.event_values[tango_attr] = value
+                return
         dev = self.devsExtraAttributes[axis][DEVICE]
         attr = self.devsExtraAttributes[axis][ATTRIBUTE]
         if not self.devices_to_read.has_key(dev):
@@ -64,50 +93,53 @@ class ReadTangoAttributes():
 
     def read_all(self):
         try:
+          for tango_attr, VALUE in self.event_values.iteritems():
+              results = self.formulas.evaluate_attribute(tango_attr, to_value(VALUE))
+              for axis, v in results.iteritems():
+                  self.devsExtraAttributes[axis][EVALUATED_VALUE] = v
+          requests = {}
           for dev in self.devices_to_read.keys():
-              attributes = self.devices_to_read[dev]
-              values = {}
+              # Set the list to prevent duplicated attr names
+              # Tango raise exception on read_attributes if there are
+              # duplicated attributes
+              attrs = list(set(self.devices_to_read[dev]))
               try:
                   dev_proxy = PoolUtil().get_device(self.inst_name, dev)
-                  # Set the list to prevent duplicated attr names
-                  # Tango raise exception on read_attributes if there are
-                  # duplicated attributes
-                  attrs = list(set(attributes))
-                  r_values = dev_proxy.read_attributes(attrs)
-                  values = dict(zip(attrs, r_values))
-              except PyTango.DevFailed, e:
-                  # In case of DeviceServer error
-                  for attr in attributes:
-                      axis = self.axis_by_tango_attribute[dev+'/'+attr]
-                      self.devsExtraAttributes[axis][EVALUATED_VALUE] = e
-                  self._log.debug("Exception on read the attribute:%r"%e)
+                  requests[dev] = (dev_proxy, attrs)
               except Exception,e:
-                  self._log.error('Exception reading attributes:%s.%s' % (dev,str(attributes)))
-
-              for attr in attributes:
-                  axies = []
-                  for axis, dic in self.devsExtraAttributes.iteritems():
-                      if dic[TANGO_ATTR] == dev+'/'+attr:
-                           axies.append(axis)
-                  for axis in axies:
-                    if len(values) > 0:
-                        dev_attr_value = values[attr]
-                        if dev_attr_value.has_failed:
-                            # In case of Attribute error
-                            VALUE = PyTango.DevFailed(*dev_attr_value.get_err_stack())
-                            self.devsExtraAttributes[axis][EVALUATED_VALUE] = VALUE
-                        else:
-                            formula = self.devsExtraAttributes[axis][FORMULA]
-                            VALUE = float(dev_attr_value.value)
-                            value = VALUE # just in case 'VALUE' has been written in lowercase...
-                            v = eval(formula)
-                            self.devsExtraAttributes[axis][EVALUATED_VALUE] = v
+                  self._log.error('Exception getting device:%s %r' % (dev,e))
+          # All the devices are read at the same time
+          replies = read_attributes_concurrently(requests)
+          for dev, r_values in replies.iteritems():
+              attrs = requests[dev][1]
+              if isinstance(r_values, PyTango.DevFailed):
+                  # In case of DeviceServer error
+                  for attr in attrs:
+                      for axis in self.formulas.axes(dev+'/'+attr):
+                          self.devsExtraAttributes[axis][EVALUATED_VALUE] = r_values
+                  self._log.debug("Exception on read the attribute:%r"%r_values)
+                  continue
+              elif isinstance(r_values, Exception):
+                  self._log.error('Exception reading attributes:%s.%s' % (dev,str(attrs)))
+                  continue
+
+              for attr, dev_attr_value in zip(attrs, r_values):
+                  key = dev+'/'+attr
+                  if dev_attr_value.has_failed:
+                      # In case of Attribute error
+                      VALUE = PyTango.DevFailed(*dev_attr_value.get_err_stack())
+                      results = dict.fromkeys(self.formulas.axes(key), VALUE)
+                  else:
+                      VALUE = to_value(dev_attr_value.value)
+                      results = self.formulas.evaluate_attribute(key, VALUE)
+                  for axis, v in results.iteritems():
+                      self.devsExtraAttributes[axis][EVALUATED_VALUE] = v
         except Exception as e:
           self._log.error('Exception on read_all: %r'%e)
 
     def read_one(self, axis):
         value = self.devsExtraAttributes[axis][EVALUATED_VALUE]
-        if isinstance(value, PyTango.DevFailed):
+        if isinstance(value, (PyTango.DevFailed, Exception)):
             raise value
         return value
 
@@ -115,8 +147,11 @@ class ReadTangoAttributes():
         return self.devsExtraAttributes[axis][name]
 
     def set_extra_attribute_par(self,axis, name, value):
-        value =  value.lower()
+        if isinstance(value, basestring):
+            value =  value.lower()
         self._log.debug('SetExtraAttributePar [%d] %s = %s' % (axis, name, value))
+        if name == FORMULA:
+            self.formulas.set_formula(axis, value)
         self.devsExtraAttributes[axis][name] = value
         if name == TANGO_ATTR:
             idx = value.rfind("/")
@@ -125,6 +160,18 @@ class ReadTangoAttributes():
             self.devsExtraAttributes[axis][DEVICE] = dev
             self.devsExtraAttributes[axis][ATTRIBUTE] = attr
             self.axis_by_tango_attribute[value] = axis
+            self.formulas.set_attribute(axis, value)
+        if name in (TANGO_ATTR, EVENT_TYPE):
+            self.update_subscription(axis)
+
+    def update_subscription(self, axis):
+        tango_attr = self.devsExtraAttributes[axis][TANGO_ATTR]
+        event_type = self.devsExtraAttributes[axis][EVENT_TYPE]
+        try:
+            self.events.subscribe(axis, tango_attr, event_type)
+        except PyTango.DevFailed, e:
+            self._log.error('Could not subscribe to %s events of %s, it '
+                            'will be read: %r' % (event_type, tango_attr, e))
 
 
 class TangoAttrCTController(ReadTangoAttributes, CounterTimerController):
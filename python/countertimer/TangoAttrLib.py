@@ -0,0 +1,272 @@
+##############################################################################
+##
+## This file is part of Sardana
+##
+## http://www.tango-controls.org/static/sardana/latest/doc/html/index.html
+##
+## Copyright 2011 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+## Sardana is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Sardana is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with Sardana.  If not, see <http://www.gnu.org/licenses/>.
+##
+##############################################################################
+
+"""Helpers shared by the TangoAttr* controllers (countertimer, zerod, motor
+and ioregister). The controllers of the other directories still work
+without it in the PoolPath, evaluating the formulas with eval and reading
+the devices one after the other.
+"""
+
+import math
+import threading
+import time
+
+import numpy
+import PyTango
+
+
+def to_value(value):
+    """Scalars are converted to float, spectra to numpy arrays."""
+    if isinstance(value, (list, tuple, numpy.ndarray)):
+        return numpy.asarray(value)
+    return float(value)
+
+
+class Formula(object):
+    """A formula of VALUE (or value), compiled once.
+
+    The formulas are evaluated with math and numpy available, plus the
+    given globals (usually the ones of the controller module, so the
+    formulas written for the previous eval based implementation still work).
+    """
+
+    def __init__(self, source, globals_=None):
+        self.source = source
+        self.code = compile(source, 'Formula', 'eval')
+        self.globals = {'math': math, 'numpy': numpy}
+        if globals_ is not None:
+            self.globals.update(globals_)
+        self.identity = source.strip() in ('VALUE', 'value')
+
+    def __call__(self, VALUE):
+        if self.identity:
+            return VALUE
+        return eval(self.code, self.globals, {'VALUE': VALUE, 'value': VALUE})
+
+
+class FormulaEngine(object):
+    """The formulas of the axes of a controller, and the index of the axes
+    reading each Tango attribute.
+
+    All the axes reading the same attribute are evaluated in one call of
+    evaluate_attribute, and axes sharing the same formula are evaluated only
+    once.
+    """
+
+    def __init__(self, globals_=None, default='VALUE'):
+        self.globals = globals_
+        self.default = default
+        self.formulas = {}
+        self.attributes = {}
+        self.axes_by_attribute = {}
+        self._compiled = {}
+
+    def _compile(self, source):
+        formula = self._compiled.get(source)
+        if formula is None:
+            formula = Formula(source, self.globals)
+            self._compiled[source] = formula
+        return formula
+
+    def set_formula(self, axis, source):
+        """Compile and assign a formula to the axis. A SyntaxError is raised
+        (and the previous formula kept) if it can not be compiled."""
+        self.formulas[axis] = self._compile(source)
+
+    def get_formula(self, axis):
+        return self.formulas[axis].source
+
+    def set_attribute(self, axis, attribute):
+        """Assign the full Tango attribute name (dev/ice/name/attr) read by
+        the axis, the names are not case sensitive."""
+        self._unindex(axis)
+        if attribute:
+            attribute = attribute.lower()
+            self.attributes[axis] = attribute
+            self.axes_by_attribute.setdefault(attribute, []).append(axis)
+
+    def remove(self, axis):
+        self._unindex(axis)
+        self.formulas.pop(axis, None)
+
+    def _unindex(self, axis):
+        attribute = self.attributes.pop(axis, None)
+        if attribute is None:
+            return
+        axes = self.axes_by_attribute[attribute]
+        axes.remove(axis)
+        if not axes:
+            del self.axes_by_attribute[attribute]
+
+    def axes(self, attribute):
+        """@return the axes reading the attribute"""
+        return self.axes_by_attribute.get(attribute.lower(), [])
+
+    def evaluate(self, axis, VALUE):
+        formula = self.formulas.get(axis)
+        if formula is None:
+            formula = self.formulas[axis] = self._compile(self.default)
+        return formula(VALUE)
+
+    def evaluate_attribute(self, attribute, VALUE):
+        """Evaluate the formulas of all the axes reading the attribute.
+        @return a dictionary axis: value. If a formula fails, the value of
+                its axes is the exception.
+        """
+        results = {}
+        by_formula = {}
+        for axis in self.axes(attribute):
+            by_formula.setdefault(self.formulas.get(axis), []).append(axis)
+        for formula, axes in by_formula.items():
+            if formula is None:
+                formula = self._compile(self.default)
+            try:
+                result = formula(VALUE)
+            except Exception, e:
+                result = e
+            for axis in axes:
+                results[axis] = result
+        return results
+
+
+def read_attributes_concurrently(requests):
+    """Read the attributes of several devices at the same time: all the
+    asynchronous read_attributes requests are sent before waiting for the
+    first reply, so the devices cost one round trip instead of one each.
+    @param requests dictionary device name: (device proxy, attribute names)
+    @return dictionary device name: list of DeviceAttribute (in the order of
+            the attribute names) or the exception raised reading them
+    """
+    replies = {}
+    ids = {}
+    for dev, (proxy, attributes) in requests.items():
+        try:
+            ids[dev] = proxy.read_attributes_asynch(attributes)
+        except Exception, e:
+            replies[dev] = e
+    for dev, request_id in ids.items():
+        proxy = requests[dev][0]
+        try:
+            # timeout 0: wait for the reply (up to the device timeout)
+            replies[dev] = proxy.read_attributes_reply(request_id, 0)
+        except Exception, e:
+            replies[dev] = e
+    return replies
+
+
+class _AttributeListener(object):
+
+    def __init__(self, cache, attribute):
+        self.cache = cache
+        self.attribute = attribute
+
+    def push_event(self, event):
+        if not event.err:
+            self.cache.store(self.attribute, event.attr_value.value)
+        else:
+            # discard it, the next read is done synchronously
+            self.cache.discard(self.attribute)
+            if self.cache.log:
+                e = event.errors[0]
+                self.cache.log.debug('Event error on %s (reason: %s; '
+                                     'desc: %s)' % (self.attribute, e.reason,
+                                                    e.desc))
+
+
+class AttributeEventCache(object):
+    """Last values of Tango attributes pushed by change or periodic events,
+    with the time they were received.
+
+    The axes subscribe to the attribute they read; an attribute subscribed
+    by several axes is subscribed only once per event type.
+    """
+
+    EVENT_TYPES = {'change': PyTango.EventType.CHANGE_EVENT,
+                   'periodic': PyTango.EventType.PERIODIC_EVENT}
+
+    def __init__(self, log=None):
+        self.log = log
+        self.lock = threading.Lock()
+        self.values = {}
+        self.subscriptions = {}
+        self.axes = {}
+
+    def subscribe(self, axis, attribute, event_type):
+        """Subscribe the axis to the events of the attribute. An empty
+        event_type only unsubscribes it.
+        @param event_type 'change', 'periodic' or ''
+        """
+        self.unsubscribe(axis)
+        event_type = event_type.lower()
+        if not event_type or not attribute:
+            return
+        if event_type not in self.EVENT_TYPES:
+            raise ValueError('Unknown event type %s (use one of %s)' %
+                             (event_type, ', '.join(self.EVENT_TYPES)))
+        key = (attribute.lower(), event_type)
+        subscription = self.subscriptions.get(key)
+        if subscription is None:
+            proxy = PyTango.AttributeProxy(attribute)
+            listener = _AttributeListener(self, key[0])
+            event_id = proxy.subscribe_event(self.EVENT_TYPES[event_type],
+                                             listener)
+            subscription = self.subscriptions[key] = [proxy, event_id, set()]
+        subscription[2].add(axis)
+        self.axes[axis] = key
+
+    def unsubscribe(self, axis):
+        key = self.axes.pop(axis, None)
+        if key is None:
+            return
+        proxy, event_id, axes = self.subscriptions[key]
+        axes.discard(axis)
+        if axes:
+            return
+        del self.subscriptions[key]
+        self.discard(key[0])
+        try:
+            proxy.unsubscribe_event(event_id)
+        except Exception, e:
+            if self.log:
+                self.log.debug('Could not unsubscribe from %s: %s' %
+                               (key[0], e))
+
+    def store(self, attribute, value):
+        with self.lock:
+            self.values[attribute] = (value, time.time())
+
+    def discard(self, attribute):
+        with self.lock:
+            self.values.pop(attribute, None)
+
+    def get(self, attribute, max_age):
+        """@return the last value of the attribute or None if there is
+                   none or it is older than max_age seconds (max_age <= 0
+                   means it never gets old)"""
+        with self.lock:
+            value, timestamp = self.values.get(attribute.lower(), (None, 0))
+        if value is None:
+            return None
+        if max_age > 0 and time.time() - timestamp > max_age:
+            return None
+        return value
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from LimaFileLib import open_edf, open_frame
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def edf_frame(data, **keys):
+    header = ('{\nHeaderID = EH:000001:000000:000000 ;\nByteOrder = '
+              'LowByteFirst ;\nDataType = UnsignedShort ;\nDim_1 = %d ;\n'
+              'Dim_2 = %d ;\nSize = %d ;\n' % (data.shape[1], data.shape[0],
+                                                 data.nbytes))
+    for key, value in keys.items():
+        header += '%s = %s ;\n' % (key, value)
+    header = header.ljust(1024 - 2) + '}\n'
+    return header + data.astype('<u2').tostring()
+
+
+class LimaFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.frames = [numpy.arange(i, i + 12, dtype=numpy.uint16)
+                       .reshape(3, 4) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_edf(self):
+        filename = os.path.join(self.dir, 'img_0000.edf')
+        with open(filename, 'wb') as f:
+            for frame in self.frames:
+                f.write(edf_frame(frame, count_time=0.1))
+        for i, frame in enumerate(self.frames):
+            image = open_edf(filename, i)
+            self.assertEqual(image.shape, (3, 4))
+            self.assertTrue((image == frame).all())
+        self.assertTrue((open_frame(filename) == self.frames[0]).all())
+
+    @unittest.skipIf(h5py is None, 'h5py not available')
+    def test_hdf5(self):
+        filename = os.path.join(self.dir, 'img_0000.h5')
+        with h5py.File(filename, 'w') as f:
+            f['entry_0000/measurement/data'] = numpy.array(self.frames)
+        for i, frame in enumerate(self.frames):
+            self.assertTrue((open_frame(filename, i) == frame).all())
+
+    def test_format(self):
+        self.assertRaises(ValueError, open_frame, 'img_0000.cbf')
+
+
+if __name__ == '__main__':
+    unittest.main()
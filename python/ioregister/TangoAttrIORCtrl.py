@@ -39,6 +39,13 @@ from sardana.tango.core.util import from_tango_state_to_state
 
 import json
 
+try:
+    # TangoAttrLib is in the countertimer directory, without it in the
+    # PoolPath each axis reads its own attribute in ReadOne
+    from TangoAttrLib import read_attributes_concurrently
+except ImportError:
+    read_attributes_concurrently = None
+
 TANGO_ATTR = 'TangoAttribute'
 DEVICE = 'Device'
 DPROXY = 'DeviceProxy'
@@ -127,6 +134,8 @@ class TangoAttrIORController(IORegisterController):
     def __init__(self, inst, props, *args, **kwargs):
         IORegisterController.__init__(self, inst, props, *args, **kwargs)
         self.devsExtraAttributes = {}
+        self.devices_to_read = {}
+        self.read_values = {}
 
     def AddDevice(self, axis):
         self._log.debug('AddDevice %d' % axis)
@@ -170,15 +179,64 @@ class TangoAttrIORController(IORegisterController):
                 state = from_tango_state_to_state(state)
             return (state, status)
 
+    def PreReadAll(self):
+        self.devices_to_read = {}
+        self.read_values = {}
+
+    def PreReadOne(self, axis):
+        dev = self.devsExtraAttributes[axis].get(DEVICE)
+        attr = self.devsExtraAttributes[axis].get(ATTRIBUTE)
+        if dev is None or attr is None:
+            return
+        attrs = self.devices_to_read.setdefault(dev, [])
+        if attr not in attrs:
+            attrs.append(attr)
+
+    def ReadAll(self):
+        if read_attributes_concurrently is None:
+            return
+        # All the devices are read at the same time, one call per device
+        requests = {}
+        for dev, attrs in self.devices_to_read.items():
+            try:
+                requests[dev] = (PoolUtil().get_device(self.inst_name, dev), attrs)
+            except Exception, e:
+                self._log.error('Exception getting device:%s %r' % (dev, e))
+        replies = read_attributes_concurrently(requests)
+        for dev, values in replies.items():
+            attrs = requests[dev][1]
+            if isinstance(values, Exception):
+                for attr in attrs:
+                    self.read_values[(dev, attr)] = values
+                continue
+            for attr, dev_attr_value in zip(attrs, values):
+                if dev_attr_value.has_failed:
+                    value = DevFailed(*dev_attr_value.get_err_stack())
+                else:
+                    value = dev_attr_value.value
+                self.read_values[(dev, attr)] = value
+
+    def _readValue(self, axis):
+        '''The value read in ReadAll, or read it now if not available.'''
+        dev = self.devsExtraAttributes[axis][DEVICE]
+        attr = self.devsExtraAttributes[axis][ATTRIBUTE]
+        try:
+            value = self.read_values[(dev, attr)]
+        except KeyError:
+            dev_proxy = self.devsExtraAttributes[axis][DPROXY] or self._buildProxy(axis)
+            return dev_proxy.read_attribute(attr).value
+        if isinstance(value, Exception):
+            raise value
+        return value
+
     def ReadOne(self, axis):
         attr = self.devsExtraAttributes[axis][ATTRIBUTE]
-        dev_proxy = self.devsExtraAttributes[axis][DPROXY] or self._buildProxy(axis)
         llabels = len(self.devsExtraAttributes[axis][LABELS])
         positions = self.devsExtraAttributes[axis][POSITIONS]
         calibration = self.devsExtraAttributes[axis][CALIBRATION]
         lcalibration = len(calibration)
         try:
-            value = dev_proxy.read_attribute(attr).value
+            value = self._readValue(axis)
             self.devsExtraAttributes[axis][READFAILED] = False
             #case 0: nothing to translate, only round about integer the attribute value
             if llabels == 0:
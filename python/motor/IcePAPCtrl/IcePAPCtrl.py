@@ -29,7 +29,7 @@ import numpy
 
 from pyIcePAP import *
 
-from PyTango import AttributeProxy
+from PyTango import AttributeProxy, EventType
 
 from sardana import State, DataAccess
 from sardana.pool.controller import MotorController
@@ -51,9 +51,15 @@ class IcepapController(MotorController):
     ctrl_properties = {
         'Host':{Type:str,Description:'The host name'},
         'Port':{Type:int, Description:'The port number',DefaultValue:5000},
-        'Timeout':{Type:int, Description:'Connection timeout',DefaultValue:3}
+        'Timeout':{Type:int, Description:'Connection timeout',DefaultValue:3},
+        'SnapshotMaxAge':{Type:float, Description:'Max age (s) of the cached status/position values served to the extra attributes',DefaultValue:0.5}
     }
 
+    ## The registers that can be read with the ?POS and ?ENC multi-axis queries
+    ## and that are exposed as the Pos<REGISTER> and Enc<REGISTER> extra attributes
+    pos_registers = ['AXIS','INDEXER','SHFTENC','TGTENC','ENCIN','INPOS','ABSENC','MOTOR']
+    enc_registers = ['AXIS','INDEXER','SHFTENC','TGTENC','ENCIN','INPOS','ABSENC']
+
     ## The axis extra attributes that correspond to extra features from the Icepap drivers
     axis_attributes = {
         'Indexer':{Type:str,Access:ReadWrite},
@@ -154,11 +160,15 @@ class IcepapController(MotorController):
         self.attributes[axis]["status_value"] = None
         self.attributes[axis]["last_state_value"] = None
         self.attributes[axis]["position_value"] = None
+        self.attributes[axis]["snapshot"] = {}
         self.attributes[axis]["MotorEnabled"] = True
         self.attributes[axis]['use_encoder_source'] = False
         self.attributes[axis]['encoder_source'] = 'attr://EncEncIn'
         self.attributes[axis]['encoder_source_formula'] = 'VALUE'
+        self.attributes[axis]['encoder_source_formula_code'] = compile('VALUE', 'EncoderSourceFormula', 'eval')
         self.attributes[axis]['encoder_source_tango_attribute'] = FakedAttributeProxy(self, axis, 'attr://EncEncIn')
+        self.attributes[axis]['encoder_source_event_id'] = None
+        self.attributes[axis]['encoder_source_value'] = None
 
         if self.iPAP.connected:
             drivers_alive = self.iPAP.getDriversAlive()
@@ -172,8 +182,8 @@ class IcepapController(MotorController):
 
 
     def DeleteDevice(self,axis):
-        """ Nothing special to do. """
-        pass
+        """ Unsubscribe from the external encoder source, if any. """
+        self._unsubscribeEncoderSource(axis)
 
     def PreStateAll(self):
         """ If there is no connection, to the Icepap system, return False"""
@@ -196,6 +206,7 @@ class IcepapController(MotorController):
                 ans = self.iPAP.getMultipleStatus(self.stateMultiple)
                 for axis, status in ans:
                     self.attributes[axis]['status_value'] = status
+                    self._storeSnapshot(axis, 'status', status)
             except Exception,e:
                 self._log.error('StateAll(%s) Hint: some driver board not present?.\nException:\n%s' % (str(self.stateMultiple),str(e)))
         else:
@@ -307,6 +318,11 @@ class IcepapController(MotorController):
         self.positionMultiple = []
         if not self.iPAP.connected:
             return False
+        # THE ENCODER SOURCE OF AN AXIS MAY READ ANY REGISTER OF ANY AXIS, SO
+        # IT CAN NOT BE SERVED FROM THE SNAPSHOT TAKEN IN A PREVIOUS READ
+        if any(attrs['use_encoder_source'] for attrs in self.attributes.values()):
+            for axis in self.attributes:
+                self._invalidateSnapshot(axis)
 
     def PreReadOne(self,axis):
         self.attributes[axis]["position_value"] = None
@@ -326,6 +342,7 @@ class IcepapController(MotorController):
                 #ans = self.iPAP.getMultiplePosition(self.positionMultiple)
                 for axis, position in ans:
                     self.attributes[axis]['position_value'] = long(position)
+                    self._storeSnapshot(axis, ('pos','AXIS'), position)
             except Exception,e:
                 self._log.error('ReadAll(%s) Hint: some driver board not present?.\nException:\n%s' % (str(self.positionMultiple),str(e)))
         else:
@@ -366,6 +383,9 @@ class IcepapController(MotorController):
         self.moveMultipleValues = []
         if not self.iPAP.connected:
             return False
+        # THE ENCODER SOURCE POSITIONS HAVE TO BE FRESH BEFORE COMPUTING THE MOVES
+        for axis in self.attributes:
+            self._invalidateSnapshot(axis)
 
     def PreStartOne(self,axis,pos):
         """ Store all positions in a variable and then react on the StartAll method.
@@ -399,6 +419,8 @@ class IcepapController(MotorController):
         """ Move all axis at all position with just one command to the Icepap Controller. """
         if self.iPAP.connected:
             try:
+                for axis, pos in self.moveMultipleValues:
+                    self._invalidateSnapshot(axis)
                 self.iPAP.moveMultipleGrouped(self.moveMultipleValues)
                 self._log.info('moveMultiple: '+str(self.moveMultipleValues))
                 self.moveMultipleValues = []
@@ -512,55 +534,11 @@ class IcepapController(MotorController):
                 ## Julio Lidon points out that this info is very useful:
                 ## ?POS : AXIS INDEXER POSERR SHFTENC TGTENC ENCIN INPOS ABSENC
                 ## ?ENC : AXIS INDEXER EXTERR SHFTENC TGTENC ENCIN INPOS ABSENC
-                elif name == "posaxis":
-                    ans = self.iPAP.getPositionFromBoard(axis,"AXIS")
-                    return float(ans)
-                elif name == "posindexer":
-                    ans = self.iPAP.getPositionFromBoard(axis,"INDEXER")
-                    return float(ans)
-                ##elif name == "posposerr":
-                ##    ans = self.iPAP.getPosition(axis,"POSERR")
-                ##    return ans
-                elif name == "posshftenc":
-                    ans = self.iPAP.getPositionFromBoard(axis,"SHFTENC")
-                    return float(ans)
-                elif name == "postgtenc":
-                    ans = self.iPAP.getPositionFromBoard(axis,"TGTENC")
-                    return float(ans)
-                elif name == "posencin":
-                    ans = self.iPAP.getPositionFromBoard(axis,"ENCIN")
-                    return float(ans)
-                elif name == "posinpos":
-                    ans = self.iPAP.getPositionFromBoard(axis,"INPOS")
-                    return float(ans)
-                elif name == "posabsenc":
-                    ans = self.iPAP.getPositionFromBoard(axis,"ABSENC")
-                elif name == "posmotor":
-                    ans = self.iPAP.getPositionFromBoard(axis,"MOTOR")
-                    return float(ans)
-                elif name == "encaxis":
-                    ans = self.iPAP.getEncoder(axis,"AXIS")
-                    return float(ans)
-                elif name == "encindexer":
-                    ans = self.iPAP.getEncoder(axis,"INDEXER")
+                elif name[:3] == 'pos' and name[3:].upper() in self.pos_registers:
+                    ans = self._getSnapshot(axis, ('pos', name[3:].upper()), all_registers=True)
                     return float(ans)
-                ##elif name == "encexterr":
-                ##    ans = self.iPAP.getEncoder(axis,"EXTERR")
-                ##    return ans
-                elif name == "encshftenc":
-                    ans = self.iPAP.getEncoder(axis,"SHFTENC")
-                    return float(ans)
-                elif name == "enctgtenc":
-                    ans = self.iPAP.getEncoder(axis,"TGTENC")
-                    return float(ans)
-                elif name == "encencin":
-                    ans = self.iPAP.getEncoder(axis,"ENCIN")
-                    return float(ans)
-                elif name == "encinpos":
-                    ans = self.iPAP.getEncoder(axis,"INPOS")
-                    return float(ans)
-                elif name == "encabsenc":
-                    ans = self.iPAP.getEncoder(axis,"ABSENC")
+                elif name[:3] == 'enc' and name[3:].upper() in self.enc_registers:
+                    ans = self._getSnapshot(axis, ('enc', name[3:].upper()), all_registers=True)
                     return float(ans)
                 elif name == "powerinfo":
                     ans = self.iPAP.isg_powerinfo(axis)
@@ -568,21 +546,15 @@ class IcepapController(MotorController):
                 elif name == 'motorenabled':
                     return self.attributes[axis]["MotorEnabled"]
                 elif name == "statusdriverboard":
-                    ans = self.iPAP.decodeStatus(self.attributes[axis]["status_value"])
+                    ans = self.iPAP.decodeStatus(self._getSnapshot(axis, 'status'))
                     return str(ans)
                 elif name == "statusdetails":
                     ans = self.iPAP.getVStatus(axis)
                     return str(ans)
                 elif name.startswith('status'):
-                    
-                    #We apply getStatusFromBoard to update all status
-                    self.attributes[axis]['status_value'] = self.iPAP.getStatusFromBoard(axis)                    
-                    
-                    #register = self.iPAP.getStatusFromBoard(axis)
-                    register = self.attributes[axis]['status_value']
-                    
-                    if register == None:
-                        register = self.iPAP.getStatusFromBoard(axis)
+                    # served from the last StateAll (or grouped refresh) if
+                    # it is not older than SnapshotMaxAge
+                    register = self._getSnapshot(axis, 'status')
                     status_dict = self.iPAP.decodeStatus(register)
                     status_key = name.replace('status','')
                     if status_key in ['disable','indexer','mode','stopcode']:
@@ -602,10 +574,13 @@ class IcepapController(MotorController):
                 elif name == 'encoder':
                     try:
                         if self.attributes[axis]['encoder_source_tango_attribute'] != None:
-                            VALUE = self.attributes[axis]['encoder_source_tango_attribute'].read().value
+                            # LAST VALUE RECEIVED BY CHANGE EVENTS, IF SUBSCRIBED
+                            VALUE = self.attributes[axis]['encoder_source_value']
+                            if VALUE is None:
+                                VALUE = self.attributes[axis]['encoder_source_tango_attribute'].read().value
                             eval_globals = numpy.__dict__
                             eval_locals = {'VALUE':VALUE, 'value':VALUE}
-                            current_source_pos = eval(self.attributes[axis]['encoder_source_formula'], eval_globals, eval_locals)
+                            current_source_pos = eval(self.attributes[axis]['encoder_source_formula_code'], eval_globals, eval_locals)
                             return float(current_source_pos)
                         else:
                             return float('NaN')
@@ -694,6 +669,7 @@ class IcepapController(MotorController):
                 elif name == 'useencodersource':
                     self.attributes[axis]['use_encoder_source'] = value
                 elif name == 'encodersource':
+                    self._unsubscribeEncoderSource(axis)
                     self.attributes[axis]['encoder_source'] = value
                     self.attributes[axis]['encoder_source_tango_attribute'] = None
                     try:
@@ -713,6 +689,7 @@ class IcepapController(MotorController):
                                         self.attributes[axis]['encoder_source_tango_attribute'] = FakedAttributeProxy(self, other_axis, other_value)
                                 else:
                                     self.attributes[axis]['encoder_source_tango_attribute'] = AttributeProxy(value)
+                                    self._subscribeEncoderSource(axis)
                             except Exception,e:
                                 self._log.error('SetAxisExtraPar(%d,%s).\nException:\n%s' % (axis,name,str(e)))
                                 self.attributes[axis]['use_encoder_source'] = False
@@ -720,7 +697,10 @@ class IcepapController(MotorController):
                         raise e
                     
                 elif name == 'encodersourceformula':
+                    # COMPILE IT ONCE, IT IS EVALUATED ON EVERY READ AND MOVE
+                    code = compile(value, 'EncoderSourceFormula', 'eval')
                     self.attributes[axis]['encoder_source_formula'] = value
+                    self.attributes[axis]['encoder_source_formula_code'] = code
                 elif name == 'frequency':
                     self.iPAP.setSpeed(axis, value)
                 else:
@@ -738,6 +718,7 @@ class IcepapController(MotorController):
 
     def StopOne(self, axis):
         if self.iPAP.connected: 
+            self._invalidateSnapshot(axis)
             self.iPAP.stop(axis)
             time.sleep(0.050) # not sure about that, 
                               # it comes from AbortOne implementation
@@ -767,6 +748,7 @@ class IcepapController(MotorController):
 
     def AbortOne(self, axis):
         if self.iPAP.connected:
+            self._invalidateSnapshot(axis)
             self.iPAP.abort(axis)
             time.sleep(0.050)
         else:
@@ -777,6 +759,7 @@ class IcepapController(MotorController):
     def DefinePosition(self, axis, position):
         if self.iPAP.connected:
             position = long(position * self.attributes[axis]["step_per_unit"])
+            self._invalidateSnapshot(axis)
             self.iPAP.setPosition(axis, position)
         else:
             # To provent huge logs, do not log this error until log levels can be changed in per-controller basis
@@ -815,11 +798,191 @@ class IcepapController(MotorController):
             return 'SendToCtrl(%s). No connection to %s.' % (cmd, self.Host)
 
 
+    def _subscribeEncoderSource(self, axis):
+        """ Subscribe to the change events of the external encoder source
+        so its last value is kept in memory. If the attribute does not push
+        change events, it will be read on demand.
+        @param axis which uses the external encoder source
+        """
+        source = self.attributes[axis]['encoder_source_tango_attribute']
+        cb = EncoderSourceListener(self.attributes[axis], log=self._log)
+        try:
+            self.attributes[axis]['encoder_source_event_id'] = source.subscribe_event(EventType.CHANGE_EVENT, cb)
+        except Exception,e:
+            self._log.warning('Encoder(%d). No change events from encoder source (%s), it will be read on demand.\nException:\n%s' % (axis,self.attributes[axis]['encoder_source'],str(e)))
+            self.attributes[axis]['encoder_source_event_id'] = None
+            self.attributes[axis]['encoder_source_value'] = None
+
+    def _unsubscribeEncoderSource(self, axis):
+        event_id = self.attributes[axis]['encoder_source_event_id']
+        if event_id is not None:
+            try:
+                self.attributes[axis]['encoder_source_tango_attribute'].unsubscribe_event(event_id)
+            except Exception,e:
+                self._log.debug('Encoder(%d). Could not unsubscribe from encoder source: %s' % (axis,str(e)))
+        self.attributes[axis]['encoder_source_event_id'] = None
+        self.attributes[axis]['encoder_source_value'] = None
+
+    #########################################################
+    # SNAPSHOT CACHE OF THE STATUS AND ?POS/?ENC REGISTERS
+    # The keys are 'status', ('pos',REGISTER) or ('enc',REGISTER)
+    #########################################################
+    def _storeSnapshot(self, axis, key, value):
+        self.attributes[axis]['snapshot'][key] = (value, time.time())
+
+    def _invalidateSnapshot(self, axis):
+        self.attributes[axis]['snapshot'] = {}
+
+    def _getSnapshot(self, axis, key, all_registers=False):
+        """ Get a cached value of the axis. If it is missing or older than
+        SnapshotMaxAge, it is refreshed for all the enabled axes with just one
+        command to the Icepap Controller.
+        @param axis to get the value
+        @param key of the value: 'status', ('pos',REGISTER) or ('enc',REGISTER)
+        @param all_registers if a ?POS/?ENC register is refreshed, refresh all
+               of them (for the extra attributes, usually read together)
+        @return the raw value as answered by the Icepap
+        """
+        snapshot = self.attributes[axis]['snapshot']
+        if key not in snapshot or time.time() - snapshot[key][1] > self.SnapshotMaxAge:
+            axes = [a for a in sorted(self.attributes) if self.attributes[a]['MotorEnabled']]
+            if axis not in axes:
+                axes.append(axis)
+            if key != 'status' and all_registers:
+                self._refreshRegisters(axes)
+            else:
+                self._refreshSnapshot(axes, key)
+            snapshot = self.attributes[axis]['snapshot']
+        # missing if the axis was not in the answer or the snapshot has been
+        # invalidated meanwhile
+        value = snapshot.get(key, (None, None))[0]
+        if value is None:
+            raise Exception('%s not available for axis %d' % (str(key), axis))
+        return value
+
+    def _refreshSnapshot(self, axes, key):
+        """ Read a value of several axes with just one command. If the status
+        can not be read for all the axes at once, they are read one by one,
+        as the registers.
+        """
+        if key == 'status':
+            try:
+                ans = self.iPAP.getMultipleStatus(axes)
+            except Exception,e:
+                self._log.debug('_refreshSnapshot(%s) status failed: %s' % (str(axes), str(e)))
+                ans = [(axis, None) for axis in axes]
+                if len(axes) > 1:
+                    # ONE DRIVER NOT PRESENT MUST NOT HIDE THE STATUS OF THE OTHERS
+                    ans = [self._readStatus(axis) for axis in axes]
+            for axis, value in ans:
+                self._storeSnapshot(axis, key, value)
+        else:
+            self._refreshRegister(axes, key)
+
+    def _readStatus(self, axis):
+        """ @return (axis, status) of one axis, the status is None on errors """
+        try:
+            return self.iPAP.getMultipleStatus([axis])[0]
+        except Exception,e:
+            self._log.debug('_readStatus(%d) not available: %s' % (axis, str(e)))
+            return (axis, None)
+
+    def _refreshRegisters(self, axes):
+        """ Read all the ?POS and ?ENC registers of several axes with one
+        multi-axis command per register, so the cost does not depend on the
+        number of axes.
+        @param axes to read the registers
+        """
+        for key_type, registers in (('pos', self.pos_registers),
+                                    ('enc', self.enc_registers)):
+            for register in registers:
+                self._refreshRegister(axes, (key_type, register))
+
+    def _refreshRegister(self, axes, key):
+        """ Read a ?POS or ?ENC register of several axes with one multi-axis
+        command. If it fails (e.g. a driver not present) the axes are read one
+        by one, and the registers not accessible (e.g. SHFTENC or TGTENC in
+        some configurations) are cached as None.
+        @param axes to read the register
+        @param key ('pos',REGISTER) or ('enc',REGISTER)
+        """
+        cmd = '?' + key[0].upper()
+        register = key[1]
+        try:
+            ans = self._sendMultipleQuery(cmd, register, axes)
+        except Exception,e:
+            self._log.debug('_refreshRegister(%s) %s %s failed: %s' % (str(axes), cmd, register, str(e)))
+            ans = [(axis, None) for axis in axes]
+            if len(axes) > 1:
+                # ONE DRIVER NOT PRESENT MUST NOT HIDE THE REGISTER OF THE OTHERS
+                ans = [self._readRegister(cmd, register, axis) for axis in axes]
+        for axis, value in ans:
+            self._storeSnapshot(axis, key, value)
+
+    def _readRegister(self, cmd, register, axis):
+        """ @return (axis, value) of one axis, the value is None on errors """
+        try:
+            return self._sendMultipleQuery(cmd, register, [axis])[0]
+        except Exception,e:
+            self._log.debug('_readRegister(%d) %s %s not available: %s' % (axis, cmd, register, str(e)))
+            return (axis, None)
+
+    def _registerKey(self, name):
+        """ @return the snapshot key of a Pos*/Enc* extra attribute or None """
+        name = name.lower()
+        if name[:3] == 'pos' and name[3:].upper() in self.pos_registers:
+            return ('pos', name[3:].upper())
+        if name[:3] == 'enc' and name[3:].upper() in self.enc_registers:
+            return ('enc', name[3:].upper())
+        return None
+
+    def _readEncoderSource(self, axis, name):
+        """ Read an extra attribute used as encoder source. A ?POS/?ENC
+        register is refreshed alone, since it is read on every position read
+        and before every move.
+        @param axis to read the attribute
+        @param name of the extra attribute
+        """
+        key = self._registerKey(name)
+        if key is None or not self.iPAP.connected:
+            return self.GetAxisExtraPar(axis, name)
+        return float(self._getSnapshot(axis, key))
+
+    def _sendMultipleQuery(self, cmd, register, axes):
+        """ Send a system multi-axis query like '?POS INDEXER 1 2 3'.
+        @return a list of (axis, value) pairs
+        """
+        command = '%s %s %s' % (cmd, register, ' '.join(map(str, axes)))
+        ans = self.iPAP.sendWriteReadCommand(command)
+        values = ans.split()
+        if 'ERROR' in values or len(values) < len(axes):
+            raise Exception('%s answered: %s' % (command, ans))
+        return zip(axes, values[-len(axes):])
+
     def __del__(self):
         if self.iPAP.connected:
             self.iPAP.disconnect()
 
 
+class EncoderSourceListener(object):
+    """ Keep the last value of an external encoder source pushed by change
+    events. On event errors the value is discarded so it is read on demand.
+    """
+
+    def __init__(self, axis_attributes, log=None):
+        self.axis_attributes = axis_attributes
+        self.log = log
+
+    def push_event(self, event):
+        if not event.err:
+            self.axis_attributes['encoder_source_value'] = event.attr_value.value
+        else:
+            self.axis_attributes['encoder_source_value'] = None
+            if self.log:
+                e = event.errors[0]
+                self.log.debug('Encoder source event error (reason: %s; desc: %s)' % (e.reason, e.desc))
+
+
 #########################################################
 # THIS TWO CLASSES ARE NEEDED BECAUSE IT IS NOT POSSIBLE
 # TO ACCESS THE DEVICE FROM A DEVICE CALL
@@ -834,6 +997,6 @@ class FakedAttributeProxy():
         self.axis = axis
         self.attribute = attribute.replace('attr://','')
     def read(self):
-        value = self.ctrl.GetAxisExtraPar(self.axis, self.attribute)
+        value = self.ctrl._readEncoderSource(self.axis, self.attribute)
         return FakedAttribute(value)
 
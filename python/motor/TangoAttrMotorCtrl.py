@@ -9,6 +9,13 @@ from sardana.pool.controller import Type, Access, Description
 import math
 import time
 
+try:
+    # TangoAttrLib is in the countertimer directory, without it in the
+    # PoolPath the formulas are evaluated every time with eval
+    from TangoAttrLib import FormulaEngine
+except ImportError:
+    FormulaEngine = None
+
 TANGO_ATTR = 'TangoAttribute'
 FORMULA_READ = 'FormulaRead'
 FORMULA_WRITE = 'FormulaWrite'
@@ -99,6 +106,10 @@ class TangoAttrMotorController(MotorController):
     def __init__(self, inst, props, *args, **kwargs):
         MotorController.__init__(self, inst, props, *args, **kwargs)
         self.axisAttributes = {}
+        self.formulas = {}
+        if FormulaEngine is not None:
+            self.formulas = {FORMULA_READ: FormulaEngine(globals()),
+                             FORMULA_WRITE: FormulaEngine(globals())}
 
     def AddDevice(self, axis):
         self.axisAttributes[axis] = {}
@@ -113,6 +124,8 @@ class TangoAttrMotorController(MotorController):
 
     def DeleteDevice(self, axis):
         del self.axisAttributes[axis]
+        for formulas in self.formulas.values():
+            formulas.remove(axis)
 
     def StateOne(self, axis):
         try:
@@ -174,8 +187,10 @@ class TangoAttrMotorController(MotorController):
             if self.axisAttributes[axis][TAU_ATTR_ENC] is not None:
                 tau_attr = self.axisAttributes[axis][TAU_ATTR_ENC]
 
-            formula = self.axisAttributes[axis][FORMULA_READ]
             VALUE = tau_attr.read().value
+            if FORMULA_READ in self.formulas:
+                return self.formulas[FORMULA_READ].evaluate(axis, VALUE)
+            formula = self.axisAttributes[axis][FORMULA_READ]
             # just in case 'VALUE' has been written in lowercase in the
             # formula...
             value = VALUE
@@ -194,12 +209,16 @@ class TangoAttrMotorController(MotorController):
     def StartOne(self, axis, pos):
         try:
             tau_attr = self.axisAttributes[axis][TAU_ATTR]
-            formula = self.axisAttributes[axis][FORMULA_WRITE]
-            VALUE = pos
-            # just in case 'VALUE' has been written in lowercase in the
-            # formula...
-            value = VALUE
-            evaluated_value = eval(formula)
+            if FORMULA_WRITE in self.formulas:
+                evaluated_value = self.formulas[FORMULA_WRITE].evaluate(axis,
+                                                                        pos)
+            else:
+                formula = self.axisAttributes[axis][FORMULA_WRITE]
+                VALUE = pos
+                # just in case 'VALUE' has been written in lowercase in the
+                # formula...
+                value = VALUE
+                evaluated_value = eval(formula)
 
             try:
                 self.axisAttributes[axis][MOVE_TO] = pos
@@ -240,6 +259,8 @@ class TangoAttrMotorController(MotorController):
         try:
             self._log.debug(
                 "SetExtraAttributePar [%d] %s = %s" % (axis, name, value))
+            if name in self.formulas:
+                self.formulas[name].set_formula(axis, value)
             self.axisAttributes[axis][name] = value
             if name in [TANGO_ATTR, TANGO_ATTR_ENC]:
                 key = TAU_ATTR
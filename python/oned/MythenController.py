@@ -5,9 +5,9 @@ from sardana.pool.controller import OneDController, Description, Access, \
     Type, Memorize, NotMemorized, MaxDimSize
 from taurus import Device, Attribute
 import PyTango
-import Queue
 import numpy as np
 
+import threading
 import time
 
 DEV_STATE_UNKNOWN = PyTango.DevState.UNKNOWN
@@ -33,33 +33,126 @@ CHN_RAW = 1
 # TODO include the other calculated channel and implement a ctrl for the ROIs.
 # CHN_NORM = 2
 
+# Maximum number of spectra kept by the controller until they are read
+RING_FRAMES = 1024
+
+
+class SpectraRing(object):
+    """
+    Preallocated (frames x channels) array with the spectra received by the
+    events. Each spectrum is copied into the next row and then published
+    advancing the write index; read returns the rows between the read and
+    the write indexes. When the ring is full the oldest spectra are
+    overwritten.
+
+    The array is allocated again for every acquisition, so the rows read are
+    returned as a view of it, unless the acquisition has more spectra than
+    the ring: then they would be overwritten and a copy is returned.
+    """
+
+    def __init__(self, frames=1, log=None):
+        self.log = log
+        self.lock = threading.Lock()
+        self.frames = frames
+        self.spectra = frames
+        self.data = None
+        self.start = 0
+        self.end = 0
+        self.lost = 0
+
+    def reset(self, frames=None, spectra=None):
+        """Discard the spectra, the array is allocated again by the next push.
+        @param frames new number of frames of the ring
+        @param spectra expected in the acquisition (by default the frames)
+        """
+        with self.lock:
+            if frames is not None:
+                self.frames = frames
+                self.spectra = frames if spectra is None else spectra
+            self.data = None
+            self.start = self.end = self.lost = 0
+
+    def push(self, spectrum):
+        spectrum = np.asarray(spectrum)
+        with self.lock:
+            if self.data is None or self.data.shape[1] != len(spectrum):
+                # allocated once the number of channels is known
+                self.data = np.empty((self.frames, len(spectrum)),
+                                     spectrum.dtype)
+                self.start = self.end
+            if self.end - self.start == self.frames:
+                self.start += 1
+                self.lost += 1
+            self.data[self.end % self.frames] = spectrum
+            self.end += 1
+
+    def read(self):
+        """@return the (n x channels) array of new spectra or None"""
+        with self.lock:
+            start, end, lost = self.start, self.end, self.lost
+            self.start = end
+            self.lost = 0
+            data = None
+            if start != end:
+                first = start % self.frames
+                last = first + end - start
+                if last > self.frames:
+                    data = np.concatenate((self.data[first:],
+                                           self.data[:last - self.frames]))
+                elif self.spectra > self.frames:
+                    # the ring wraps around in this acquisition
+                    data = self.data[first:last].copy()
+                else:
+                    data = self.data[first:last]
+        if lost and self.log:
+            self.log.warning('%d spectra were overwritten before being '
+                             'read' % lost)
+        return data
+
+
+class ListenerLiveMode(object):
+    def __init__(self, log=None):
+        self.value = None
+        self.log = log
+
+    def push_event(self, event):
+        if not event.err:
+            self.value = bool(event.attr_value.value)
+        else:
+            # unknown, it is read again when needed
+            self.value = None
+            if self.log:
+                self.log.debug('Listener LiveMode error in event')
+
 
 class ListenerChangeEvent(object):
-    def __init__(self, queue, mythen, log=None):
-        self.queue = queue
+    def __init__(self, ring, mythen, live_mode, log=None):
+        self.ring = ring
         self.mythen = mythen
+        self.live_mode = live_mode
         self.log = log
 
     def push_event(self, event):
         if self.log:
             self.log.debug('Listener DataChangeEvent recevied')
 
-        live_mode = self.mythen.read_attribute('LiveMode').value
+        live_mode = self.live_mode.value
+        if live_mode is None:
+            live_mode = self.mythen.read_attribute('LiveMode').value
+            self.live_mode.value = live_mode
         if live_mode:
             self.log.debug('Listener DataChangeEvent acquisition is not '
                            'running.')
             return
 
         if not event.err:
-            new_data = event.attr_value.value
-            # There are problem with the numpy array when we extract it from
-            # the queue it has another values.
-            self.queue.put(new_data.tolist())
+            # The event value is not kept, it is copied into the ring
+            self.ring.push(event.attr_value.value)
             self.log.debug('New data')
 
         else:
             self.log.debug('Listener DataReadyEvent error in event')
-            raise 'Error with the event.'
+            raise Exception('Error with the event.')
 
 
 class MythenController(OneDController):
@@ -171,10 +264,21 @@ class MythenController(OneDController):
     def __init__(self, inst, props, *args, **kwargs):
         OneDController.__init__(self,inst, props, *args, **kwargs)
         self.mythen = Device(self.MythenDCS)
-        self.raw_queue = Queue.Queue()
+        self.raw_ring = SpectraRing(log=self._log)
         self.ext_trigger = False
-        
-        self.raw_listener = ListenerChangeEvent(self.raw_queue, self.mythen,
+
+        self.live_mode_listener = ListenerLiveMode(self._log)
+        try:
+            self.mythen.subscribe_event('LiveMode', CHANGE_EVENT,
+                                        self.live_mode_listener)
+            self.live_mode_events = True
+        except Exception, e:
+            # it is read in LoadOne and cached until the next one
+            self._log.debug('LiveMode will not be tracked by events: %s' % e)
+            self.live_mode_events = False
+
+        self.raw_listener = ListenerChangeEvent(self.raw_ring, self.mythen,
+                                                self.live_mode_listener,
                                                 self._log)
         self.listener_id = self.mythen.subscribe_event('RawData',
                                                        CHANGE_EVENT,
@@ -223,24 +327,20 @@ class MythenController(OneDController):
     def ReadOne(self, axis):
         # Read the raw data from the detector
         # TODO implement the calculation of the mean with more frames.
-        data = []
+        data = self.raw_ring.read()
         result = []
-        while not self.raw_queue.empty():
-            data.append(self.raw_queue.get(timeout=1))
-        new_data = len(data)
-        
-        if self._synchronization in SOFTWARE and new_data:
+
+        if self._synchronization in SOFTWARE and data is not None:
             result = data[0]
-        elif self._synchronization in HARDWARE and new_data:
+        elif self._synchronization in HARDWARE and data is not None:
             result = data
-        
+
         return result
 
     @debug
     def StartOne(self, axis, value):
         if axis == CHN_RAW:
-            with self.raw_queue.mutex:
-                self.raw_queue.queue.clear()
+            self.raw_ring.reset()
 
             self.mythen.start()
 
@@ -248,7 +348,9 @@ class MythenController(OneDController):
     @debug
     def LoadOne(self, axis, value, repetitions):
         self.state = self.mythen.state()
-        live_mode = self.mythen.read_attribute('LiveMode').value
+        live_mode = self.live_mode_listener.value
+        if live_mode is None or not self.live_mode_events:
+            live_mode = self.mythen.read_attribute('LiveMode').value
         if self.state == State.Running:
             self.mythen.stop()
 
@@ -256,8 +358,9 @@ class MythenController(OneDController):
             self._log.warning('The live move is active!!!. We will turn off '
                               'it.')
             self.mythen.write_attribute('LiveMode', False)
+        self.live_mode_listener.value = False
 
-        self.repetitions = repetitions    
+        self.repetitions = repetitions
 
         self.mythen.write_attribute('IntTime', value)
         if self._synchronization in SOFTWARE:
@@ -275,6 +378,7 @@ class MythenController(OneDController):
             raise Exception("Mythen allows only Software or Hardware "
                             "triggering")
 
+        self.raw_ring.reset(min(repetitions, RING_FRAMES), repetitions)
         self.mythen.write_attribute('Frames', repetitions)
         self.mythen.write_attribute('TriggerMode', self.ext_trigger)
         self.mythen.write_attribute('ContinuousTrigger', self.ext_trigger)
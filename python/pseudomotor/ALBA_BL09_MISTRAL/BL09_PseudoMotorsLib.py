@@ -1,4 +1,5 @@
 import math
+import numpy
 import PyTango
  
 from sardana import pool
@@ -8,6 +9,88 @@ from sardana.pool.controller import PseudoMotorController
 from sardana.pool.controller import MemorizedNoInit, NotMemorized, Memorized
 
 
+def energy2physical(energy, Cff, hc, order, line_density, offsetG, offsetM):
+    """Array version of the energy (already corrected with the energy offset)
+    to m3 and gr pitch (mrad) conversion of the Energy controllers.
+    @return (m, g) arrays, nan where there is no solution
+    """
+    energy = numpy.asarray(energy, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        waveLen = numpy.where(energy == 0.0, 0.0, hc / energy)
+        f1 = Cff**2 + 1
+        f2 = 1 - Cff**2
+        K = order * waveLen * line_density
+        CosAlpha = numpy.sqrt(-1*K**2 * f1 + 2*numpy.fabs(K) * numpy.sqrt(f2**2 + Cff**2 * K**2))/numpy.fabs(f2)
+        alpha = numpy.arccos(CosAlpha)
+        beta = -numpy.arccos(Cff * CosAlpha)
+        theta = (alpha - beta) * 0.5
+    m = ((math.pi/2.0) - theta - offsetM)*1000
+    g = (beta + (math.pi/2.0) + offsetG)*1000
+    return m, g
+
+
+def physical2energy(m, g, hc, order, line_density, offsetG, offsetM):
+    """Array version of the m3 and gr pitch (mrad) to energy (before the
+    energy offset correction) conversion of the Energy controllers.
+    @return (energy, Cff) arrays
+    """
+    m = numpy.asarray(m, dtype=float)
+    g = numpy.asarray(g, dtype=float)
+    beta = (g/1000) - (math.pi/2.0) - offsetG
+    theta = (math.pi/2.0) - (m/1000) - offsetM
+    alpha = (2.0*theta) + beta
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        wavelength = (numpy.sin(alpha) + numpy.sin(beta)) / (order * line_density)
+        energy = numpy.where(wavelength == 0.0, 0.0, hc / wavelength)
+        Cff = numpy.cos(beta)/numpy.cos(alpha)
+    return energy, Cff
+
+
+class CachedAttribute(object):
+    """
+    Utility class keeping the value of an attribute of a device proxy, updated
+    by its change events. If the events are not available (or the last one
+    was an error) the attribute is read from the device.
+    """
+
+    def __init__(self, proxy, name, log=None):
+        self.proxy = proxy
+        self.name = name
+        self.log = log
+        self.value = None
+        self.event_id = None
+        try:
+            self.event_id = proxy.subscribe_event(
+                                name, PyTango.EventType.CHANGE_EVENT,
+                                self.push_event)
+        except Exception, e:
+            if self.log:
+                self.log.debug('Unable to subscribe to %s changes, it will '
+                               'be read every time: %s' % (name, e))
+
+    def push_event(self, event):
+        if event.err or event.attr_value is None:
+            self.value = None
+        else:
+            self.value = event.attr_value.value
+
+    def get(self):
+        value = self.value
+        if value is None:
+            value = self.proxy.read_attribute(self.name).value
+        return value
+
+    def unsubscribe(self):
+        if self.event_id is None:
+            return
+        try:
+            self.proxy.unsubscribe_event(self.event_id)
+        except Exception:
+            pass
+        self.event_id = None
+        self.value = None
+
+
 class EnergyCff(PseudoMotorController):
     """Energy pseudomotor controller. Used for scans with Cff fixed"""
 
@@ -102,6 +185,10 @@ class EnergyCff(PseudoMotorController):
 
         self.iorDP = PyTango.DeviceProxy(self.gr_ior)
         self.iorDP2 = PyTango.DeviceProxy(self.m3_ior)
+        # grating and mirror selected, updated with the ioregister change
+        # events so the calculations do not read them every time
+        self.grx = CachedAttribute(self.iorDP, 'Value', self._log)
+        self.m3x = CachedAttribute(self.iorDP2, 'Value', self._log)
 
         self.a_offset_coeff = 0.05785
         self.b_offset_coeff = -10.6294
@@ -115,6 +202,10 @@ class EnergyCff(PseudoMotorController):
         #self.a = 0.05785
         #self.b = -10.6294 
 
+    def __del__(self):
+        for attribute in (self.grx, self.m3x):
+            attribute.unsubscribe()
+
     def calc_physical(self, index, pseudos):
         return self.calc_all_physical(pseudos)[index - 1]
 
@@ -137,7 +228,8 @@ class EnergyCff(PseudoMotorController):
         
         f1 = Cff**2 + 1
         f2 = 1 - Cff**2
-        K = self.DiffrOrder * waveLen * self.look_at_grx()
+        line_density, offsetG, offsetM = self.get_grating()
+        K = self.DiffrOrder * waveLen * line_density
         
         CosAlpha = math.sqrt(-1*K**2 * f1 + 2*math.fabs(K) * math.sqrt(f2**2 + Cff**2 * K**2))/math.fabs(f2)
 
@@ -149,7 +241,6 @@ class EnergyCff(PseudoMotorController):
         theta = (alpha - beta) * 0.5
         self.theta = theta
 
-        offsetG,offsetM = self.checkOffset()
         m = ((math.pi/2.0) - theta - offsetM)*1000 #angle*1000 to have it in mrad
         g = (beta + (math.pi/2.0) + offsetG)*1000
         #self._log.debug('!!!!!!!!calc_all_physical(): returning (%f, %f)' % (m,g))
@@ -160,7 +251,7 @@ class EnergyCff(PseudoMotorController):
 
         #print("-----CTGENSOFT---MOTORSMONO: %f, %f" % (physical_pos[0], physical_pos[1]))
         #self._log.debug('!!!!!!!!calc_all_pseudo(%s): entering...' % repr(physical_pos))
-        offsetG,offsetM = self.checkOffset()
+        line_density, offsetG, offsetM = self.get_grating()
         #print("-----CTGENSOFT---OFFSETGMENERGY: %f, %f" % (offsetG, offsetM))
 
         beta = (physical_pos[1]/1000) - (math.pi/2.0) - offsetG
@@ -169,7 +260,7 @@ class EnergyCff(PseudoMotorController):
         self.theta = theta
         alpha = (2.0*theta) + beta
         self.alpha = alpha
-        wavelength = (math.sin(alpha) + math.sin(beta)) / (self.DiffrOrder * self.look_at_grx())
+        wavelength = (math.sin(alpha) + math.sin(beta)) / (self.DiffrOrder * line_density)
         
         if wavelength == 0.0:
             energy_physicalmot = 0.0
@@ -189,6 +280,29 @@ class EnergyCff(PseudoMotorController):
         #print("--CTGENSOFT---MOTORSMONO: %f, %f, %f, %f, %f, %f, %f, %f:" %(energy, Cff, wavelength, alpha, beta, theta, offsetG, offsetM))
         return (energy,Cff)
 
+    def calc_all_physical_array(self, pseudo_pos):
+        """Array version of calc_all_physical: from the (N, 2) energy and Cff
+        positions, the (N, 2) m3 and gr positions (nan where there is no
+        solution). The grating and the offsets are read once for all of
+        them."""
+        pseudo_pos = numpy.asarray(pseudo_pos, dtype=float)
+        energy = pseudo_pos[:, 0] + self.a_offset_coeff*pseudo_pos[:, 0] + self.b_offset_coeff
+        line_density, offsetG, offsetM = self.get_grating()
+        m, g = energy2physical(energy, pseudo_pos[:, 1], self.hc,
+                               self.DiffrOrder, line_density, offsetG, offsetM)
+        return numpy.column_stack((m, g))
+
+    def calc_all_pseudo_array(self, physical_pos):
+        """Array version of calc_all_pseudo: from the (N, 2) m3 and gr
+        positions, the (N, 2) energy and Cff positions."""
+        physical_pos = numpy.asarray(physical_pos, dtype=float)
+        line_density, offsetG, offsetM = self.get_grating()
+        energy, Cff = physical2energy(physical_pos[:, 0], physical_pos[:, 1],
+                                      self.hc, self.DiffrOrder, line_density,
+                                      offsetG, offsetM)
+        energy = (numpy.fabs(energy) - self.b_offset_coeff) / (1 + self.a_offset_coeff)
+        return numpy.column_stack((energy, Cff))
+
     def GetExtraAttributePar(self, axis, name):
         
         if name.lower() == "diffrorder":
@@ -256,21 +370,26 @@ class EnergyCff(PseudoMotorController):
             
         return 600.0 * 1E-7
 
+    def get_grating(self):
+        """Line density and offsets of the grating and mirror selected, once
+        per calculation (or once for a whole trajectory)."""
+        offsetG,offsetM = self.checkOffset()
+        return self.look_at_grx(), offsetG, offsetM
+
     def checkOffset(self):
         offsetGrating,offsetMirror = 0.0,0.0
-        print("out")
-        if self.iorDP['Value'].value == 0:
+        grx = self.grx.get()
+        if grx == 0:
             offsetGrating = self.offsetGrxLE/1000.0
-            print("if iorDP==0 %f:"% offsetGrating)
-        elif self.iorDP['Value'].value == 2:
+        elif grx == 2:
             offsetGrating = self.offsetGrxHE/1000.0
-            print("if iorDP==2 %f:"% offsetGrating)
-        if self.iorDP2['Value'].value == 0:
+        m3x = self.m3x.get()
+        if m3x == 0:
             offsetMirror = self.offsetMxLE/1000.0
-            print("if iorDP2==0 %f:"% offsetMirror)
-        elif self.iorDP2['Value'].value == 2:
+        elif m3x == 2:
             offsetMirror = self.offsetMxHE/1000.0
-            print("if iorDP2==2 %f:"% offsetMirror)
+        self._log.debug('checkOffset: grx %s m3x %s (%f, %f)' %
+                        (grx, m3x, offsetGrating, offsetMirror))
 
         return offsetGrating, offsetMirror
 
@@ -363,6 +482,14 @@ class MZ_Pseudos(PseudoMotorController):
     
     return (mzc, mzl, mzr)
 
+  def calc_all_physical_array(self, pseudos):
+    """(N, 3) z, pitch/yaw, roll positions to (N, 3) mzc, mzl, mzr"""
+    pseudos = numpy.asarray(pseudos, dtype=float)
+    z_m = pseudos[:, 0] / 1000.0
+    pit = numpy.tan(pseudos[:, 1] / 1000.0) * self.DIM_Y / 1000.0 / 2
+    rol = numpy.tan(pseudos[:, 2] / 1000.0) * self.DIM_X / 1000.0 / 2
+    return numpy.column_stack((z_m + pit, z_m - pit + rol, z_m - pit - rol)) * 1000
+
   def calc_all_pseudo(self, physicals):
     mzc, mzl, mzr = physicals
 
@@ -383,6 +510,15 @@ class MZ_Pseudos(PseudoMotorController):
 
     return (z, pit, rol)
 
+  def calc_all_pseudo_array(self, physicals):
+    """(N, 3) mzc, mzl, mzr positions to (N, 3) z, pitch/yaw, roll"""
+    physicals = numpy.asarray(physicals, dtype=float) / 1000.0
+    mzc_m, mzl_m, mzr_m = physicals[:, 0], physicals[:, 1], physicals[:, 2]
+    pit_rad = numpy.arctan2((mzc_m - (mzr_m + mzl_m) / 2), self.DIM_Y / 1000.0)
+    rol_rad = numpy.arctan2((mzl_m - mzr_m), self.DIM_X / 1000.0)
+    z_m = mzc_m / 2 + (mzl_m + mzr_m) / 4
+    return numpy.column_stack((z_m, pit_rad, rol_rad)) * 1000
+
 class M1_Z_Pitch_Roll(MZ_Pseudos):
   """ The PseudoMotor controller for the MISTRAL's M1 table: Z, Pitch, Roll.
       User units must be: mm for distances and mrad for angles.
@@ -518,6 +654,13 @@ class MX_Pseudos(PseudoMotorController):
 
     return (mx1, mx2)
 
+  def calc_all_physical_array(self, pseudos):
+    """(N, 2) x, yaw/pitch positions to (N, 2) mx1, mx2"""
+    pseudos = numpy.asarray(pseudos, dtype=float)
+    x_m = pseudos[:, 0] / 1000.0
+    yaw = numpy.tan(pseudos[:, 1] / 1000.0) * self.DIM_Y / 1000.0 / 2
+    return numpy.column_stack((x_m - yaw, x_m + yaw)) * 1000
+
   def calc_all_pseudo(self, physicals):
     mx1, mx2 = physicals
 
@@ -533,6 +676,14 @@ class MX_Pseudos(PseudoMotorController):
     yaw = yaw_rad * 1000
 
     return (x, yaw)
+
+  def calc_all_pseudo_array(self, physicals):
+    """(N, 2) mx1, mx2 positions to (N, 2) x, yaw/pitch"""
+    physicals = numpy.asarray(physicals, dtype=float) / 1000.0
+    mx1_m, mx2_m = physicals[:, 0], physicals[:, 1]
+    x_m = (mx1_m + mx2_m) / 2
+    yaw_rad = numpy.arctan2((mx2_m - mx1_m), self.DIM_Y / 1000.0)
+    return numpy.column_stack((x_m, yaw_rad)) * 1000
   
 class M1_X_and_Yaw(MX_Pseudos): 
   """
@@ -712,7 +863,19 @@ class EnergyCffFixed(PseudoMotorController):
         self.offsetGrxHE = 0.0
         self.offsetMxHE = 0.0
 
+        self.grx = CachedAttribute(self.iorDP, 'Value', self._log)
+        self.m3x = CachedAttribute(self.iorDP2, 'Value', self._log)
+
         self.EnergyDP = PyTango.DeviceProxy('pm/energycff_ctrl/1')
+        self.a_offset_coeff = CachedAttribute(self.EnergyDP,
+                                              'a_offset_coeff', self._log)
+        self.b_offset_coeff = CachedAttribute(self.EnergyDP,
+                                              'b_offset_coeff', self._log)
+
+    def __del__(self):
+        for attribute in (self.grx, self.m3x, self.a_offset_coeff,
+                          self.b_offset_coeff):
+            attribute.unsubscribe()
     
     def calc_physical(self, index, pseudos):
         return self.calc_all_physical(pseudos)[index - 1]
@@ -724,8 +887,7 @@ class EnergyCffFixed(PseudoMotorController):
         """From a given energy, we calculate the physical
          position for the real motors."""
 
-        a_coeff = self.EnergyDP.a_offset_coeff
-        b_coeff = self.EnergyDP.b_offset_coeff
+        a_coeff, b_coeff = self.get_offset_coeffs()
         offsetE = a_coeff*pseudo_pos[0] + b_coeff
         energy = pseudo_pos[0] + offsetE
 
@@ -750,6 +912,7 @@ class EnergyCffFixed(PseudoMotorController):
         """From the real motor positions, we calculate the pseudomotors positions."""
 
         offsetG,offsetM = self.checkOffset()
+        a_coeff, b_coeff = self.get_offset_coeffs()
         beta = (physical_pos[1]/1000) - (math.pi/2.0) - offsetG
         theta = (math.pi/2.0) - (physical_pos[0]/1000) - offsetM
         alpha = (2.0*theta) + beta
@@ -760,8 +923,6 @@ class EnergyCffFixed(PseudoMotorController):
         else:
             energy_physicalmot = self.hc / wavelength
 
-        a_coeff = self.EnergyDP.a_offset_coeff
-        b_coeff = self.EnergyDP.b_offset_coeff
         # Real Energy is equal to the energy calculated by the motors
         # minus an offset that depends on the same energy calculated by the 
         # motors.
@@ -771,6 +932,41 @@ class EnergyCffFixed(PseudoMotorController):
 
         return energy
 
+    def calc_all_physical_array(self, pseudo_pos):
+        """Array version of calc_all_physical: from the (N, 1) energy
+        positions, the (N, 2) m3 and gr positions (nan where there is no
+        solution). The offsets are read once for all of them."""
+        pseudo_pos = numpy.asarray(pseudo_pos, dtype=float)
+        a_coeff, b_coeff = self.get_offset_coeffs()
+        energy = pseudo_pos[:, 0] + a_coeff*pseudo_pos[:, 0] + b_coeff
+        offsetG,offsetM = self.checkOffset()
+        m, g = energy2physical(energy, self.Cff, self.hc, self.DiffrOrder,
+                               self.lineDensity, offsetG, offsetM)
+        return numpy.column_stack((m, g))
+
+    def calc_all_pseudo_array(self, physical_pos):
+        """Array version of calc_all_pseudo: from the (N, 2) m3 and gr
+        positions, the (N, 1) energy positions."""
+        physical_pos = numpy.asarray(physical_pos, dtype=float)
+        offsetG,offsetM = self.checkOffset()
+        a_coeff, b_coeff = self.get_offset_coeffs()
+        energy, _ = physical2energy(physical_pos[:, 0], physical_pos[:, 1],
+                                    self.hc, self.DiffrOrder, self.lineDensity,
+                                    offsetG, offsetM)
+        energy = (energy - b_coeff) / (1 + a_coeff)
+        return energy.reshape(-1, 1)
+
+    def get_offset_coeffs(self):
+        """The energy offset coefficients of the EnergyCff controller, read
+        in one call if they are not updated by events."""
+        a_coeff = self.a_offset_coeff.value
+        b_coeff = self.b_offset_coeff.value
+        if a_coeff is None or b_coeff is None:
+            values = self.EnergyDP.read_attributes(['a_offset_coeff',
+                                                    'b_offset_coeff'])
+            a_coeff, b_coeff = values[0].value, values[1].value
+        return a_coeff, b_coeff
+
     def GetExtraAttributePar(self, axis, name):
         
         if name.lower() == "cff":
@@ -812,14 +1008,16 @@ class EnergyCffFixed(PseudoMotorController):
 
     def checkOffset(self):
         offsetGrating,offsetMirror = 0.0,0.0
-        if self.iorDP['Value'].value == 0:
+        grx = self.grx.get()
+        if grx == 0:
             offsetGrating = self.offsetGrxLE/1000.0
-        elif self.iorDP['Value'].value == 2:
+        elif grx == 2:
             offsetGrating = self.offsetGrxHE/1000.0
         
-        if self.iorDP2['Value'].value == 0:
+        m3x = self.m3x.get()
+        if m3x == 0:
             offsetMirror = self.offsetMxLE/1000.0
-        elif self.iorDP2['Value'].value == 2:
+        elif m3x == 2:
             offsetMirror = self.offsetMxHE/1000.0
 
         return offsetGrating, offsetMirror
@@ -0,0 +1,108 @@
+import unittest
+
+import numpy
+
+import BL09_PseudoMotorsLib as lib
+
+
+class FakeEvent(object):
+
+    class AttrValue(object):
+        def __init__(self, value):
+            self.value = value
+
+    def __init__(self, value):
+        self.err = False
+        self.attr_value = self.AttrValue(value)
+
+
+class FakeProxy(object):
+    """Device proxy pushing a change event when subscribed and on every
+    change, as the ioregisters do. Counts the reads."""
+
+    values = {'gr_ior': {'Value': 0},
+              'm3_ior': {'Value': 0},
+              'pm/energycff_ctrl/1': {'a_offset_coeff': 0.05785,
+                                      'b_offset_coeff': -10.6294}}
+
+    def __init__(self, name):
+        self.values = dict(self.values[name])
+        self.callbacks = {}
+        self.reads = 0
+
+    def subscribe_event(self, name, event_type, cb):
+        self.callbacks[name] = cb
+        cb(FakeEvent(self.values[name]))
+        return len(self.callbacks)
+
+    def unsubscribe_event(self, event_id):
+        pass
+
+    def read_attribute(self, name):
+        self.reads += 1
+        return FakeEvent.AttrValue(self.values[name])
+
+    def read_attributes(self, names):
+        return [self.read_attribute(name) for name in names]
+
+    def change(self, name, value):
+        self.values[name] = value
+        self.callbacks[name](FakeEvent(value))
+
+
+ENERGY_PROPS = {'hc': 12398.41856, 'offsetG': 0.0, 'offsetM': 0.0,
+                'gr_ior': 'gr_ior', 'm3_ior': 'm3_ior'}
+
+
+class ArrayTestCase(unittest.TestCase):
+    """The array calculations give the same positions as the scalar ones"""
+
+    def setUp(self):
+        self.DeviceProxy = lib.PyTango.DeviceProxy
+        lib.PyTango.DeviceProxy = FakeProxy
+
+    def tearDown(self):
+        lib.PyTango.DeviceProxy = self.DeviceProxy
+
+    def assertArrayEqual(self, ctrl, pseudos):
+        physicals = ctrl.calc_all_physical_array(pseudos)
+        for pseudo, physical in zip(pseudos, physicals):
+            numpy.testing.assert_allclose(ctrl.calc_all_physical(pseudo),
+                                          physical)
+        for physical, pseudo in zip(physicals,
+                                    ctrl.calc_all_pseudo_array(physicals)):
+            numpy.testing.assert_allclose(ctrl.calc_all_pseudo(physical),
+                                          pseudo)
+
+    def test_tables(self):
+        ctrl = lib.M1_Z_Pitch_Roll('test', {'DIM_X': 220.0, 'DIM_Y': 1145.0})
+        self.assertArrayEqual(ctrl, [(0.0, 0.0, 0.0), (1.5, -2.0, 0.3),
+                                     (-4.0, 1.0, -0.8)])
+        ctrl = lib.M1_X_and_Yaw('test', {'DIM_Y': 1145.0})
+        self.assertArrayEqual(ctrl, [(0.0, 0.0), (1.5, -2.0), (-4.0, 1.0)])
+
+    def test_energy(self):
+        ctrl = lib.EnergyCff('test', dict(ENERGY_PROPS))
+        pseudos = [(energy, 2.25) for energy in numpy.linspace(300, 1200, 5)]
+        self.assertArrayEqual(ctrl, pseudos)
+
+    def test_energy_cff_fixed(self):
+        ctrl = lib.EnergyCffFixed('test', dict(ENERGY_PROPS))
+        pseudos = numpy.linspace(300, 1200, 5).reshape(-1, 1)
+        self.assertArrayEqual(ctrl, pseudos)
+        # the offsets are taken from the events
+        self.assertEqual(ctrl.EnergyDP.reads, 0)
+
+    def test_grating_change(self):
+        ctrl = lib.EnergyCff('test', dict(ENERGY_PROPS))
+        ctrl.SetExtraAttributePar(1, 'offsetGrxHE', 1.0)
+        pseudos = [(500.0, 2.25)]
+        low = ctrl.calc_all_physical_array(pseudos)
+        ctrl.iorDP.change('Value', 2)
+        high = ctrl.calc_all_physical_array(pseudos)
+        self.assertAlmostEqual(high[0, 1] - low[0, 1], 1.0)
+        self.assertEqual(ctrl.iorDP.reads, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
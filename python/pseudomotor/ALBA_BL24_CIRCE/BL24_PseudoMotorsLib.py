@@ -4,8 +4,100 @@ from sardana.pool.controller import PseudoMotorController
 from sardana.pool.controller import MemorizedNoInit, NotMemorized, Memorized
 
 import math
+import numpy
 import PyTango
 
+
+def energy2physical(energy, Cff, hc, order, line_density, offsetG, offsetM,
+                    theta=None):
+    """Array version of the energy to m2 and gr pitch (mrad) conversion of
+    the Energy controllers. If theta (the m2 pitch in rad) is given, it is
+    kept fixed (FixedM2Pit) and Cff is not used.
+    @return (m, g) arrays, nan where there is no solution
+    """
+    energy = numpy.asarray(energy, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        waveLen = numpy.where(energy == 0.0, 0.0, hc / energy)
+        if theta is None:
+            f1 = Cff**2 + 1
+            f2 = 1 - Cff**2
+            K = order * waveLen * line_density
+            CosAlpha = numpy.sqrt(-1*K**2 * f1 + 2*numpy.fabs(K) * numpy.sqrt(f2**2 + Cff**2 * K**2))/numpy.fabs(f2)
+            alpha = numpy.arccos(CosAlpha)
+            beta = -numpy.arccos(Cff * CosAlpha)
+            theta = (alpha - beta) * 0.5
+        else:
+            mkl = order * line_density * waveLen
+            A1 = (mkl/2.0) * math.tan(theta)
+            A2 = numpy.sqrt(((math.cos(theta))**2) - ((mkl/2.0)**2))
+            beta = -numpy.arccos(A2 - A1)
+    m = ((math.pi/2.0) - theta + offsetM)*1000
+    g = (beta + (math.pi/2.0) + offsetG)*1000
+    return numpy.broadcast_arrays(m, g)
+
+
+def physical2energy(m, g, hc, order, line_density, offsetG, offsetM):
+    """Array version of the m2 and gr pitch (mrad) to energy conversion of the
+    Energy controllers.
+    @return (energy, Cff) arrays
+    """
+    m = numpy.asarray(m, dtype=float)
+    g = numpy.asarray(g, dtype=float)
+    beta = (g/1000) - (math.pi/2.0) - offsetG
+    theta = (math.pi/2.0) - (m/1000) + offsetM
+    alpha = (2.0*theta) + beta
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        wavelength = (numpy.sin(alpha) + numpy.sin(beta)) / (order * line_density)
+        energy = numpy.fabs(numpy.where(wavelength == 0.0, 0.0, hc / wavelength))
+        Cff = numpy.cos(beta)/numpy.cos(alpha)
+    return energy, Cff
+
+
+class CachedAttribute(object):
+    """
+    Utility class keeping the value of an attribute of a device proxy, updated
+    by its change events. If the events are not available (or the last one
+    was an error) the attribute is read from the device.
+    """
+
+    def __init__(self, proxy, name, log=None):
+        self.proxy = proxy
+        self.name = name
+        self.log = log
+        self.value = None
+        self.event_id = None
+        try:
+            self.event_id = proxy.subscribe_event(
+                                name, PyTango.EventType.CHANGE_EVENT,
+                                self.push_event)
+        except Exception, e:
+            if self.log:
+                self.log.debug('Unable to subscribe to %s changes, it will '
+                               'be read every time: %s' % (name, e))
+
+    def push_event(self, event):
+        if event.err or event.attr_value is None:
+            self.value = None
+        else:
+            self.value = event.attr_value.value
+
+    def get(self):
+        value = self.value
+        if value is None:
+            value = self.proxy.read_attribute(self.name).value
+        return value
+
+    def unsubscribe(self):
+        if self.event_id is None:
+            return
+        try:
+            self.proxy.unsubscribe_event(self.event_id)
+        except Exception:
+            pass
+        self.event_id = None
+        self.value = None
+
+
 class EnergyCffFixed(PseudoMotorController):
     """Energy pseudomotor controller. Used for scans with Cff fixed"""
 
@@ -80,6 +172,9 @@ class EnergyCffFixed(PseudoMotorController):
         PseudoMotorController.__init__(self,inst,props)
 
         self.ior = PyTango.DeviceProxy(self.iorGrx)
+        # grating selected, updated with the ioregister change events so the
+        # calculations do not read it every time
+        self.grx = CachedAttribute(self.ior, 'Value', self._log)
 
         self.Cff = 0.0
         self.DiffrOrder = 1.0
@@ -92,6 +187,9 @@ class EnergyCffFixed(PseudoMotorController):
         self.offsetGrME = 0.0
         self.offsetMME = 0.0
 
+    def __del__(self):
+        self.grx.unsubscribe()
+
     def calc_physical(self, index, pseudos):
         return self.calc_all_physical(pseudos)[index - 1]
 
@@ -111,14 +209,14 @@ class EnergyCffFixed(PseudoMotorController):
         else:
             waveLen = self.hc / energy
         
-        offsetG,offsetM = self.checkOffset()
+        line_density, offsetG, offsetM = self.get_grating()
 
         if not self.FixedM2Pit:
             #f1 = self.Cff**2 + 1
             #f2 = 1 - self.Cff**2
             f1 = Cff**2 + 1
             f2 = 1 - Cff**2
-            K = self.DiffrOrder * waveLen * self.look_at_grx()
+            K = self.DiffrOrder * waveLen * line_density
         
             #CosAlpha = math.sqrt(-1*K**2 * f1 + 2*math.fabs(K) * math.sqrt(f2**2 + self.Cff**2 * K**2))/math.fabs(f2)
             CosAlpha = math.sqrt(-1*K**2 * f1 + 2*math.fabs(K) * math.sqrt(f2**2 + Cff**2 * K**2))/math.fabs(f2)
@@ -133,10 +231,10 @@ class EnergyCffFixed(PseudoMotorController):
             g = (self.beta + (math.pi/2.0) + offsetG)*1000
             #txt = "%.2f %.5f %.6f %.6f" %(energy, self.Cff, m, g)
             txt = "%.2f %.5f %.6f %.6f" %(energy, Cff, m, g)
-            print txt 
+            self._log.debug(txt)
             return (m,g)
         else:
-            mkl = self.DiffrOrder * self.look_at_grx() * waveLen
+            mkl = self.DiffrOrder * line_density * waveLen
             A1 = (mkl/2.0) * math.tan(self.theta)
             A2 = math.sqrt(((math.cos(self.theta))**2) - ((mkl/2.0)**2))
             
@@ -150,11 +248,11 @@ class EnergyCffFixed(PseudoMotorController):
     def calc_all_pseudo(self, physical_pos, param=None):
         """From the real motor positions, we calculate the pseudomotors positions."""
 
-        offsetG,offsetM = self.checkOffset()
+        line_density, offsetG, offsetM = self.get_grating()
         self.beta = (physical_pos[1]/1000) - (math.pi/2.0) - offsetG
         self.theta = (math.pi/2.0) - (physical_pos[0]/1000) + offsetM
         self.alpha = (2.0*self.theta) + self.beta
-        wavelength = (math.sin(self.alpha) + math.sin(self.beta)) / (self.DiffrOrder * self.look_at_grx())
+        wavelength = (math.sin(self.alpha) + math.sin(self.beta)) / (self.DiffrOrder * line_density)
         
         if wavelength == 0.0:
             energy = 0.0
@@ -165,6 +263,28 @@ class EnergyCffFixed(PseudoMotorController):
         if energy < 0 : energy = energy *(-1) #warning: wavelength se vuelve negativo ... ??????
         return (energy,self.Cff)
 
+    def calc_all_physical_array(self, pseudo_pos):
+        """Array version of calc_all_physical: from the (N, 2) energy and Cff
+        positions, the (N, 2) m2 and gr positions (nan where there is no
+        solution). The grating is read once for all of them."""
+        pseudo_pos = numpy.asarray(pseudo_pos, dtype=float)
+        line_density, offsetG, offsetM = self.get_grating()
+        theta = self.theta if self.FixedM2Pit else None
+        m, g = energy2physical(pseudo_pos[:, 0], pseudo_pos[:, 1], self.hc,
+                               self.DiffrOrder, line_density, offsetG,
+                               offsetM, theta)
+        return numpy.column_stack((m, g))
+
+    def calc_all_pseudo_array(self, physical_pos):
+        """Array version of calc_all_pseudo: from the (N, 2) m2 and gr
+        positions, the (N, 2) energy and Cff positions."""
+        physical_pos = numpy.asarray(physical_pos, dtype=float)
+        line_density, offsetG, offsetM = self.get_grating()
+        energy, Cff = physical2energy(physical_pos[:, 0], physical_pos[:, 1],
+                                      self.hc, self.DiffrOrder, line_density,
+                                      offsetG, offsetM)
+        return numpy.column_stack((energy, Cff))
+
     def GetExtraAttributePar(self, axis, name):
         
         if name.lower() == "diffrorder":
@@ -222,9 +342,10 @@ class EnergyCffFixed(PseudoMotorController):
         if name.lower() == "offsetmhe":
             self.offsetMHE = value
 
-    def look_at_grx(self):
+    def look_at_grx(self, iorPos=None):
             
-        iorPos = self.ior['Value'].value
+        if iorPos is None:
+            iorPos = self.grx.get()
         
         energyRange = 0
 
@@ -250,23 +371,34 @@ class EnergyCffFixed(PseudoMotorController):
         else:
             return 0.0
 
-    def checkOffset(self):
+    def checkOffset(self, iorPos=None):
         offsetGrating,offsetMirror = 0.0, 0.0
         
-        if self.ior['Value'].value == 4:
+        if iorPos is None:
+            iorPos = self.grx.get()
+
+        if iorPos == 4:
             offsetGrating = self.offsetGrLE/1000.0
             offsetMirror = self.offsetMLE/1000.0
         
-        elif self.ior['Value'].value == 3:
+        elif iorPos == 3:
             offsetGrating = self.offsetGrME/1000.0
             offsetMirror = self.offsetMME/1000.0
         
-        if self.ior['Value'].value == 2:
+        elif iorPos == 2:
             offsetGrating = self.offsetGrHE/1000.0
             offsetMirror = self.offsetMHE/1000.0
         
         return offsetGrating, offsetMirror
 
+    def get_grating(self):
+        """Line density and offsets of the grating selected, with the GRX
+        ioregister taken once per calculation (or once for a whole
+        trajectory)."""
+        iorPos = self.grx.get()
+        offsetG,offsetM = self.checkOffset(iorPos)
+        return self.look_at_grx(iorPos), offsetG, offsetM
+
         
 
 #########################
@@ -354,6 +486,9 @@ class EnergyAtFixedCff(PseudoMotorController):
         PseudoMotorController.__init__(self,inst,props)
 
         self.ior = PyTango.DeviceProxy(self.iorGrx)
+        # grating selected, updated with the ioregister change events so the
+        # calculations do not read it every time
+        self.grx = CachedAttribute(self.ior, 'Value', self._log)
 
         self.Cff = 2.25
         self.DiffrOrder = 1.0
@@ -366,6 +501,9 @@ class EnergyAtFixedCff(PseudoMotorController):
         self.offsetGrME = 0.0
         self.offsetMME = 0.0
 
+    def __del__(self):
+        self.grx.unsubscribe()
+
     def calc_physical(self, index, pseudos):
         return self.calc_all_physical(pseudos)[index - 1]
 
@@ -385,14 +523,14 @@ class EnergyAtFixedCff(PseudoMotorController):
         else:
             waveLen = self.hc / energy
         
-        offsetG,offsetM = self.checkOffset()
+        line_density, offsetG, offsetM = self.get_grating()
 
         if not self.FixedM2Pit:
             f1 = self.Cff**2 + 1
             f2 = 1 - self.Cff**2
             # FB f1 = Cff**2 + 1 # FB 
             # FB f2 = 1 - Cff**2
-            K = self.DiffrOrder * waveLen * self.look_at_grx()
+            K = self.DiffrOrder * waveLen * line_density
         
             CosAlpha = math.sqrt(-1*K**2 * f1 + 2*math.fabs(K) * math.sqrt(f2**2 + self.Cff**2 * K**2))/math.fabs(f2)
             # FB CosAlpha = math.sqrt(-1*K**2 * f1 + 2*math.fabs(K) * math.sqrt(f2**2 + Cff**2 * K**2))/math.fabs(f2)
@@ -407,10 +545,10 @@ class EnergyAtFixedCff(PseudoMotorController):
             g = (self.beta + (math.pi/2.0) + offsetG)*1000
             txt = "%.2f %.5f %.6f %.6f" %(energy, self.Cff, m, g)
             # FB txt = "%.2f %.5f %.6f %.6f" %(energy, Cff, m, g)
-            print txt 
+            self._log.debug(txt)
             return (m,g)
         else:
-            mkl = self.DiffrOrder * self.look_at_grx() * waveLen
+            mkl = self.DiffrOrder * line_density * waveLen
             A1 = (mkl/2.0) * math.tan(self.theta)
             A2 = math.sqrt(((math.cos(self.theta))**2) - ((mkl/2.0)**2))
             
@@ -423,13 +561,13 @@ class EnergyAtFixedCff(PseudoMotorController):
             
     def calc_all_pseudo(self, physical_pos, param=None):
         """From the real motor positions, we calculate the pseudomotors positions."""
-        offsetG,offsetM = self.checkOffset()
+        line_density, offsetG, offsetM = self.get_grating()
         self.beta = (physical_pos[1]/1000) - (math.pi/2.0) - offsetG
         self.theta = (math.pi/2.0) - (physical_pos[0]/1000) + offsetM
         self.alpha = (2.0*self.theta) + self.beta
-        wavelength = (math.sin(self.alpha) + math.sin(self.beta)) / (self.DiffrOrder * self.look_at_grx())
+        wavelength = (math.sin(self.alpha) + math.sin(self.beta)) / (self.DiffrOrder * line_density)
         
-        print "wavelength",  wavelength
+        self._log.debug("wavelength %s" % wavelength)
         if wavelength == 0.0:
             energy = 0.0
         else:
@@ -441,9 +579,31 @@ class EnergyAtFixedCff(PseudoMotorController):
         # FB self.Cff = math.cos(self.beta)/math.cos(self.alpha)
         # FB return (energy,self.Cff)
 
-        print "energy",  energy
+        self._log.debug("energy %s" % energy)
         return [energy,]
 
+    def calc_all_physical_array(self, pseudo_pos):
+        """Array version of calc_all_physical: from the (N, 1) energy
+        positions, the (N, 2) m2 and gr positions (nan where there is no
+        solution). The grating is read once for all of them."""
+        pseudo_pos = numpy.asarray(pseudo_pos, dtype=float)
+        line_density, offsetG, offsetM = self.get_grating()
+        theta = self.theta if self.FixedM2Pit else None
+        m, g = energy2physical(pseudo_pos[:, 0], self.Cff, self.hc,
+                               self.DiffrOrder, line_density, offsetG,
+                               offsetM, theta)
+        return numpy.column_stack((m, g))
+
+    def calc_all_pseudo_array(self, physical_pos):
+        """Array version of calc_all_pseudo: from the (N, 2) m2 and gr
+        positions, the (N, 1) energy positions."""
+        physical_pos = numpy.asarray(physical_pos, dtype=float)
+        line_density, offsetG, offsetM = self.get_grating()
+        energy, _ = physical2energy(physical_pos[:, 0], physical_pos[:, 1],
+                                    self.hc, self.DiffrOrder, line_density,
+                                    offsetG, offsetM)
+        return energy.reshape(-1, 1)
+
     def GetExtraAttributePar(self, axis, name):
 
 
@@ -507,8 +667,9 @@ class EnergyAtFixedCff(PseudoMotorController):
         if name.lower() == "offsetmhe":
             self.offsetMHE = value
 
-    def look_at_grx(self):
-        iorPos = self.ior['Value'].value
+    def look_at_grx(self, iorPos=None):
+        if iorPos is None:
+            iorPos = self.grx.get()
         
         energyRange = 0
 
@@ -534,24 +695,34 @@ class EnergyAtFixedCff(PseudoMotorController):
         else:
             return 0.0
 
-    def checkOffset(self):
+    def checkOffset(self, iorPos=None):
         offsetGrating,offsetMirror = 0.0, 0.0
         
-        if self.ior['Value'].value == 4:
+        if iorPos is None:
+            iorPos = self.grx.get()
+
+        if iorPos == 4:
             offsetGrating = self.offsetGrLE/1000.0
             offsetMirror = self.offsetMLE/1000.0
         
-        elif self.ior['Value'].value == 3:
+        elif iorPos == 3:
             offsetGrating = self.offsetGrME/1000.0
             offsetMirror = self.offsetMME/1000.0
         
-        if self.ior['Value'].value == 2:
+        elif iorPos == 2:
             offsetGrating = self.offsetGrHE/1000.0
             offsetMirror = self.offsetMHE/1000.0
         
-        
         return offsetGrating, offsetMirror
 
+    def get_grating(self):
+        """Line density and offsets of the grating selected, with the GRX
+        ioregister taken once per calculation (or once for a whole
+        trajectory)."""
+        iorPos = self.grx.get()
+        offsetG,offsetM = self.checkOffset(iorPos)
+        return self.look_at_grx(iorPos), offsetG, offsetM
+
 
 
 
@@ -0,0 +1,92 @@
+import unittest
+
+import numpy
+
+import BL24_PseudoMotorsLib as lib
+
+
+class FakeEvent(object):
+
+    class AttrValue(object):
+        def __init__(self, value):
+            self.value = value
+
+    def __init__(self, value):
+        self.err = False
+        self.attr_value = self.AttrValue(value)
+
+
+class FakeProxy(object):
+    """Device proxy pushing a change event when subscribed and on every
+    change, as the ioregisters do. Counts the reads."""
+
+    values = {'grx_ior': {'Value': 4}}
+
+    def __init__(self, name):
+        self.values = dict(self.values[name])
+        self.callbacks = {}
+        self.reads = 0
+
+    def subscribe_event(self, name, event_type, cb):
+        self.callbacks[name] = cb
+        cb(FakeEvent(self.values[name]))
+        return len(self.callbacks)
+
+    def unsubscribe_event(self, event_id):
+        pass
+
+    def read_attribute(self, name):
+        self.reads += 1
+        return FakeEvent.AttrValue(self.values[name])
+
+    def change(self, name, value):
+        self.values[name] = value
+        self.callbacks[name](FakeEvent(value))
+
+
+ENERGY_PROPS = {'hc': 12398.41856, 'iorGrx': 'grx_ior'}
+
+
+class ArrayTestCase(unittest.TestCase):
+    """The array calculations give the same positions as the scalar ones"""
+
+    def setUp(self):
+        self.DeviceProxy = lib.PyTango.DeviceProxy
+        lib.PyTango.DeviceProxy = FakeProxy
+
+    def tearDown(self):
+        lib.PyTango.DeviceProxy = self.DeviceProxy
+
+    def assertArrayEqual(self, ctrl, pseudos):
+        physicals = ctrl.calc_all_physical_array(pseudos)
+        for pseudo, physical in zip(pseudos, physicals):
+            numpy.testing.assert_allclose(ctrl.calc_all_physical(pseudo),
+                                          physical)
+        for physical, pseudo in zip(physicals,
+                                    ctrl.calc_all_pseudo_array(physicals)):
+            numpy.testing.assert_allclose(ctrl.calc_all_pseudo(physical),
+                                          pseudo)
+
+    def test_energy(self):
+        ctrl = lib.EnergyCffFixed('test', dict(ENERGY_PROPS))
+        pseudos = [(energy, 2.25) for energy in numpy.linspace(100, 600, 5)]
+        self.assertArrayEqual(ctrl, pseudos)
+
+    def test_energy_at_fixed_cff(self):
+        ctrl = lib.EnergyAtFixedCff('test', dict(ENERGY_PROPS))
+        pseudos = numpy.linspace(100, 600, 5).reshape(-1, 1)
+        self.assertArrayEqual(ctrl, pseudos)
+
+    def test_grating_change(self):
+        ctrl = lib.EnergyAtFixedCff('test', dict(ENERGY_PROPS))
+        pseudos = [(500.0,)]
+        low = ctrl.calc_all_physical_array(pseudos)
+        ctrl.ior.change('Value', 3)
+        self.assertEqual(ctrl.get_grating()[0], 900.0 * 1E-7)
+        self.assertFalse(numpy.allclose(ctrl.calc_all_physical_array(pseudos),
+                                        low))
+        self.assertEqual(ctrl.ior.reads, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import bisect
 import math
 
 from sardana import DataAccess
@@ -109,6 +110,81 @@ class Energy(object):
 
         return energy
 
+    @staticmethod
+    def get_gr_pitch(sm_selected, gr_selected, target_energy):
+        """
+        Given the mirrors combination and an energy, it computes the grating
+        pitch (the inverse of get_energy, without the mirrors offsets).
+        @param[in] sm_selected: the Spherical Mirror selected (0=SM2, 1=SM1)
+        @param[in] gr_selected: the grating selected (0=HEG, 1=MEG, 2=LEG)
+        @param[in] target_energy: the energy in eV
+        @return the grating pitch in micro radians
+        @throws exception
+        """
+        #get spherical mirror offset
+        offset = Energy.offset[sm_selected]
+
+        #compute gr_pitch
+        wave_length = Energy.constant / target_energy
+        theta = Energy.include_angles[sm_selected]
+        D0 = Energy.line_spacing[gr_selected]
+
+        #Assuming m will always be 1.0 and doing basic simplification, the computation:
+        #beta = -acos((m*lambbda*1.e-9*D0*1.e3/2) * tan(theta/2) + 
+        #              sqrt(cos(theta/2)**2 - (m*lambbda*1.e-9*D0*1.e3/2)**2)
+        #            )
+        #Can be expressed as:
+        beta = -1.0 * math.acos(
+                         (wave_length*D0*5e-7) * math.tan(theta/2) + math.sqrt(math.cos(theta/2)**2 - (wave_length*D0*5e-7)**2 )
+                        )
+
+        alpha = theta + beta
+
+        gr_pitch = (math.pi/2 - alpha - offset) #radians
+        return gr_pitch * 1.0e6 #rads -> microrads
+
+    #index of the mirrors combinations valid for each energy (see
+    #get_combinations): energy_ranges it was built for, sorted range limits,
+    #combinations valid at each limit and between consecutive limits
+    _index = (None, [], [], [])
+
+    @staticmethod
+    def _build_index():
+        ranges = [(lo, hi, (j, i))
+                  for i in range(len(Energy.line_spacing))
+                  for j in range(len(Energy.include_angles))
+                  for lo, hi in [Energy.energy_ranges[i][j]]]
+        limits = sorted(set([lo for lo, hi, c in ranges] +
+                            [hi for lo, hi, c in ranges]))
+        # combinations in the order check_mirrors used to look for them
+        at_limit = [tuple([c for lo, hi, c in ranges if lo <= e <= hi])
+                    for e in limits]
+        between = [tuple([c for lo, hi, c in ranges if lo <= e1 and e2 <= hi])
+                   for e1, e2 in zip(limits[:-1], limits[1:])]
+        snapshot = [[tuple(r) for r in gr_ranges]
+                    for gr_ranges in Energy.energy_ranges]
+        Energy._index = (snapshot, limits, at_limit, between)
+
+    @staticmethod
+    def get_combinations(target_energy):
+        """
+        Given an energy, it returns the mirrors combinations that can reach it.
+        The combinations are looked up in an index of the energy ranges (it
+        is built again if energy_ranges is modified).
+        @param[in] target_energy: the energy to check
+        @return tuple of (sm, gr) tuples, with gr grating first order
+        """
+        snapshot, limits, at_limit, between = Energy._index
+        if snapshot != Energy.energy_ranges:
+            Energy._build_index()
+            snapshot, limits, at_limit, between = Energy._index
+        idx = bisect.bisect_left(limits, target_energy)
+        if idx < len(limits) and limits[idx] == target_energy:
+            return at_limit[idx]
+        if idx == 0 or idx == len(limits):
+            return ()
+        return between[idx-1]
+
     @staticmethod
     def check_mirrors(target_energy, sm, gr):
         """
@@ -132,41 +208,22 @@ class Energy(object):
         passed sm and/or gr position are invalid
         """
 
-        #check that target energy is possible with current mirrors combination
-        range_found = False
-        if (sm in Energy.SM_VALID) and (gr in Energy.GR_VALID):
-            current_min_energy = Energy.energy_ranges[gr][sm][0]
-            current_max_energy = Energy.energy_ranges[gr][sm][1]
-            if (target_energy >= current_min_energy) and (target_energy <= current_max_energy):
-                range_found = True
-                sm_target = sm
-                gr_target = gr
-        else:
+        if not ((sm in Energy.SM_VALID) and (gr in Energy.GR_VALID)):
             raise Exception('The GR and/or SM positions received are invalid')
 
+        #check that target energy is possible with current mirrors combination
+        combinations = Energy.get_combinations(target_energy)
+        if (sm, gr) in combinations:
+            return True, sm, gr
+
         #If target energy not possible with current combination, find which
         #grating and spherical mirrors can give me that energy. If not possible,
         #then raise exception
-
-        if range_found:
-            possible=True
-        else:
-            possible=False
-            mirrors_changed=False
-            for i in range(len(Energy.line_spacing)):
-                for j in range(len(Energy.include_angles)):
-                    if (target_energy >= Energy.energy_ranges[i][j][0] and target_energy <= Energy.energy_ranges[i][j][1]):
-                        sm_target = j
-                        gr_target = i
-                        mirrors_changed = True
-                        break
-                if mirrors_changed:
-                    break
-            else:
-                msg = 'Energy %s out of any possible range' % str(target_energy)
-                raise Exception(msg)
-
-        return possible, sm_target, gr_target
+        if not combinations:
+            msg = 'Energy %s out of any possible range' % str(target_energy)
+            raise Exception(msg)
+        sm_target, gr_target = combinations[0]
+        return False, sm_target, gr_target
 
     @staticmethod
     def lib2user(sm_lib, sm_user_offset=0):
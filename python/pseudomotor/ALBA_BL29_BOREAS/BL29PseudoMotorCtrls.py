@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
-import math
 import numpy
-from scipy.optimize import fsolve
+import PyTango
+from scipy.interpolate import splrep, splev
 
 from BL29Energy import Energy
 
@@ -13,6 +13,55 @@ from sardana.pool.controller import PseudoMotorController
 from sardana.pool.controller import Type, Access, Description, DefaultValue
 
 
+class CachedAttribute(object):
+    """
+    Utility class keeping the value of an attribute of a device proxy, updated
+    by its change events. If the events are not available (or the last one
+    was an error) the attribute is read from the device.
+    """
+
+    def __init__(self, proxy, name, log=None):
+        self.proxy = proxy
+        self.name = name
+        self.log = log
+        self.value = None
+        self.event_id = None
+        try:
+            self.event_id = proxy.subscribe_event(
+                                name, PyTango.EventType.CHANGE_EVENT,
+                                self.push_event)
+        except Exception, e:
+            if self.log:
+                self.log.debug('Unable to subscribe to %s changes, it will '
+                               'be read every time: %s' % (name, e))
+
+    def push_event(self, event):
+        if event.err or event.attr_value is None:
+            self.value = None
+        else:
+            self.value = event.attr_value.value
+
+    def get(self):
+        value = self.value
+        if value is None:
+            value = getattr(self.proxy, self.name)
+        return value
+
+    def invalidate(self):
+        """the next get reads the attribute, until a new event arrives"""
+        self.value = None
+
+    def unsubscribe(self):
+        if self.event_id is None:
+            return
+        try:
+            self.proxy.unsubscribe_event(self.event_id)
+        except Exception:
+            pass
+        self.event_id = None
+        self.value = None
+
+
 class BL29EnergyMono(PseudoMotorController):
     """
     Energy pseudo motor controller for handling BL29-Boreas theoretical energy of
@@ -100,6 +149,31 @@ class BL29EnergyMono(PseudoMotorController):
         PseudoMotorController.__init__(self, inst, props, *args, **kwargs)
         self.sm_selected = PoolUtil.get_device(inst, self.sm_pseudo)
         self.gr_selected = PoolUtil.get_device(inst, self.gr_pseudo)
+        #selected mirrors, updated with change events so energy scans do not
+        #read them for every point
+        self.sm_position = CachedAttribute(self.sm_selected, 'position', self._log)
+        self.gr_position = CachedAttribute(self.gr_selected, 'position', self._log)
+        self.sm_user_idx_offset = CachedAttribute(self.sm_selected, 'user_idx_offset', self._log)
+
+    def __del__(self):
+        for attribute in (self.sm_position, self.gr_position,
+                          self.sm_user_idx_offset):
+            attribute.unsubscribe()
+
+    def get_selected_mirrors(self):
+        """
+        Get the spherical mirror (with the library's definition) and the
+        grating currently selected.
+        @return tuple (sm, gr)
+        @throws exception
+        """
+        sm_selected = int(self.sm_position.get())
+        gr_selected = int(self.gr_position.get())
+        # sm_selected definition was changed on user request, but we have to
+        # work with the library's definition
+        sm_selected = Energy.user2lib(sm_selected,
+                                      self.sm_user_idx_offset.get())
+        return sm_selected, gr_selected
 
     def CalcPhysical(self, axis, pseudo_pos, current_physical):
         """
@@ -113,18 +187,12 @@ class BL29EnergyMono(PseudoMotorController):
         """
         target_energy = pseudo_pos[0]
         try:
-            sm_current = int(self.sm_selected.position)
-            gr_current = int(self.gr_selected.position)
+            sm_current, gr_current = self.get_selected_mirrors()
         except:
             msg = 'Unable to determine SM and/or GR selected'
             self._log.error(msg)
             raise Exception(msg)
 
-        # sm_selected definition was changed on user request, but we have to
-        # work with the library's definition
-        sm_current = Energy.user2lib(sm_current,
-                                     self.sm_selected.user_idx_offset)
-
         target_reachable, sm_target, gr_target = Energy.check_mirrors(
                                                     target_energy,
                                                     sm_current,
@@ -140,11 +208,13 @@ class BL29EnergyMono(PseudoMotorController):
                         # so we have to translate from library's to user
                         sm_usr_target = Energy.lib2user(
                                         sm_target,
-                                        self.sm_selected.user_idx_offset)
+                                        self.sm_user_idx_offset.get())
                         self._log.debug('Moving SM to %d' % sm_usr_target)
+                        self.sm_position.invalidate()
                         self.sm_selected.position = sm_usr_target
                     if gr_current != gr_target:
                         self._log.debug('Moving GR to %d' % gr_target)
+                        self.gr_position.invalidate()
                         self.gr_selected.position = gr_target
                 except:
                     msg = 'Got exception while trying to move SM or GR pseudo motors'
@@ -168,40 +238,14 @@ class BL29EnergyMono(PseudoMotorController):
                 raise Exception(msg)
 
         if axis == 1:
-            #get spherical mirror offset
-            offset = Energy.offset[sm_target]
-
-            #compute gr_pitch
-            wave_length = Energy.constant / target_energy
-            theta = Energy.include_angles[sm_target]
-            D0 = Energy.line_spacing[gr_target]
-
-            #Assuming m will always be 1.0 and doing basic simplification, the computation:
-            #beta = -acos((m*lambbda*1.e-9*D0*1.e3/2) * tan(theta/2) + 
-            #              sqrt(cos(theta/2)**2 - (m*lambbda*1.e-9*D0*1.e3/2)**2)
-            #            )
-            #Can be expressed as:
-            beta = -1.0 * math.acos(
-                             (wave_length*D0*5e-7) * math.tan(theta/2) + math.sqrt(math.cos(theta/2)**2 - (wave_length*D0*5e-7)**2 )
-                            )
-
-            alpha = theta + beta
-
-            gr_pitch = (math.pi/2 - alpha - offset) #radians
+            gr_pitch = Energy.get_gr_pitch(sm_target, gr_target, target_energy)
 
             self._log.debug('<------------------------------------------------------- CalcPhysical')
             self._log.debug('target_energy: %f', target_energy)
-            self._log.debug('offset: %f', offset)
-            self._log.debug('lambda: %f', wave_length)
-            self._log.debug('theta: %f', theta * 180 / math.pi)
-            self._log.debug('beta: %f', beta * 180 / math.pi)
-            self._log.debug('alpha: %f', alpha * 180 / math.pi)
-            self._log.debug('(sm_target: %f, gr_target: %f, gr-pitch (rad): %f, gr-pitch (deg): %f, gr_pitch (microrad): %f', sm_target, gr_target, gr_pitch, gr_pitch * 180 / math.pi, gr_pitch * 1.0e6)
-            self._log.debug('gr-pitch (rad): %f, gr-pitch (deg): %f', gr_pitch, gr_pitch * 180 / math.pi)
-            self._log.debug('gr-pitch (urad): %f, gr-pitch (urad - OFFSET): %f', gr_pitch * 1e6, gr_pitch * 1e6 - Energy.mirrors_offsets[gr_target][sm_target])
+            self._log.debug('(sm_target: %f, gr_target: %f, gr_pitch (microrad): %f', sm_target, gr_target, gr_pitch)
+            self._log.debug('gr-pitch (urad): %f, gr-pitch (urad - OFFSET): %f', gr_pitch, gr_pitch - Energy.mirrors_offsets[gr_target][sm_target])
             self._log.debug('-------------------------------------------------------> CalcPhysical')
 
-            gr_pitch = gr_pitch * 1.0e6 #rads -> microrads
             #apply the corresponding mirrors combination offset
             return gr_pitch - Energy.mirrors_offsets[gr_target][sm_target]
         else:
@@ -220,19 +264,13 @@ class BL29EnergyMono(PseudoMotorController):
         """
         try:
             #get currently selected grating and spherical mirror
-            sm_selected = int(self.sm_selected.position)
-            gr_selected = int(self.gr_selected.position)
+            sm_selected, gr_selected = self.get_selected_mirrors()
             gr_pitch = physical_pos[0]
         except:
             msg = 'Unable to determine SM and/or GR selected and/or GR pitch'
             self._log.error(msg)
             raise Exception(msg)
 
-        # sm_selected definition was changed on user request, but we have to
-        # work with the library's definition
-        sm_selected = Energy.user2lib(sm_selected,
-                                      self.sm_selected.user_idx_offset)
-
         if not (sm_selected in Energy.SM_VALID) or not (gr_selected in Energy.GR_VALID) or (gr_pitch is None):
             msg = 'Spherical mirrors and/or grating mirror and/or grating pitch are not correctly set in CalcPseudo()'
             self._log.error(msg)
@@ -296,6 +334,108 @@ class BL29EnergyMono(PseudoMotorController):
             pass
 
 
+class BL29PitchCorrection(object):
+    """
+    Utility class with the non linear correction of the grating pitch of
+    BL29EnergyMonoCorrected for a given set of parameters and grating pitch
+    motor offset. The correction is computed with numpy (it accepts arrays)
+    and so is its derivative, used to invert it with Newton's method. An
+    inverse spline over the usable pitch range gives the initial guesses.
+    """
+
+    def __init__(self, polynomials, amplitudes, frequencies, phases,
+                 enc_to_axis_factor, factor, total_offsets, gr_pitch_offset,
+                 step_per_unit):
+        if len(amplitudes)!=len(frequencies) or len(frequencies)!=len(phases):
+            raise Exception('Amplitudes, frequencies and phases must be the same length')
+        # numpy.polyval expects the highest degree first
+        self.polynomial = numpy.array(list(reversed(polynomials)) or [0.0])
+        self.polynomial_der = numpy.polyder(self.polynomial)
+        self.amplitudes = numpy.array(amplitudes, dtype=float)
+        self.frequencies = numpy.array(frequencies, dtype=float)
+        self.phases = numpy.array(phases, dtype=float)
+        self.enc_to_axis_factor = enc_to_axis_factor
+        self.factor = factor
+        self.total_offsets = total_offsets
+        self.gr_pitch_offset = gr_pitch_offset
+        self.step_per_unit = step_per_unit
+        self.inverse = None
+
+    def compute_pitch(self, gr_pitch_axis):
+        """
+        Conversion between real axis counts and corrected axis counts (see
+        BL29EnergyMonoCorrected.compute_pitch)
+        """
+        gr_pitch_axis = numpy.asarray(gr_pitch_axis, dtype=float)
+        angles = numpy.multiply.outer(gr_pitch_axis, self.frequencies) + self.phases
+        correction = numpy.polyval(self.polynomial, gr_pitch_axis) + \
+            (self.amplitudes * numpy.sin(angles)).sum(axis=-1)
+        return gr_pitch_axis + correction / self.enc_to_axis_factor
+
+    def compute_pitch_der(self, gr_pitch_axis):
+        """derivative of compute_pitch"""
+        gr_pitch_axis = numpy.asarray(gr_pitch_axis, dtype=float)
+        angles = numpy.multiply.outer(gr_pitch_axis, self.frequencies) + self.phases
+        correction = numpy.polyval(self.polynomial_der, gr_pitch_axis) + \
+            (self.amplitudes * self.frequencies * numpy.cos(angles)).sum(axis=-1)
+        return 1.0 + correction / self.enc_to_axis_factor
+
+    def correct(self, gr_pitch):
+        """corrected grating pitch (see BL29EnergyMonoCorrected.correct_gr_pitch)"""
+        gr_pitch_axis = (self.gr_pitch_offset - numpy.asarray(gr_pitch)) * self.step_per_unit
+        return self.total_offsets - self.compute_pitch(gr_pitch_axis) / self.factor
+
+    def correct_der(self, gr_pitch):
+        """derivative of correct"""
+        gr_pitch_axis = (self.gr_pitch_offset - numpy.asarray(gr_pitch)) * self.step_per_unit
+        return self.compute_pitch_der(gr_pitch_axis) * self.step_per_unit / self.factor
+
+    def solve(self, gr_pitch_corrected, guess=None, xtol=1.49012e-08, maxiter=50):
+        """
+        Newton's method to find the grating pitch whose correction is
+        gr_pitch_corrected.
+        @throws exception if it does not converge
+        """
+        if guess is None:
+            guess = self.guess(gr_pitch_corrected)
+        x = float(guess)
+        for i in range(maxiter):
+            der = float(self.correct_der(x))
+            if der == 0 or der != der:
+                raise Exception('null derivative at %f' % x)
+            dx = (float(self.correct(x)) - gr_pitch_corrected) / der
+            x -= dx
+            if abs(dx) <= xtol * max(1.0, abs(x)):
+                return x
+        raise Exception('no convergence after %d iterations' % maxiter)
+
+    def build_inverse(self, gr_pitch_min, gr_pitch_max, points=2048):
+        """
+        Compute the inverse spline of the correction in the grating pitch
+        range. It is not used if the correction is not monotonic there.
+        """
+        self.inverse = None
+        x = numpy.linspace(gr_pitch_min, gr_pitch_max, points)
+        y = self.correct(x)
+        dy = numpy.diff(y)
+        if not ((dy > 0).all() or (dy < 0).all()):
+            return False
+        order = numpy.argsort(y)
+        self.inverse = (splrep(y[order], x[order]), y[order[0]], y[order[-1]])
+        return True
+
+    def guess(self, gr_pitch_corrected):
+        """
+        Initial guess for solve: the inverse spline or the corrected value
+        itself out of its range.
+        """
+        if self.inverse is not None:
+            tck, y_min, y_max = self.inverse
+            if y_min <= gr_pitch_corrected <= y_max:
+                return float(splev(gr_pitch_corrected, tck))
+        return gr_pitch_corrected
+
+
 class BL29EnergyMonoCorrected(BL29EnergyMono):
     """
     Energy pseudo motor controller for handling BL29-Boreas theoretical energy of
@@ -415,6 +555,8 @@ class BL29EnergyMonoCorrected(BL29EnergyMono):
         BL29EnergyMono.__init__(self, inst, props, *args, **kwargs)
         self.gr_pitch_motor = None
         self.lock_mirrors = True
+        # BL29PitchCorrection of the current parameters
+        self.correction = None
 
     def CalcPhysical(self, axis, pseudo_pos, current_physical):
         """
@@ -426,25 +568,63 @@ class BL29EnergyMonoCorrected(BL29EnergyMono):
         @return the correct motor position
         @throws exception
         """
-        if self.gr_pitch_motor == None: #this cannot be initialize in __init__
-            self.gr_pitch_motor = self.GetMotor(0)
         gr_pitch = BL29EnergyMono.CalcPhysical(self, axis, pseudo_pos, current_physical)
-        result, info, rc, mesg = fsolve(self.resolve_pitch, gr_pitch, args=gr_pitch, full_output=True)
-        if rc != 1:
-            msg = 'Unable to find a solution for %s: %s' % (str(self.motor_roles[0]), str(mesg))
+        correction = self.get_correction()
+        try:
+            return correction.solve(gr_pitch)
+        except Exception, e:
+            msg = 'Unable to find a solution for %s: %s' % (str(self.motor_roles[0]), str(e))
             self._log.error(msg)
             raise Exception(msg)
-        if type(result) != numpy.ndarray: #in old versions result was a float
-            return result
-        else:
-            return result[0]
 
-    def resolve_pitch(self, x, gr_pitch):
+    def get_correction(self):
         """
-        this function is the one that needs to be solved (find a 0) to go from
-        gr_pitch_corrected to the real gr_pitch
+        Get the BL29PitchCorrection of the current parameters and grating
+        pitch motor offset. It is computed again (with its inverse spline)
+        only if any of them changed.
         """
-        return self.correct_gr_pitch(x) - gr_pitch
+        if self.gr_pitch_motor == None: #this cannot be initialize in __init__
+            self.gr_pitch_motor = self.GetMotor(0)
+        gr_pitch_offset = self.gr_pitch_motor.get_offset().get_value()
+        step_per_unit = self.gr_pitch_motor.step_per_unit
+        key = (tuple(self.polynomials), tuple(self.amplitudes),
+               tuple(self.frequencies), tuple(self.phases),
+               self.enc_to_axis_factor, self.factor, self.offset,
+               Energy.offset0, gr_pitch_offset, step_per_unit,
+               tuple(map(tuple, Energy.mirrors_offsets)))
+        if self.correction is None or self.correction_key != key:
+            correction = BL29PitchCorrection(
+                            self.polynomials, self.amplitudes,
+                            self.frequencies, self.phases,
+                            self.enc_to_axis_factor, self.factor,
+                            self.offset + Energy.offset0, gr_pitch_offset,
+                            step_per_unit)
+            self.build_inverse(correction)
+            self.correction = correction
+            self.correction_key = key
+        return self.correction
+
+    def build_inverse(self, correction):
+        """
+        Build the inverse spline of the correction over the grating pitch
+        range needed by the energy ranges of all the mirrors combinations.
+        """
+        gr_pitches = []
+        for gr in Energy.GR_VALID:
+            for sm in Energy.SM_VALID:
+                for energy in Energy.energy_ranges[gr][sm]:
+                    try:
+                        gr_pitch = Energy.get_gr_pitch(sm, gr, energy) - \
+                                   Energy.mirrors_offsets[gr][sm]
+                        gr_pitches.append(correction.solve(gr_pitch, gr_pitch))
+                    except Exception, e:
+                        self._log.debug('Skipping %s eV (GR %d, SM %d) in the inverse spline: %s' % (energy, gr, sm, e))
+        if len(gr_pitches) < 2:
+            return
+        margin = 0.01 * (max(gr_pitches) - min(gr_pitches))
+        if not correction.build_inverse(min(gr_pitches) - margin,
+                                        max(gr_pitches) + margin):
+            self._log.debug('Correction not monotonic, inverse spline not used')
 
     def CalcPseudo(self, axis, physical_pos, current_pseudo):
         """
@@ -455,23 +635,15 @@ class BL29EnergyMonoCorrected(BL29EnergyMono):
         @return the energy pseudo motor value
         @throws exception
         """
-        if self.gr_pitch_motor == None: #this cannot be initialize in __init__
-            self.gr_pitch_motor = self.GetMotor(0)
         try:
             #get currently selected grating and spherical mirror
-            sm_selected = int(self.sm_selected.position)
-            gr_selected = int(self.gr_selected.position)
+            sm_selected, gr_selected = self.get_selected_mirrors()
             gr_pitch = physical_pos[0]
         except:
             msg = 'Unable to determine SM and/or GR selected and/or GR pitch'
             self._log.error(msg)
             raise Exception(msg)
 
-        # sm_selected definition was changed on user request, but we have to
-        # work with the library's definition
-        sm_selected = Energy.user2lib(sm_selected,
-                                      self.sm_selected.user_idx_offset)
-
         gr_pitch = physical_pos[0]
         gr_pitch_corrected = self.correct_gr_pitch(gr_pitch)
         return Energy.get_energy(sm_selected,gr_selected,gr_pitch_corrected)
@@ -488,12 +660,7 @@ class BL29EnergyMonoCorrected(BL29EnergyMono):
         The correction is computed taking into account the axis position of the
         grating pitch motor (gr_pitch), not the user position.
         """
-        total_offsets = self.offset + Energy.offset0
-        gr_pitch_offset = self.gr_pitch_motor.get_offset().get_value()
-        gr_pitch_axis = (gr_pitch_offset - gr_pitch) * self.gr_pitch_motor.step_per_unit
-        axis_increment = self.compute_pitch(gr_pitch_axis)
-        gr_pitch_corrected = total_offsets - axis_increment / self.factor
-        return gr_pitch_corrected
+        return float(self.get_correction().correct(gr_pitch))
 
     def compute_pitch(self, gr_pitch_axis):
         """
@@ -501,21 +668,7 @@ class BL29EnergyMonoCorrected(BL29EnergyMono):
         corrected axis counts. This value is a factor conversion between encoder
         counts and axis counts
         """
-        #first the polynomial part is computed
-        correction = 0.0
-        for idx, polynomial in enumerate(self.polynomials):
-            correction += (polynomial * math.pow(gr_pitch_axis,idx))
-
-        #then the sinusoidal part is added
-        if len(self.amplitudes)!=len(self.frequencies) or len(self.frequencies)!=len(self.phases):
-            raise Exception('Amplitudes, frequencies and phases must be the same length')
-        for amplitude, frequency, phase in zip(self.amplitudes,self.frequencies,self.phases):
-            correction += (amplitude * math.sin(frequency*gr_pitch_axis + phase))
-
-        #the new axis values are finally computed
-        #the correction factor is necessary as the first computation was done using the encoder as driving value
-        gr_corrected = gr_pitch_axis + correction / self.enc_to_axis_factor
-        return gr_corrected
+        return float(self.get_correction().compute_pitch(gr_pitch_axis))
 
     def GetAxisExtraPar(self, axis, name):
         if name == 'enc_to_axis_factor':
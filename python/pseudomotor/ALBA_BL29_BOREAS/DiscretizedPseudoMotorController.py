@@ -26,6 +26,7 @@
 """This module contains the definition of a grouped pseudomotor controllers"""
 
 
+import bisect
 import json
 
 from sardana import DataAccess
@@ -40,6 +41,71 @@ CALIBRATION = 'Calibration'
 LABELS = 'Labels'
 
 
+class CalibrationIndex(object):
+    """
+    Index of the calibrations of a DiscretizedPseudoMotorController for a
+    given number of physical motors.
+
+    For each physical motor the limits of its calibration ranges split the
+    positions in segments (the limits themselves and the open intervals
+    between them), and each segment stores a bit mask of the combinations
+    whose range includes it. The combinations are numbered in the order they
+    are chosen (maximum number of motors matched, first wins), so the
+    combination matched is the lowest bit set in the mask of all the motors.
+    """
+
+    def __init__(self, calibrations, nmotors):
+        counts = []
+        for ranges in calibrations:
+            ranges = ranges[:nmotors]
+            for range_ in ranges:
+                if range_ is not None and len(range_) != 3:
+                    raise Exception('Incorrect calibration configuration')
+            counts.append(len([r for r in ranges if r is not None]))
+        # combinations without any motor to match are never chosen
+        self.order = sorted([idx for idx, count in enumerate(counts)
+                             if count > 0], key=lambda idx: -counts[idx])
+        self.motors = []
+        for motor in range(nmotors):
+            ignored = 0
+            limits = set()
+            for bit, idx in enumerate(self.order):
+                ranges = calibrations[idx]
+                if motor >= len(ranges) or ranges[motor] is None:
+                    ignored |= 1 << bit
+                else:
+                    limits.add(ranges[motor][0])
+                    limits.add(ranges[motor][2])
+            limits = sorted(limits)
+            # segment 2*i is the interval below limits[i], 2*i+1 is limits[i]
+            masks = [ignored] * (2 * len(limits) + 1)
+            for bit, idx in enumerate(self.order):
+                ranges = calibrations[idx]
+                if motor >= len(ranges) or ranges[motor] is None:
+                    continue
+                first = bisect.bisect_left(limits, ranges[motor][0])
+                last = bisect.bisect_left(limits, ranges[motor][2])
+                for segment in range(2 * first + 1, 2 * last + 2):
+                    masks[segment] |= 1 << bit
+            self.motors.append((limits, masks))
+
+    def match(self, physical_positions):
+        """
+        @return the index of the combination matched by the physical
+                positions or None if there is none
+        """
+        matched = (1 << len(self.order)) - 1
+        for physical, (limits, masks) in zip(physical_positions, self.motors):
+            i = bisect.bisect_left(limits, physical)
+            if i < len(limits) and limits[i] == physical:
+                matched &= masks[2 * i + 1]
+            else:
+                matched &= masks[2 * i]
+            if not matched:
+                return None
+        return self.order[(matched & -matched).bit_length() - 1]
+
+
 class DiscretizedPseudoMotorController(PseudoMotorController):
     """
     This class is meant to implement a basic logic which bind one or more
@@ -121,26 +187,18 @@ class DiscretizedPseudoMotorController(PseudoMotorController):
         self.calibrations = None
         self.labels = None
         self.user_idx_offset = 0
+        # built from the calibrations on the first CalcPseudo after they
+        # change
+        self.calibration_index = None
 
     def CalcPseudo(self, axis, physical_positions, current_pseudo_positions):
         self._log.debug('CalcPseudo: %s' % str(physical_positions))
-        best_match = None
-        max_motors_matched = 0
-        for idx, ranges in enumerate(self.calibrations):
-            motors_matched = 0
-            for physical, range_ in zip(physical_positions, ranges):
-                if range_ is None:
-                    pass
-                elif len(range_) != 3:
-                    raise Exception('Incorrect calibration configuration')
-                elif physical >= range_[0] and physical <= range_[2]:
-                    motors_matched += 1
-                else:
-                    break
-            else:
-                if motors_matched > max_motors_matched:
-                    best_match = idx
-                    max_motors_matched = motors_matched
+        index = self.calibration_index
+        if index is None or len(index.motors) != len(physical_positions):
+            index = CalibrationIndex(self.calibrations,
+                                     len(physical_positions))
+            self.calibration_index = index
+        best_match = index.match(physical_positions)
         return best_match + self.user_idx_offset
 
     def CalcAllPhysical(self, pseudo_positions, current_physical_positions):
@@ -177,8 +235,10 @@ class DiscretizedPseudoMotorController(PseudoMotorController):
         name = name.lower()
         if name == self.CALIBRATION:
             self.calibrations = json.loads(value)
+            self.calibration_index = None
         elif name == self.LABELS:
             self.labels = json.loads(value)
+            self.calibration_index = None
         elif name == self.USER_IDX_OFFSET:
             self.user_idx_offset = value
         else:
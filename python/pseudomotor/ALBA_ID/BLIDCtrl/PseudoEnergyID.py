@@ -9,7 +9,7 @@ import math
 import numpy as np
 import scipy
 import scipy.optimize
-from PseudoEnergyLib import EnergyID, EnergyIDPlus
+from PseudoEnergyLib import EnergyID, EnergyIDPlus, LRUCache, GapPhaseTable
 #from PseudoEnergyLib import 
 
 import traceback
@@ -43,7 +43,9 @@ class PseudoEnergy(PseudoMotorController):
     logo = "ALBA_logo.png"
 
     ctrl_properties = {"id_name":{Type:str,Description:"I don't want to describe it",DefaultValue:'xxx'},
-    "pol_units":{Type:str ,Description:"True if rad unit should b eused",DefaultValue:'rad'}}
+    "pol_units":{Type:str ,Description:"True if rad unit should b eused",DefaultValue:'rad'},
+    "cache_size":{Type:int,Description:"Number of Energy to Gap and Phase solutions kept",DefaultValue:1024},
+    "gap_phase_table":{Type:str,Description:"Directory of the Gap and Phase tables (interpolated inversion), empty to always solve it",DefaultValue:''}}
     
     #ctrl_properties = {"id_name":{Type:str,Description:"I don't want to describe it",DefaultValue:'xxx'}}
 
@@ -73,6 +75,11 @@ class PseudoEnergy(PseudoMotorController):
         self.Deceleration = {}
         self.Velocity = {}
         self.Base_rate = {}
+
+        # (Energy, Polarization, harmonic, offset): (Gap, Phase)
+        self.solutions = LRUCache(self.cache_size)
+        # harmonic: GapPhaseTable
+        self.tables = {}
         
 
         if self.id_name == 'NCD':
@@ -87,32 +94,47 @@ class PseudoEnergy(PseudoMotorController):
             pass
         
 
-    def calc_physical(self, index, pseudo_pos):
+    def toRad(self, Polarization):
+        if self.pol_units == "rad":
+            return Polarization
+        elif self.pol_units == "degree":
+            return fromDegreeToRad(Polarization)
+        else:
+            return fromTauToRad(Polarization)
+
+    def solveGapPhase(self, Energy, rad, harm, off):
+        # The inversion is solved once per move (not once per motor) and
+        # the solutions are kept, so scans repeating the same energies do
+        # not search them again
+        key = (Energy, rad, harm, off)
+        solution = self.solutions.get(key)
+        if solution is None:
+            if self.gap_phase_table:
+                table = self.tables.get(harm)
+                if table is None:
+                    table = GapPhaseTable(self.lib, harm, self.gap_phase_table)
+                    self.tables[harm] = table
+                solution = table.calculateGapPhase(Energy, rad, off)
+            else:
+                solution = self.lib.calculateGapPhase(Energy, rad, harm, off)
+            self.solutions.put(key, solution)
+        return solution
+
+    def calc_all_physical(self, pseudo_pos):
         
         Energy = pseudo_pos[0]
         Polarization = pseudo_pos[1]
 
-        harm = self.harmonics[index]
-        off = self.offsets[index]
+        harm = self.harmonics[1]
+        off = self.offsets[1]
 
         # From Energy (eV) to Gap (meter)
-        try:
-            if self.pol_units == "rad":
-                Gap,Phase = self.lib.calculateGapPhase(Energy, Polarization, harm, off)
-            elif self.pol_units == "degree":
-                rad = fromDegreeToRad(Polarization)
-                Gap,Phase = self.lib.calculateGapPhase(Energy, rad, harm, off)
-            else:
-                rad = fromTauToRad(Polarization)
-                Gap,Phase = self.lib.calculateGapPhase(Energy, rad, harm, off)
-                #print " From Energy = %f and Pol = %f to Gap = %f and Phase = %f (rad=%f)" %(Energy, Polarization, Gap/MICRO,Phase/MICRO, rad)
-        except Exception,e:
-            raise
+        Gap,Phase = self.solveGapPhase(Energy, self.toRad(Polarization), harm, off)
 
-        if index == 1:
-            return Gap/MICRO
-        elif index == 2:
-            return Phase/MICRO
+        return [Gap/MICRO, Phase/MICRO]
+
+    def calc_physical(self, index, pseudo_pos):
+        return self.calc_all_physical(pseudo_pos)[index - 1]
             
     def calc_pseudo(self, index, physical_pos):
         
@@ -263,7 +285,9 @@ class PseudoEnergyPlus(PseudoMotorController):
     
 
     ctrl_properties = {"id_name":{Type:str,Description:"I don't want to describe it",DefaultValue:'xxx'},
-    "pol_units":{Type:str ,Description:"True if rad unit should b eused",DefaultValue:'rad'}}
+    "pol_units":{Type:str ,Description:"True if rad unit should b eused",DefaultValue:'rad'},
+    "cache_size":{Type:int,Description:"Number of Energy to Gap and Phase solutions kept",DefaultValue:1024},
+    "gap_phase_table":{Type:str,Description:"Directory of the Gap and Phase tables (interpolated inversion), empty to always solve it",DefaultValue:''}}
     
 
     # FB the edMAXEnergy should be only READ, but there is a bug in the pool
@@ -288,6 +312,11 @@ class PseudoEnergyPlus(PseudoMotorController):
         self.polarizationPlusSigns = {}
         self.max_energies = {}
 
+        # (Energy, Polarization, harmonic, offset, parallel mode): (Gap, Phase)
+        self.solutions = LRUCache(self.cache_size)
+        # (harmonic, parallel mode): GapPhaseTable
+        self.tables = {}
+
         if self.id_name == 'NCD':
             self.lib = EnergyIDPlus('NCD')
         elif self.id_name == 'XALOC':
@@ -300,7 +329,34 @@ class PseudoEnergyPlus(PseudoMotorController):
             pass
         
 
-    def calc_physical(self, index, pseudo_pos):
+    def toRad(self, Polarization):
+        if self.pol_units == "rad":
+            return Polarization
+        elif self.pol_units == "degree":
+            return fromDegreeToRad(Polarization)
+        else:
+            return fromTauToRad(Polarization)
+
+    def solveGapPhase(self, Energy, rad, harm, off):
+        # The inversion is solved once per move (not once per motor) and
+        # the solutions are kept, so scans repeating the same energies do
+        # not search them again
+        key = (Energy, rad, harm, off, self.lib.parallelMode)
+        solution = self.solutions.get(key)
+        if solution is None:
+            if self.gap_phase_table:
+                table_key = (harm, self.lib.parallelMode)
+                table = self.tables.get(table_key)
+                if table is None:
+                    table = GapPhaseTable(self.lib, harm, self.gap_phase_table)
+                    self.tables[table_key] = table
+                solution = table.calculateGapPhase(Energy, rad, off)
+            else:
+                solution = self.lib.calculateGapPhase(Energy, rad, harm, off)
+            self.solutions.put(key, solution)
+        return solution
+
+    def calc_all_physical(self, pseudo_pos):
         
         Energy = pseudo_pos[0]
         if pseudo_pos[1] <0:
@@ -309,45 +365,26 @@ class PseudoEnergyPlus(PseudoMotorController):
             self.polarizationPlusSigns[1] = True
         Polarization = abs(pseudo_pos[1])#FB Take the absolute value of the polarizationplus
 
-        harm = self.harmonics[index]
-        off = self.offsets[index]
+        harm = self.harmonics[1]
+        off = self.offsets[1]
 
         # From Energy (eV) to Gap (meter)
-	try:
-            if self.pol_units == "rad":
-                Gap,Phase = self.lib.calculateGapPhase(Energy, Polarization, harm, off)
-            elif self.pol_units == "degree":
-                rad = fromDegreeToRad(Polarization)
-                Gap,Phase = self.lib.calculateGapPhase(Energy, rad, harm, off)
-            else:
-                rad = fromTauToRad(Polarization)
-                Gap,Phase = self.lib.calculateGapPhase(Energy, rad, harm, off)
-                #print " From Energy = %f and Pol = %f to Gap = %f and Phase = %f (rad=%f)" %(Energy, Polarization, Gap/MICRO,Phase/MICRO, rad)
-        except Exception,e:
-            raise
+        Gap,Phase = self.solveGapPhase(Energy, self.toRad(Polarization), harm, off)
 
         if self.polarizationPlusSigns[1] == False:#FB If the polarization is negative the antiphase is negative
             Phase = 0.0 - Phase
 
-        print "calc_physical: index = %d parallelMode = %d" %(index, self.parallelModes[1])
-        if index == 1:      
-            print "Gap = %f" %(Gap/MICRO)
-            return Gap/MICRO
-        elif index == 2:    
-            if self.parallelModes[1] == True:      
-                print "Phase = %f" %(Phase/MICRO)
-                return Phase/MICRO
-            else:      
-                print "Phase = %f" %(0.0)
-                return 0.0
-        elif index == 3:  
-            if self.parallelModes[1] == False: 
-                print "AntiPhase = %f"  %(Phase/MICRO)
-                return Phase/MICRO
-            else:        
-                print "AntiPhase = %f" %(0.0)
-                return 0.0
-            
+        Gap = Gap/MICRO
+        Phase = Phase/MICRO
+        if self.parallelModes[1] == True:
+            physicals = [Gap, Phase, 0.0]
+        else:
+            physicals = [Gap, 0.0, Phase]
+        return physicals
+
+    def calc_physical(self, index, pseudo_pos):
+        return self.calc_all_physical(pseudo_pos)[index - 1]
+
     def calc_pseudo(self, index, physical_pos):
         
         Gap = physical_pos[0]
@@ -1,5 +1,9 @@
+import collections
+import hashlib
 import math as m
 import numpy as np
+import os
+import tempfile
 import time
 import scipy
 import scipy.optimize
@@ -22,6 +26,324 @@ NCD= "NCD"
 XALOC = "XALOC"
 
 
+#################################################################################
+
+class LRUCache:
+    """ Bounded dictionary, when it is full the least recently used entry is
+    discarded.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        # move it to the end (most recently used)
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+#################################################################################
+
+def calculatePsiDifference(idc, G, Kz, Kx, XiSign, parallelMode=True):
+    """ Difference between the phases giving Kz and Kx at the gaps G (arrays),
+    and the phase giving Kz. The gap solving the inversion is its zero.
+    """
+    pCosZ = Kz/(idc.Az0*np.exp(idc.az1*G + idc.az2*G**2))
+    pSinX = Kx/(idc.Ax0*np.exp(idc.ax1*G + idc.ax2*G**2))
+    # If anti-parallel-mode the sin and cos appear with exponential 2
+    if parallelMode == False:
+        pCosZ = np.real(np.sqrt(pCosZ))
+        pSinX = np.real(np.sqrt(pSinX))
+    PSI_Z = XiSign*idc.LambdaU/m.pi*np.real(np.arccos(pCosZ))
+    PSI_X = idc.LambdaU/m.pi*np.real(np.arcsin(pSinX))
+    return PSI_Z - PSI_X, PSI_Z
+
+def _max(a, b):
+    return np.where(b > a, b, a)
+
+def calculateGapPhaseArray(idc, fEnergy, fPolarization, harm, offset,
+                           parallelMode=True, absVertical=False, strict=True):
+    """ INVERSE of many points at once: the bisection of calculateGapPhase
+    is done on numpy arrays, each point stops when it reaches ErrThreshold.
+
+    @param idc EnergyID or EnergyIDPlus with the constants of the ID
+    @param fEnergy, fPolarization arrays (or scalars, broadcasted)
+    @param strict if True an exception is raised if any point has no
+                  solution in [GapMin, GapMax], otherwise its gap and phase
+                  are NaN
+    @return arrays GAP, PSI (m)
+    """
+    fEnergy, fPolarization = np.broadcast_arrays(
+        np.asarray(fEnergy, dtype=float), np.asarray(fPolarization, dtype=float))
+    GAP = np.empty(fEnergy.shape)
+    GAP.fill(np.nan)
+    PSI = np.empty(fEnergy.shape)
+    PSI.fill(np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # We know energy and polarization and we calculate Kx, Kz
+        E1 = (fEnergy+offset)/harm
+        K = np.real(np.sqrt(4.0*HC*idc.Gamma**2/(idc.LambdaU*E1)-2.0))
+        Kx = K*np.sin(fPolarization)
+        Kz = K*np.cos(fPolarization)
+        XiSign = np.sign(Kx)
+
+        horizontal = Kx == 0 # linear horizontal
+        vertical = (Kz == 0) & ~horizontal # linear vertical
+        both = ~(horizontal | vertical)
+
+        GAP[horizontal] = idc.calculate_gz(alpha=Kz[horizontal]/idc.Az0)
+        PSI[horizontal] = 0
+        alpha = Kx[vertical]/idc.Ax0
+        if absVertical:
+            alpha = np.abs(alpha)
+        GAP[vertical] = idc.calculate_gx(alpha=alpha)
+        PSI[vertical] = 0.5*idc.LambdaU
+
+        kz, kx, xi = Kz[both], Kx[both], XiSign[both]
+        # set initial values
+        G_L = np.empty(kz.shape)
+        G_L.fill(idc.GapMin)
+        G_Hx = (-idc.ax1 - np.sqrt(idc.ax1**2 + 4.0*idc.ax2*np.log(np.abs(kx)/idc.Ax0)))/(2.0*idc.ax2)
+        G_Hz = (-idc.az1 - np.sqrt(idc.az1**2 + 4.0*idc.az2*np.log(np.abs(kz)/idc.Az0)))/(2.0*idc.az2)
+        # as min() and max() of the scalar version, a NaN in the second
+        # argument is ignored
+        G_H = np.where(G_Hx < G_Hz, G_Hx, G_Hz)
+        DIF_L = calculatePsiDifference(idc, G_L, kz, kx, xi, parallelMode)[0]
+        DIF_H = calculatePsiDifference(idc, G_H, kz, kx, xi, parallelMode)[0]
+
+        # bucle to find the positions
+        Err = _max(np.abs(DIF_L), np.abs(DIF_H))
+        G_New = np.empty(kz.shape)
+        G_New.fill(np.nan)
+        PSI_ZNew = np.empty(kz.shape)
+        PSI_ZNew.fill(np.nan)
+        # there is no solution for the points already below the threshold;
+        # each iteration works only on the points still iterating (n)
+        n = np.flatnonzero(Err > idc.ErrThreshold)
+        G_L, G_H, DIF_L, DIF_H = G_L[n], G_H[n], DIF_L[n], DIF_H[n]
+        kz, kx, xi = kz[n], kx[n], xi[n]
+        ct = 0
+        while len(n) and ct <= 1000:
+            ct += 1
+            G = 0.5*(G_L + G_H)
+            DIF_New, PSI_Z = calculatePsiDifference(idc, G, kz, kx, xi,
+                                                    parallelMode)
+            G_New[n] = G
+            PSI_ZNew[n] = PSI_Z
+            lower = DIF_New*DIF_L >= 0
+            # the intervals that can not be split any more would not change
+            # in the next iterations
+            stuck = (G == G_L) | (G == G_H)
+            G_L = np.where(lower, G, G_L)
+            DIF_L = np.where(lower, DIF_New, DIF_L)
+            G_H = np.where(lower, G_H, G)
+            DIF_H = np.where(lower, DIF_H, DIF_New)
+            Err = _max(np.abs(DIF_L), np.abs(DIF_H))
+            go_on = (Err > idc.ErrThreshold) & ~stuck
+            if not go_on.all():
+                n = n[go_on]
+                G_L, G_H, DIF_L, DIF_H = G_L[go_on], G_H[go_on], DIF_L[go_on], DIF_H[go_on]
+                kz, kx, xi = kz[go_on], kx[go_on], xi[go_on]
+        GAP[both] = G_New
+        PSI[both] = PSI_ZNew
+
+        # same checks as calculateGapPhase, per point
+        invalid = np.isnan(GAP) | (GAP > idc.GapMax) | (GAP < idc.GapMin)
+    if invalid.any():
+        if strict:
+            first = np.flatnonzero(invalid)[0]
+            str_aux = "Error, there is no solution in the gap range for %d of %d points (first: Energy = %.3f and Polarization = %.6f)" %(invalid.sum(), invalid.size, fEnergy.flat[first], fPolarization.flat[first])
+            raise Exception(str_aux)
+        GAP[invalid] = np.nan
+        PSI[invalid] = np.nan
+    return GAP, PSI
+
+
+#################################################################################
+
+class GapPhaseTable:
+    """ (Energy, Polarization) -> (Gap, Phase) table of an ID for one harmonic
+    (and parallel mode), solved once with calculateGapPhaseArray.
+
+    The grid is regular in log(K) (K of the energy, see calculateKfromEnergy)
+    and in polarization: the gap is close to linear in log(K), while it is
+    not in energy. The table does not depend on the energy offset.
+
+    The table is saved in the directory as a .npy file named after a hash of
+    the constants of the ID, and it is memory mapped when it is loaded again.
+    The inversions are interpolated from the table (bilinear), refined with
+    a few Newton steps of the direct model and checked with
+    calculateEnergyPolarization: if the result is not within the tolerances
+    (or the point is outside the table or close to a discontinuity of the
+    solutions) the exact calculateGapPhase is used.
+    """
+    VERSION = 1
+
+    def __init__(self, idc, harm, directory=None, nK=512, nPolarization=256,
+                 energyTolerance=0.01, polarizationTolerance=1E-5,
+                 newtonSteps=3):
+        self.idc = idc
+        self.harm = harm
+        self.parallelMode = getattr(idc, 'parallelMode', True)
+        self.directory = directory
+        self.nK = nK
+        self.nPolarization = nPolarization
+        self.energyTolerance = energyTolerance
+        self.polarizationTolerance = polarizationTolerance
+        self.newtonSteps = newtonSteps
+
+        # K range of the gap and phase ranges
+        GAP, PSI = np.meshgrid(np.linspace(idc.GapMin, idc.GapMax, 256),
+                               np.linspace(idc.PhaseMin, idc.PhaseMax, 256))
+        Kz, Kx = self.calculateK(GAP, PSI)
+        K = np.sqrt(Kz**2 + Kx**2)
+        K = K[K > 0]
+        self.logK = np.linspace(np.log(K.min()), np.log(K.max()), nK)
+        self.polarizations = np.linspace(-0.5*m.pi, 0.5*m.pi, nPolarization)
+        self.logKStep = self.logK[1] - self.logK[0]
+        self.polarizationStep = self.polarizations[1] - self.polarizations[0]
+        # cells whose gaps differ more are across a discontinuity
+        self.maxGapSpread = 8*(idc.GapMax - idc.GapMin)/nK
+
+        self.table = None
+        if directory:
+            self.table = self.load()
+        if self.table is None:
+            self.table = self.build()
+            if directory:
+                self.save()
+
+    def calculateK(self, GAP, PSI, exp=np.exp, cos=np.cos, sin=np.sin):
+        """ DIRECT model as calculateKfromGap (without side effects). The
+        math functions are used for scalars, they are much faster. """
+        idc = self.idc
+        Kz = (idc.Az0*exp(idc.az1*GAP + idc.az2*GAP**2))*cos(m.pi*PSI/idc.LambdaU)
+        Kx = (idc.Ax0*exp(idc.ax1*GAP + idc.ax2*GAP**2))*sin(m.pi*PSI/idc.LambdaU)
+        # If anti-parallel-mode the sin and cos appear with exponential 2
+        if self.parallelMode == False:
+            Kz = Kz*cos(m.pi*PSI/idc.LambdaU)
+            Kx = Kx*sin(m.pi*PSI/idc.LambdaU)
+        return Kz, Kx
+
+    def key(self):
+        idc = self.idc
+        constants = (self.VERSION, idc.LambdaU, idc.Ax0, idc.ax1, idc.ax2,
+                     idc.Az0, idc.az1, idc.az2, idc.Gamma, idc.GapMin,
+                     idc.GapMax, idc.PhaseMin, idc.PhaseMax,
+                     idc.ErrThreshold, self.harm, bool(self.parallelMode),
+                     self.nK, self.nPolarization)
+        return hashlib.md5(repr(constants)).hexdigest()
+
+    def filename(self):
+        return os.path.join(self.directory, 'GapPhase_%s.npy' % self.key())
+
+    def load(self):
+        filename = self.filename()
+        if not os.path.exists(filename):
+            return None
+        table = np.load(filename, mmap_mode='r')
+        if table.shape != (2, self.nK, self.nPolarization):
+            return None
+        return table
+
+    def build(self):
+        LK, P = np.meshgrid(self.logK, self.polarizations, indexing='ij')
+        K = np.exp(LK)
+        # energy with offset 0 giving K
+        E = self.harm*HC*(2.0*self.idc.Gamma**2)/(self.idc.LambdaU*(1.0+0.5*K**2))
+        GAP, PSI = self.idc.calculateGapPhaseArray(E, P, self.harm, 0,
+                                                   strict=False)
+        return np.array([GAP, PSI])
+
+    def save(self):
+        # written to a temporary file and renamed, so a table being written
+        # is never loaded
+        filename = self.filename()
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, self.table)
+            os.rename(tmp, filename)
+        except (IOError, OSError), e:
+            # the table is kept in memory
+            print "Could not save the gap and phase table %s: %s" %(filename, e)
+
+    def interpolate(self, K, fPolarization):
+        """ @return (Gap, Phase) interpolated from the table or None if the
+                    point is outside it or across a discontinuity """
+        if not K > 0:
+            return None
+        fi = (m.log(K) - self.logK[0])/self.logKStep
+        fj = (fPolarization - self.polarizations[0])/self.polarizationStep
+        i = int(m.floor(fi))
+        j = int(m.floor(fj))
+        if not (0 <= i < self.nK-1 and 0 <= j < self.nPolarization-1):
+            return None
+        (g00, g01), (g10, g11) = self.table[0, i:i+2, j:j+2].tolist()
+        (p00, p01), (p10, p11) = self.table[1, i:i+2, j:j+2].tolist()
+        gaps = (g00, g01, g10, g11)
+        # NaN (no solution) in any corner fails the comparison
+        if not max(gaps) - min(gaps) <= self.maxGapSpread:
+            return None
+        if m.isnan(p00 + p01 + p10 + p11):
+            return None
+        ti = fi - i
+        tj = fj - j
+        GAP = (1-ti)*((1-tj)*g00 + tj*g01) + ti*((1-tj)*g10 + tj*g11)
+        PSI = (1-ti)*((1-tj)*p00 + tj*p01) + ti*((1-tj)*p10 + tj*p11)
+        return GAP, PSI
+
+    def refine(self, GAP, PSI, Kz, Kx):
+        """ Newton steps of the direct model to the wanted Kz, Kx """
+        h = 1E-3*MICRO
+        f = lambda GAP, PSI: self.calculateK(GAP, PSI, m.exp, m.cos, m.sin)
+        for i in range(self.newtonSteps):
+            z0, x0 = f(GAP, PSI)
+            zg, xg = f(GAP + h, PSI)
+            zp, xp = f(GAP, PSI + h)
+            dzg, dzp = (zg - z0)/h, (zp - z0)/h
+            dxg, dxp = (xg - x0)/h, (xp - x0)/h
+            det = dzg*dxp - dzp*dxg
+            if det == 0:
+                break
+            rz, rx = Kz - z0, Kx - x0
+            GAP += (dxp*rz - dzp*rx)/det
+            PSI += (dzg*rx - dxg*rz)/det
+        return GAP, PSI
+
+    def calculateGapPhase(self, fEnergy = 0, fPolarization = 0, offset = 0):
+        idc = self.idc
+        E1 = (fEnergy+offset)/self.harm
+        K = m.sqrt(max(4.0*HC*idc.Gamma**2/(idc.LambdaU*E1)-2.0, 0.0))
+        solution = self.interpolate(K, fPolarization)
+        if solution is not None:
+            GAP, PSI = self.refine(solution[0], solution[1],
+                                   K*m.cos(fPolarization),
+                                   K*m.sin(fPolarization))
+            if idc.GapMin <= GAP <= idc.GapMax:
+                En, Pn = idc.calculateEnergyPolarization(GAP, PSI, self.harm, offset)
+                if (abs(En - fEnergy) <= self.energyTolerance and
+                        abs(Pn - fPolarization) <= self.polarizationTolerance):
+                    return GAP, PSI
+        return idc.calculateGapPhase(fEnergy, fPolarization, self.harm, offset)
+
+
 #################################################################################
 
 class EnergyID:
@@ -255,6 +577,12 @@ class EnergyID:
             raise
     
 
+    # INVERSE ## From arrays of Energy+Polarization to Gap in mm
+    def calculateGapPhaseArray(self, fEnergy, fPolarization, harm = 5, offset = 0, strict = True):
+        self.harm = harm
+        self.offset = offset
+        return calculateGapPhaseArray(self, fEnergy, fPolarization, harm, offset, strict=strict)
+
     # INVERSE #
     def calculateKfromEnergy(self,fEnergy,fPolarization):
         E1 = (fEnergy+self.offset)/self.harm
@@ -567,6 +895,14 @@ class EnergyIDPlus:
             raise
     
 
+    # INVERSE ## From arrays of Energy+Polarization to Gap in mm
+    def calculateGapPhaseArray(self, fEnergy, fPolarization, harm = 5, offset = 0, strict = True):
+        self.harm = harm
+        self.offset = offset
+        return calculateGapPhaseArray(self, fEnergy, fPolarization, harm, offset,
+                                      parallelMode=self.parallelMode,
+                                      absVertical=True, strict=strict)
+
     # INVERSE #
     def calculateKfromEnergy(self,fEnergy,fPolarization):
         E1 = (fEnergy+self.offset)/self.harm
@@ -0,0 +1,81 @@
+import unittest
+
+from PseudoEnergyID import PseudoEnergy, PseudoEnergyPlus
+
+PROPERTIES = {'id_name': 'CIRCE', 'pol_units': 'rad', 'cache_size': 16,
+              'gap_phase_table': ''}
+
+# physical positions (um)
+GAP = 30000.0
+PHASE = 5000.0
+
+
+class CountingLib(object):
+    """Counts the inversions solved by the library of the controller"""
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.inversions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.lib, name)
+
+    def calculateGapPhase(self, *args):
+        self.inversions += 1
+        return self.lib.calculateGapPhase(*args)
+
+
+class PseudoEnergyTestCase(unittest.TestCase):
+
+    def create(self):
+        ctrl = PseudoEnergy('test', dict(PROPERTIES))
+        for axis in (1, 2):
+            ctrl.harmonics[axis] = 1
+            ctrl.offsets[axis] = 0.0
+        return ctrl
+
+    def physicals(self):
+        return [GAP, PHASE]
+
+    def test_calc_physical(self):
+        ctrl = self.create()
+        physicals = self.physicals()
+        pseudos = [ctrl.calc_pseudo(1, physicals),
+                   ctrl.calc_pseudo(2, physicals)]
+        ctrl.lib = CountingLib(ctrl.lib)
+        gap = ctrl.calc_physical(1, pseudos)
+        phase = ctrl.calc_physical(2, pseudos)
+        self.assertAlmostEqual(gap, GAP, delta=1.0)
+        self.assertAlmostEqual(phase, PHASE, delta=1.0)
+        # the second motor uses the solution of the first one
+        self.assertEqual(ctrl.lib.inversions, 1)
+        self.assertEqual(ctrl.calc_all_physical(pseudos)[:2], [gap, phase])
+
+
+class PseudoEnergyPlusTestCase(PseudoEnergyTestCase):
+
+    def create(self, parallel=True):
+        ctrl = PseudoEnergyPlus('test', dict(PROPERTIES))
+        for axis in (1, 2, 3):
+            ctrl.harmonics[axis] = 1
+            ctrl.offsets[axis] = 0.0
+        ctrl.SetExtraAttributePar(1, 'parallelMode', parallel)
+        return ctrl
+
+    def physicals(self):
+        return [GAP, PHASE, 0.0]
+
+    def test_calc_physical_antiparallel(self):
+        ctrl = self.create(parallel=False)
+        physicals = [GAP, 0.0, PHASE]
+        pseudos = [ctrl.calc_pseudo(1, physicals),
+                   ctrl.calc_pseudo(2, physicals)]
+        self.assertEqual(ctrl.calc_physical(2, pseudos), 0.0)
+        self.assertAlmostEqual(ctrl.calc_physical(1, pseudos), GAP,
+                               delta=1.0)
+        self.assertAlmostEqual(ctrl.calc_physical(3, pseudos), PHASE,
+                               delta=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,100 @@
 """ The standard pseudo motor controller library for the device pool """
 
+import time
 import traceback
 import numpy
 from sardana.pool.controller import PseudoMotorController, Type, \
     Description, Access, DataAccess, Memorize, NotMemorized, DefaultValue
 
 
+# (gap, symmetry, offset, taper) to (z1, z2, z3, z4), without the offsets of
+# the motors, and its inverse
+GAPS_TO_Z = numpy.array([[0.5, -0.25, 1.0, -0.25],
+                         [0.5, 0.25, 1.0, 0.25],
+                         [-0.5, 0.25, 1.0, -0.25],
+                         [-0.5, -0.25, 1.0, 0.25]])
+Z_TO_GAPS = numpy.array([[0.5, 0.5, -0.5, -0.5],
+                         [-1.0, 1.0, 1.0, -1.0],
+                         [0.25, 0.25, 0.25, 0.25],
+                         [-1.0, 1.0, -1.0, 1.0]])
+
+
+def gaps_to_z(pseudos, offsets):
+    """(gap, symmetry, offset, taper) positions, one per row, to the
+    (z1, z2, z3, z4) positions of the motors with the given offsets"""
+    return numpy.dot(pseudos, GAPS_TO_Z.T) + offsets
+
+
+def z_to_gaps(physicals, offsets):
+    """(z1, z2, z3, z4) positions, one per row, of the motors with the given
+    offsets to the (gap, symmetry, offset, taper) positions"""
+    return numpy.dot(numpy.subtract(physicals, offsets), Z_TO_GAPS.T)
+
+
+class RateLimitedLog(object):
+    """
+    Debug messages of the hot paths (e.g. the positions calculated on every
+    event): each kind of message is logged at most once per period, with the
+    number of messages of the same kind discarded since the previous one.
+    """
+
+    def __init__(self, log, period=1.0):
+        self.log = log
+        self.period = period
+        self.kinds = {}
+
+    def debug(self, kind, msg, *args):
+        now = time.time()
+        last, discarded = self.kinds.get(kind, (0, 0))
+        if now - last < self.period:
+            self.kinds[kind] = (last, discarded + 1)
+            return
+        self.kinds[kind] = (now, 0)
+        msg = '%s: ' % kind + msg % args
+        if discarded:
+            msg += ' (%d discarded)' % discarded
+        self.log.debug(msg)
+
+
+class AveragedMotorPars(object):
+    """
+    Average of the parameters (velocity, acceleration...) of the physical
+    motors of a controller. Each parameter is read from the motors once and
+    read again after any of them reports a change of it.
+    """
+
+    def __init__(self, ctrl, nmotors):
+        self.ctrl = ctrl
+        self.nmotors = nmotors
+        self.values = {}
+        self.motors = None
+        self.subscribed = False
+
+    def subscribe(self):
+        self.motors = [self.ctrl.GetMotor(i) for i in range(self.nmotors)]
+        try:
+            for motor in self.motors:
+                motor.add_listener(self.on_motor_change)
+            self.subscribed = True
+        except Exception, e:
+            self.ctrl._log.debug('Motor parameters will not be cached: %s' % e)
+
+    def on_motor_change(self, evt_src, evt_type, evt_value):
+        self.values.pop(evt_type.get_name().lower(), None)
+
+    def get(self, name):
+        value = self.values.get(name.lower())
+        if value is not None:
+            return value
+        if self.motors is None:
+            self.subscribe()
+        value = numpy.average([motor.get_par(name) for motor in self.motors])
+        self.ctrl._log.debug('The attr %s is %s' % (name, value))
+        if self.subscribed:
+            self.values[name.lower()] = value
+        return value
+
+
 class PseudoAppleII(PseudoMotorController):
     """ """
     
@@ -37,70 +126,47 @@ class PseudoAppleII(PseudoMotorController):
         self.Velocity = {}
         self.Base_rate = {}
 
+        self.trace = RateLimitedLog(self._log)
+        self.motor_pars = AveragedMotorPars(self, len(self.motor_roles))
+
+    def get_offsets(self):
+        return [self.offsets[1], self.offsets[2], self.offsets[3],
+                self.offsets[4]]
+
     def CalcPhysical(self, index, pseudo_pos, curr_physical_pos):
         return self.CalcAllPhysical(pseudo_pos, curr_physical_pos)[index-1]
 
     def CalcAllPhysical(self, pseudo_pos, curr_physical_pos):
-        gap = pseudo_pos[0]
-        symmetry = pseudo_pos[1]
-        offset = pseudo_pos[2]
-        taper = pseudo_pos[3]
-        print "PM:", gap, symmetry, offset, taper
+        self.trace.debug('PM', '%s %s %s %s', *pseudo_pos[:4])
+        physical = self.calc_all_physical_array(pseudo_pos[:4])
+        return tuple(physical.tolist())
         
-        Z10 = self.offsets[1]
-        Z20 = self.offsets[2]
-        Z30 = self.offsets[3]
-        Z40 = self.offsets[4]
-
+    def calc_all_physical_array(self, pseudo_pos):
+        """CalcAllPhysical of an array of positions, one per row"""
+        pseudo_pos = numpy.array(pseudo_pos, dtype=float)
         #FB for exit of a sw stop
-        if self.AlwaysZero[2] == True:
-            symmetry = 0.0
-        if self.AlwaysZero[3] == True:
-            offset = 0.0
-        if self.AlwaysZero[4] == True:
-            taper = 0.0
-        z1 = Z10 + gap/2.0 + offset - taper/4.0 - symmetry/4.0
-        z2 = Z20 + gap/2.0 + offset + taper/4.0 + symmetry/4.0
-        z3 = Z30 - gap/2.0 + offset - taper/4.0 + symmetry/4.0
-        z4 = Z40 - gap/2.0 + offset + taper/4.0 - symmetry/4.0
-        return (z1, z2, z3, z4)
+        for index in (2, 3, 4):
+            if self.AlwaysZero[index] == True:
+                pseudo_pos[..., index-1] = 0.0
+        return gaps_to_z(pseudo_pos, self.get_offsets())
 
     def CalcPseudo(self, index, physical_pos, curr_pseudo_pos):
         return self.CalcAllPseudo(physical_pos, curr_pseudo_pos)[index-1]
 
     def CalcAllPseudo(self, physical_pos, curr_pseudo_pos):
-        Z10 = self.offsets[1]
-        Z20 = self.offsets[2]
-        Z30 = self.offsets[3]
-        Z40 = self.offsets[4]
-        z1 = physical_pos[0] - Z10
-        z2 = physical_pos[1] - Z20
-        z3 = physical_pos[2] - Z30
-        z4 = physical_pos[3] - Z40
-
-        gap = (z1+z2)/2.0 - (z3+z4)/2.0
-        offset = (z1+z2)/4.0 + (z3+z4)/4.0
-        taper = (z2-z1)-(z3-z4)
-        symmetry = (z2 - z1) + (z3 - z4)
-
-        return (gap, symmetry, offset, taper)
+        pseudo = self.calc_all_pseudo_array(physical_pos[:4])
+        return tuple(pseudo.tolist())
+
+    def calc_all_pseudo_array(self, physical_pos):
+        """CalcAllPseudo of an array of positions, one per row"""
+        return z_to_gaps(physical_pos, self.get_offsets())
 
     def read_all_motors(self,name):
         try:
-            m1 = self.GetMotor(0)
-            m2 = self.GetMotor(1)
-            m3 = self.GetMotor(2)
-            m4 = self.GetMotor(3)
-            a1 = m1.get_par(name)
-            a2 = m2.get_par(name)
-            a3 = m3.get_par(name)
-            a4 = m4.get_par(name)
-            a = numpy.average([a1,a2,a3,a4])
-            print "The attr ", name, " is ", a
-            return a
+            return self.motor_pars.get(name)
         except Exception,e:
-            print "Err in read ", name, str(e)
-            traceback.print_exc()
+            self._log.error('Err in read %s: %s' % (name, e))
+            self._log.debug(traceback.format_exc())
 
     def GetExtraAttributePar(self, ind, name):
         if name == "Offset":
@@ -130,7 +196,7 @@ class PseudoAppleII(PseudoMotorController):
 
     def SetExtraAttributePar(self, ind, name, value):
         try:
-            print "Set Gaps",ind,name,value
+            self._log.debug('Set Gaps %s %s %s' % (ind, name, value))
             if name == "Offset":
                 self.offsets[ind] = value
             elif name == "AlwaysZero":
@@ -144,7 +210,7 @@ class PseudoAppleII(PseudoMotorController):
             elif name == "Base_rate":
                 self.Base_rate[ind] = value
         except Exception as e:
-            print "PseudoAppleII Exception", e
+            self._log.error('PseudoAppleII Exception %s' % e)
 
 
 class PseudoPhaseAppleII(PseudoMotorController):
@@ -180,6 +246,8 @@ class PseudoPhaseAppleII(PseudoMotorController):
         self.Velocity = {}
         self.Base_rate = {}
 
+        self.motor_pars = AveragedMotorPars(self, len(self.motor_roles))
+
     def calc_physical(self,index,pseudo_pos):
         phase = pseudo_pos[0]
         antiphase = pseudo_pos[1]
@@ -218,16 +286,10 @@ class PseudoPhaseAppleII(PseudoMotorController):
 
     def read_all_motors(self, name):
         try:
-            m1 = self.GetMotor(0)
-            m2 = self.GetMotor(1)
-            a1 = m1.get_par(name)
-            a2 = m2.get_par(name)
-            a = numpy.average([a1,a2])
-            print "The attr ", name, " is = ", a
-            return a
+            return self.motor_pars.get(name)
         except Exception,e:
-            print "Err in read ", name, str(e)
-            traceback.print_exc()
+            self._log.error('Err in read %s: %s' % (name, e))
+            self._log.debug(traceback.format_exc())
         
     def GetExtraAttributePar(self, ind, name):
         if name == "Offset":
@@ -251,7 +313,7 @@ class PseudoPhaseAppleII(PseudoMotorController):
 
     def SetExtraAttributePar(self, ind, name, value):
         try:
-            print "Set Phases", ind, name, value
+            self._log.debug('Set Phases %s %s %s' % (ind, name, value))
             if name == "Offset":
                 self.offsets[ind] = value
             elif name == "Acceleration":
@@ -263,4 +325,4 @@ class PseudoPhaseAppleII(PseudoMotorController):
             elif name == "Base_rate":
                 self.Base_rate[ind] = value
         except Exception,e:
-            print "PseudoPhaseAppleII Exception"
+            self._log.error('PseudoPhaseAppleII Exception %s' % e)
@@ -0,0 +1,235 @@
+##############################################################################
+##
+## This file is part of Sardana
+##
+## http://www.tango-controls.org/static/sardana/latest/doc/html/index.html
+##
+## Copyright 2011 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+## Sardana is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Sardana is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with Sardana.  If not, see <http://www.gnu.org/licenses/>.
+##
+##############################################################################
+
+"""Precalculation of the physical trajectories of a pseudo motor controller
+(e.g. E_Bragg_PMController, TripodTableController or the BL29 controllers)
+before a continuous scan: all the points are converted at once, checked
+against the limits of the motors and the velocity profiles are calculated,
+so an unreachable point is found before starting the scan.
+
+The controllers with array methods (calc_all_physical_array) convert the
+whole trajectory in one call; for the others the points are converted one by
+one, optionally split between several worker processes.
+"""
+
+import multiprocessing
+
+import numpy
+
+NOT_SPECIFIED = 'Not specified'
+
+# errors of a point the controller can not calculate (e.g. math domain
+# error, or division by zero), it becomes nan. Any other error is raised.
+CALC_ERRORS = (ValueError, ArithmeticError)
+
+# controller used by the worker processes, they get it when forked
+_worker_ctrl = None
+_worker_current = None
+
+
+def _old_api(ctrl):
+    """True if the controller implements calc_all_physical (the base class
+    of Sardana only implements it as a fallback of CalcAllPhysical)"""
+    for klass in type(ctrl).__mro__:
+        if 'calc_all_physical' in vars(klass):
+            return not klass.__module__.startswith('sardana')
+    return False
+
+
+def _calc_point(ctrl, pseudo, current_physicals):
+    """Physical positions of one point, None if the controller can not
+    calculate them"""
+    try:
+        if _old_api(ctrl):
+            physical = ctrl.calc_all_physical(list(pseudo))
+        else:
+            physical = ctrl.CalcAllPhysical(list(pseudo), current_physicals)
+        return numpy.atleast_1d(numpy.asarray(physical, dtype=float))
+    except CALC_ERRORS, e:
+        log = getattr(ctrl, '_log', None)
+        if log is not None:
+            log.debug('No physical positions for %s: %r' % (list(pseudo), e))
+        return None
+
+
+def _calc_points(ctrl, pseudos, current_physicals):
+    physicals = [_calc_point(ctrl, pseudo, current_physicals)
+                 for pseudo in pseudos]
+    nmotors = max([len(p) for p in physicals if p is not None] or
+                  [len(getattr(ctrl, 'motor_roles', ()))])
+    result = numpy.empty((len(pseudos), nmotors))
+    for i, physical in enumerate(physicals):
+        result[i] = numpy.nan if physical is None else physical
+    return result
+
+
+def _init_worker(ctrl, current_physicals):
+    global _worker_ctrl, _worker_current
+    _worker_ctrl = ctrl
+    _worker_current = current_physicals
+
+
+def _calc_chunk(pseudos):
+    return _calc_points(_worker_ctrl, pseudos, _worker_current)
+
+
+def _calc_parallel(ctrl, pseudos, current_physicals, processes):
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (ctrl, current_physicals))
+    try:
+        chunks = pool.map(_calc_chunk,
+                          numpy.array_split(pseudos, 4 * processes))
+    finally:
+        pool.close()
+        pool.join()
+    nmotors = max([chunk.shape[1] for chunk in chunks])
+    for i, chunk in enumerate(chunks):
+        if chunk.shape[1] < nmotors:
+            # chunks without any valid point
+            chunks[i] = numpy.nan * numpy.empty((len(chunk), nmotors))
+    return numpy.vstack(chunks)
+
+
+def calc_physical_trajectory(ctrl, pseudos, current_physicals=None,
+                             processes=0):
+    """Convert a pseudo trajectory to the physical one.
+    @param ctrl pseudo motor controller (old or new API)
+    @param pseudos (N, k) array of pseudo positions (or N positions if there
+           is only one pseudo motor)
+    @param current_physicals physical positions at the beginning of the
+           trajectory, given to CalcAllPhysical for all the points
+    @param processes number of worker processes used to convert the points
+           one by one (0 converts them in this process). The workers are
+           forked with the controller, so they should only be used with
+           controllers whose calculation does not access Tango devices.
+    @return (N, m) array of physical positions, with nan in the points
+            the controller could not convert
+    """
+    pseudos = numpy.asarray(pseudos, dtype=float)
+    if pseudos.ndim == 1:
+        pseudos = pseudos.reshape(-1, 1)
+    calc_array = getattr(ctrl, 'calc_all_physical_array', None)
+    if calc_array is not None:
+        physicals = numpy.asarray(calc_array(pseudos), dtype=float)
+        return physicals.reshape(len(pseudos), -1)
+    if processes <= 0 or len(pseudos) < 2 * processes:
+        physicals = _calc_points(ctrl, pseudos, current_physicals)
+    else:
+        physicals = _calc_parallel(ctrl, pseudos, current_physicals,
+                                   processes)
+    if len(pseudos) and not physicals.shape[1]:
+        raise Exception('No point of the trajectory can be calculated')
+    return physicals
+
+
+def read_limits(motors):
+    """Read the limits of the position of the motors (or pseudo motors).
+    @param motors names of the motors
+    @return list of (min, max) pairs, None where the limit is not specified
+    """
+    import PyTango
+    limits = []
+    for name in motors:
+        config = PyTango.AttributeProxy(name + '/position').get_config()
+        limit = []
+        for value in (config.min_value, config.max_value):
+            if value == NOT_SPECIFIED:
+                limit.append(None)
+            else:
+                limit.append(float(value))
+        limits.append(tuple(limit))
+    return limits
+
+
+def check_limits(physicals, limits, names=None):
+    """Check that all the points of the physical trajectory are reachable.
+    @param physicals (N, m) array of physical positions
+    @param limits sequence of m (min, max) pairs, None where there is no limit
+    @param names of the m motors (for the error messages)
+    @throws Exception with the first wrong point of each motor
+    """
+    physicals = numpy.asarray(physicals, dtype=float)
+    if names is None:
+        names = ['motor %d' % (i + 1) for i in range(physicals.shape[1])]
+    errors = []
+    for i, (name, (min_, max_)) in enumerate(zip(names, limits)):
+        positions = physicals[:, i]
+        wrong = numpy.isnan(positions)
+        with numpy.errstate(invalid='ignore'):
+            if min_ is not None:
+                wrong |= positions < min_
+            if max_ is not None:
+                wrong |= positions > max_
+        if wrong.any():
+            point = numpy.flatnonzero(wrong)[0]
+            errors.append('%s: %d points out of [%s, %s] (first: point %d '
+                          'at %s)' % (name, wrong.sum(), min_, max_, point,
+                                      positions[point]))
+    if errors:
+        raise Exception('Unreachable trajectory:\n' + '\n'.join(errors))
+
+
+def velocity_profiles(physicals, times):
+    """Velocities of the motors between the points of the trajectory.
+    @param physicals (N, m) array of physical positions
+    @param times N times of the points or the time between two points
+    @return (N-1, m) array of velocities (position units per time unit)
+    """
+    physicals = numpy.asarray(physicals, dtype=float)
+    if numpy.isscalar(times):
+        intervals = float(times)
+    else:
+        intervals = numpy.diff(numpy.asarray(times, dtype=float))[:, None]
+    return numpy.diff(physicals, axis=0) / intervals
+
+
+def precalculate_trajectory(ctrl, pseudos, times, limits=None, names=None,
+                            max_velocities=None, current_physicals=None,
+                            processes=0):
+    """Calculate and check the physical trajectory of a continuous scan.
+    @param ctrl, pseudos, current_physicals, processes as in
+           calc_physical_trajectory
+    @param times N times of the points or the time between two points
+    @param limits, names as in check_limits (not checked if None)
+    @param max_velocities of the physical motors (None if not checked)
+    @return ((N, m) physical positions, (N-1, m) velocities)
+    @throws Exception if a point is unreachable or too fast
+    """
+    physicals = calc_physical_trajectory(ctrl, pseudos, current_physicals,
+                                         processes)
+    if limits is None:
+        limits = [(None, None)] * physicals.shape[1]
+    check_limits(physicals, limits, names)
+    velocities = velocity_profiles(physicals, times)
+    if max_velocities is not None:
+        if names is None:
+            names = ['motor %d' % (i + 1) for i in range(physicals.shape[1])]
+        errors = []
+        for name, speeds, max_ in zip(names, numpy.abs(velocities).T,
+                                      max_velocities):
+            if max_ is not None and len(speeds) and speeds.max() > max_:
+                errors.append('%s: velocity %s over %s (point %d)' %
+                              (name, speeds.max(), max_, speeds.argmax()))
+        if errors:
+            raise Exception('Trajectory too fast:\n' + '\n'.join(errors))
+    return physicals, velocities
@@ -0,0 +1,99 @@
+import math
+import unittest
+
+import numpy
+
+from PseudoMotorTrajectoryLib import (calc_physical_trajectory, check_limits,
+                                      velocity_profiles,
+                                      precalculate_trajectory)
+
+
+class BraggCtrl(object):
+    """New API controller: energy (keV) to Bragg angle (deg)"""
+
+    motor_roles = ('Bragg',)
+
+    def CalcAllPhysical(self, pseudos, curr_physicals):
+        energy, = pseudos
+        return math.degrees(math.asin(12.398419 / (2 * 3.1356 * energy)))
+
+
+class SlitCtrl(object):
+    """Old API controller: gap and offset to two blades"""
+
+    def calc_all_physical(self, pseudos):
+        gap, offset = pseudos
+        return (offset + gap / 2.0, offset - gap / 2.0)
+
+    def calc_all_physical_array(self, pseudos):
+        pseudos = numpy.asarray(pseudos)
+        return numpy.column_stack((pseudos[:, 1] + pseudos[:, 0] / 2.0,
+                                   pseudos[:, 1] - pseudos[:, 0] / 2.0))
+
+
+class DeviceCtrl(BraggCtrl):
+    """Controller failing to read a device"""
+
+    def CalcAllPhysical(self, pseudos, curr_physicals):
+        raise RuntimeError('device not available')
+
+
+class TrajectoryTestCase(unittest.TestCase):
+
+    def test_points(self):
+        energies = numpy.linspace(1.5, 20, 50)
+        physicals = calc_physical_trajectory(BraggCtrl(), energies)
+        self.assertEqual(physicals.shape, (50, 1))
+        # below 1.977 keV there is no reflection
+        self.assertTrue(numpy.isnan(physicals[:2]).all())
+        self.assertFalse(numpy.isnan(physicals[2:]).any())
+        self.assertAlmostEqual(physicals[-1, 0], 5.6729, 3)
+
+    def test_errors(self):
+        # only the points the controller can not calculate are nan
+        self.assertRaises(RuntimeError, calc_physical_trajectory,
+                          DeviceCtrl(), [10.0])
+
+    def test_processes(self):
+        energies = numpy.linspace(1.5, 20, 200)
+        self.assertTrue(numpy.allclose(
+                calc_physical_trajectory(BraggCtrl(), energies, processes=2),
+                calc_physical_trajectory(BraggCtrl(), energies),
+                equal_nan=True))
+
+    def test_array(self):
+        pseudos = numpy.column_stack((numpy.linspace(1, 2, 11),
+                                      numpy.zeros(11)))
+        physicals = calc_physical_trajectory(SlitCtrl(), pseudos)
+        self.assertTrue(numpy.allclose(physicals[:, 0], -physicals[:, 1]))
+        self.assertTrue(numpy.allclose(physicals[-1], [1, -1]))
+
+    def test_limits(self):
+        physicals = numpy.array([[0, 1], [1, 2], [2, numpy.nan]])
+        check_limits(physicals[:, :1], [(0, 2)], ['m1'])
+        self.assertRaises(Exception, check_limits, physicals,
+                          [(0, 1.5), (None, None)])
+        self.assertRaises(Exception, check_limits, physicals,
+                          [(None, None), (None, None)])
+
+    def test_velocities(self):
+        physicals = numpy.array([[0, 0], [1, 2], [3, 2]], dtype=float)
+        self.assertTrue(numpy.allclose(velocity_profiles(physicals, 0.5),
+                                       [[2, 4], [4, 0]]))
+        self.assertTrue(numpy.allclose(velocity_profiles(physicals,
+                                                         [0, 1, 3]),
+                                       [[1, 2], [1, 0]]))
+
+    def test_precalculate(self):
+        pseudos = numpy.column_stack((numpy.linspace(1, 2, 11),
+                                      numpy.zeros(11)))
+        physicals, velocities = precalculate_trajectory(
+                SlitCtrl(), pseudos, 0.1, [(0, 1), (-1, 0)],
+                max_velocities=[0.6, 0.6])
+        self.assertEqual(velocities.shape, (10, 2))
+        self.assertRaises(Exception, precalculate_trajectory, SlitCtrl(),
+                          pseudos, 0.1, max_velocities=[0.1, 0.1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,8 +22,10 @@
 ##############################################################################
 
 #import time
+import struct
 
 from sardana import State
+from sardana.pool import AcqSynch
 from sardana.pool.controller import TwoDController
 from sardana.pool.controller import Type, MaxDimSize
 
@@ -86,6 +88,19 @@ class LimaTwoDController(TwoDController):
             'R/W Type': 'READ',
             'Description': 'Image Id of last acquired image',
             },
+        'FloatImage': {
+            'Type': bool,
+            'R/W Type': 'READ_WRITE',
+            'Description': 'Return the images as float32 instead of their '
+                           'native type',
+            'Defaultvalue': False},
+        'MaxFramesPerRead': {
+            'Type': int,
+            'R/W Type': 'READ_WRITE',
+            'Description': 'Maximum number of frames returned by a read in '
+                           'hardware triggered acquisitions (the rest are '
+                           'kept in the Lima buffer for the next reads)',
+            'Defaultvalue': 16},
         }
 
     ctrl_properties = {
@@ -103,23 +118,62 @@ class LimaTwoDController(TwoDController):
 
     BufferSize = 1024, 1024
 
+    MaxFramesPerRead = 16
+    # command reading several frames at once (not in all Lima versions)
+    ReadSeqCmd = 'readImageSeq'
+
+    # image_sizes: sign, depth (bytes), width, height
+    ImageTypes = {(0, 1): numpy.uint8, (0, 2): numpy.uint16,
+                  (0, 4): numpy.uint32, (1, 1): numpy.int8,
+                  (1, 2): numpy.int16, (1, 4): numpy.int32}
+
     def __init__(self, inst, props, *args, **kwargs):
         TwoDController.__init__(self, inst, props, *args, **kwargs)
         self._log.debug('Detector device: %s' % self.DetectorDevice)
         self.det = PyTango.DeviceProxy(self.DetectorDevice)
         self.det.write_attribute('saving_mode', 'MANUAL')
+        # image type and shape, read once per acquisition
+        self.image_format = None
+        self.float_image = {}
+        self.max_frames = {}
+        self._synchronization = AcqSynch.SoftwareTrigger
+        self.repetitions = 1
+        self.last_image_read = -1
+        self.frames_pending = False
+        self.read_seq = self.ReadSeqCmd in self.det.get_command_list()
+
+    def _getImageFormat(self):
+        if self.image_format is None:
+            sign, depth, width, height = \
+                self.det.read_attribute('image_sizes').value
+            dtype = self.ImageTypes.get((sign, depth))
+            if dtype is None:
+                raise ValueError('Unsupported image type: sign %d, depth %d '
+                                 'bytes' % (sign, depth))
+            self.image_format = dtype, (width, height)
+        return self.image_format
 
     def GetAxisAttributes(self, axis):
         # We fit the MaxDimSize to the actual image size
-        size = self.det.read_attribute('image_sizes').value
+        self.image_format = None
+        size = self._getImageFormat()[1]
         attrs = super(LimaTwoDController, self).GetAxisAttributes(axis)
-        attrs['Value'][MaxDimSize] = tuple(size[2:4])
+        attrs['Value'][MaxDimSize] = tuple(size)
         return attrs
 
     def StateOne(self, axis):
         limaState = self.det.read_attribute('acq_status').value
         self._log.debug('SateOne [%s]' % limaState)
         if limaState == 'Ready':
+            if self.frames_pending:
+                # the acquisition may have ended with less frames
+                last = self.det.read_attribute('last_image_ready').value
+                if self.last_image_read < last:
+                    return State.Running, 'The frames are not read yet'
+                if last < self.repetitions - 1:
+                    self._log.warning('Only %d of %d frames acquired' %
+                                      (last + 1, self.repetitions))
+                self.frames_pending = False
             return State.Standby, limaState
         elif limaState == 'Running':
             return State.Running, limaState
@@ -130,23 +184,64 @@ class LimaTwoDController(TwoDController):
 
     def ReadOne(self, axis):
         self._log.debug('ReadOne')
-        dataSize = self.det.read_attribute('image_sizes').value
+        if self._synchronization == AcqSynch.HardwareTrigger:
+            return self._readNewFrames(axis)
+        dtype, shape = self._getImageFormat()
         data = self.det.command_inout('getImage', 0)
-        if dataSize[1] == 2:
-            data.dtype = 'uint16'
-        elif dataSize[1] == 4:
-            data.dtype = 'uint32'
-        data.resize(dataSize[2], dataSize[3])
-
-        img = numpy.float32(data)
-        self._log.debug('Image data min %f max %f' % (img.min(), img.max()))
+        # view of the received buffer, without copying it
+        img = data.view(dtype).reshape(shape)
+
+        if self.float_image.get(axis, False):
+            img = img.astype(numpy.float32)
+        self._log.debug('Image data %s %s' % (img.dtype, img.shape))
         return img
 
+    def _readNewFrames(self, axis):
+        """Read all the frames acquired since the previous read (up to
+        MaxFramesPerRead) in a (n, width, height) array"""
+        last = self.det.read_attribute('last_image_ready').value
+        first = self.last_image_read + 1
+        if last < first:
+            return []
+        last = min(last, first + self.max_frames.get(axis,
+                                                     self.MaxFramesPerRead) - 1)
+        dtype, shape = self._getImageFormat()
+        nframes = last - first + 1
+        if self.read_seq:
+            # DATA_ARRAY encoded: the size of its header, then the frames
+            data = self.det.command_inout(self.ReadSeqCmd, [first, last + 1])
+            data = data[1]
+            header_size = struct.unpack_from('<H', data, 6)[0]
+            frames = numpy.frombuffer(data, dtype, offset=header_size)
+            frame_size = shape[0] * shape[1]
+            if frames.size < nframes * frame_size:
+                received = frames.size / frame_size
+                raise RuntimeError('%s returned %d of the frames %d to %d, '
+                                   'the frames %d to %d are lost' %
+                                   (self.ReadSeqCmd, received, first, last,
+                                    first + received, last))
+            frames = frames[:nframes * frame_size]
+            frames = frames.reshape((nframes,) + shape)
+        else:
+            frames = numpy.empty((nframes,) + shape, dtype)
+            for i in range(nframes):
+                data = self.det.command_inout('getImage', first + i)
+                frames[i] = data.view(dtype).reshape(shape)
+        self.last_image_read = last
+        self._log.debug('Read frames %d to %d' % (first, last))
+        if self.float_image.get(axis, False):
+            frames = frames.astype(numpy.float32)
+        return frames
+
     def ReadAll(self):
         pass
 
     def PreStartOne(self, axis, position=None):
         self._log.debug("Prepare")
+        self.image_format = None
+        self.last_image_read = -1
+        self.frames_pending = \
+            self._synchronization == AcqSynch.HardwareTrigger
         try:
             self.det.prepareAcq()
         except:
@@ -161,14 +256,24 @@ class LimaTwoDController(TwoDController):
         self._log.debug("Start Acq")
         self.det.startAcq()
 
-    def LoadOne(self, axis, value):
+    def LoadOne(self, axis, value, repetitions=1):
         self.det.write_attribute('acq_expo_time', value)
+        if self._synchronization == AcqSynch.HardwareTrigger:
+            self.repetitions = repetitions
+            self.det.write_attribute('acq_nb_frames', repetitions)
 
     def AbortOne(self, axis):
+        self.frames_pending = False
         self.det.stopAcq()
 
     def SetAxisExtraPar(self, axis, name, value):
-        if name == 'ExposureTime':
+        # the image type or size may change with the configuration
+        self.image_format = None
+        if name == 'FloatImage':
+            self.float_image[axis] = value
+        elif name == 'MaxFramesPerRead':
+            self.max_frames[axis] = max(1, value)
+        elif name == 'ExposureTime':
             self.det.write_attribute('acq_expo_time', value)
         elif name == 'LatencyTime':
             self.det.write_attribute('latency_time', value)
@@ -196,7 +301,11 @@ class LimaTwoDController(TwoDController):
             self.det.write_attribute('saving_next_number', value)
 
     def GetAxisExtraPar(self, axis, name):
-        if name == 'ExposureTime':
+        if name == 'FloatImage':
+            return self.float_image.get(axis, False)
+        elif name == 'MaxFramesPerRead':
+            return self.max_frames.get(axis, self.MaxFramesPerRead)
+        elif name == 'ExposureTime':
             value = self.det.read_attribute('acq_expo_time').value
             self._log.debug('ExposureTime: %s' % value)
             return value
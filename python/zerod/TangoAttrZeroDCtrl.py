@@ -6,12 +6,23 @@ from sardana.pool.controller import ZeroDController
 from sardana.pool.controller import Type, Access, Description
 from sardana.pool import PoolUtil
 
+try:
+    # TangoAttrLib is in the countertimer directory, without it in the
+    # PoolPath the devices are read one after the other, the formulas are
+    # evaluated every time with eval and the event mode is not available
+    from TangoAttrLib import (FormulaEngine, AttributeEventCache, to_value,
+                              read_attributes_concurrently)
+except ImportError:
+    FormulaEngine = AttributeEventCache = None
+
 TANGO_ATTR = 'TangoAttribute'
 FORMULA = 'Formula'
 DEVICE = 'Device'
 ATTRIBUTE = 'Attribute'
 EVALUATED_VALUE = 'Evaluated_value'
 INDEX_READ_ALL = 'Index_read_all'
+EVENT_TYPE = 'EventType'
+EVENT_MAX_AGE = 'EventMaxAge'
 
 
 class ReadTangoAttributes():
@@ -32,6 +43,18 @@ class ReadTangoAttributes():
             Description: 'The Formula to get the desired value.\n'\
                 ' e.g. "math.sqrt(VALUE)"',
             Access: DataAccess.ReadWrite
+        },
+        EVENT_TYPE: {
+            Type: str,
+            Description: 'Take the value from "change" or "periodic" events'\
+                ' instead of reading it (empty to always read it)',
+            Access: DataAccess.ReadWrite
+        },
+        EVENT_MAX_AGE: {
+            Type: float,
+            Description: 'Max age (s) of the event value, if older it is'\
+                ' read (0 for no limit)',
+            Access: DataAccess.ReadWrite
         }
     }
 
@@ -41,24 +64,49 @@ class ReadTangoAttributes():
         self.devices_to_read = {}
         self.axis_to_update = {}
         self.devs_values = []
+        self.formulas = None
+        self.events = None
+        if FormulaEngine is not None:
+            self.formulas = FormulaEngine(globals())
+            self.events = AttributeEventCache()
+        self.event_values = {}
 
     def add_device(self, axis):
         self._log.debug('AddDevice %d' % axis)
+        if self.events is not None:
+            self.events.log = self._log
         self.devsExtraAttributes[axis] = {}
         self.devsExtraAttributes[axis][FORMULA] = 'VALUE'
         self.devsExtraAttributes[axis][TANGO_ATTR] = None
         self.devsExtraAttributes[axis][EVALUATED_VALUE] = None
+        self.devsExtraAttributes[axis][EVENT_TYPE] = ''
+        self.devsExtraAttributes[axis][EVENT_MAX_AGE] = 0.0
+        if self.formulas is not None:
+            self.formulas.set_formula(axis, 'VALUE')
 
     def delete_device(self, axis):
         del self.devsExtraAttributes[axis]
+        if self.formulas is not None:
+            self.formulas.remove(axis)
+            self.events.unsubscribe(axis)
 
     def state_one(self, axis):
         return (State.On, 'Always ON, just reading external Tango Attribute')
 
     def pre_read_all(self):
         self.devices_to_read = {}
+        self.event_values = {}
 
     def pre_read_one(self, axis):
+        # in event mode take the last pushed value, if not too old
+        if self.events is not None and \
+                self.devsExtraAttributes[axis][EVENT_TYPE]:
+            tango_attr = self.devsExtraAttributes[axis][TANGO_ATTR]
+            max_age = self.devsExtraAttributes[axis][EVENT_MAX_AGE]
+            value = self.events.get(tango_attr, max_age)
+            if value is not None:
+                self.event_values[tango_attr] = value
+                return
         dev = self.devsExtraAttributes[axis][DEVICE]
         attr = self.devsExtraAttributes[axis][ATTRIBUTE]
         if not self.devices_to_read.has_key(dev):
@@ -68,6 +116,49 @@ class ReadTangoAttributes():
         self.devsExtraAttributes[axis][INDEX_READ_ALL] = index
 
     def read_all(self):
+        if self.formulas is None:
+            self.read_all_eval()
+            return
+        for tango_attr, VALUE in self.event_values.iteritems():
+            results = self.formulas.evaluate_attribute(tango_attr,
+                                                       to_value(VALUE))
+            for axis, value in results.iteritems():
+                self.devsExtraAttributes[axis][EVALUATED_VALUE] = value
+        requests = {}
+        for dev in self.devices_to_read.keys():
+            # Tango raises an exception on duplicated attributes
+            attributes = list(set(self.devices_to_read[dev]))
+            try:
+                dev_proxy = PoolUtil().get_device(self.inst_name, dev)
+                requests[dev] = (dev_proxy, attributes)
+            except Exception, e:
+                self._log.error('Exception getting device:%s %r' % (dev, e))
+        # all the devices are read at the same time
+        replies = read_attributes_concurrently(requests)
+        for dev, values in replies.iteritems():
+            attributes = requests[dev][1]
+            if isinstance(values, PyTango.DevFailed):
+                for attr in attributes:
+                    for axis in self.formulas.axes(dev + '/' + attr):
+                        self.devsExtraAttributes[axis][
+                            EVALUATED_VALUE] = values
+                continue
+            elif isinstance(values, Exception):
+                self._log.error('Exception reading attributes:%s.%s' %
+                                (dev, str(attributes)))
+                continue
+            for attr, dev_attr_value in zip(attributes, values):
+                key = dev + '/' + attr
+                if dev_attr_value.has_failed:
+                    VALUE = PyTango.DevFailed(*dev_attr_value.get_err_stack())
+                    results = dict.fromkeys(self.formulas.axes(key), VALUE)
+                else:
+                    VALUE = to_value(dev_attr_value.value)
+                    results = self.formulas.evaluate_attribute(key, VALUE)
+                for axis, value in results.iteritems():
+                    self.devsExtraAttributes[axis][EVALUATED_VALUE] = value
+
+    def read_all_eval(self):
         for dev in self.devices_to_read.keys():
             attributes = self.devices_to_read[dev]
             dev_proxy = PoolUtil().get_device(self.inst_name, dev)
@@ -77,9 +168,11 @@ class ReadTangoAttributes():
                 for attr in attributes:
                     axis = self.axis_by_tango_attribute[dev + '/' + attr]
                     self.devsExtraAttributes[axis][EVALUATED_VALUE] = e
+                continue
             except Exception, e:
                 self._log.error('Exception reading attributes:%s.%s' %
                                 (dev, str(attributes)))
+                continue
             for attr in attributes:
                 axis = self.axis_by_tango_attribute[dev + '/' + attr]
                 formula = self.devsExtraAttributes[axis][FORMULA]
@@ -97,7 +190,7 @@ class ReadTangoAttributes():
 
     def read_one(self, axis):
         value = self.devsExtraAttributes[axis][EVALUATED_VALUE]
-        if isinstance(value, PyTango.DevFailed):
+        if isinstance(value, (PyTango.DevFailed, Exception)):
             raise value
         return value
 
@@ -107,6 +200,8 @@ class ReadTangoAttributes():
     def set_axis_extra_par(self, axis, name, value):
         self._log.debug(
             'set_axis_extra_par [%d] %s = %s' % (axis, name, value))
+        if name == FORMULA and self.formulas is not None:
+            self.formulas.set_formula(axis, value)
         self.devsExtraAttributes[axis][name] = value
         if name == TANGO_ATTR:
             idx = value.rfind("/")
@@ -115,6 +210,25 @@ class ReadTangoAttributes():
             self.devsExtraAttributes[axis][DEVICE] = dev
             self.devsExtraAttributes[axis][ATTRIBUTE] = attr
             self.axis_by_tango_attribute[value] = axis
+            if self.formulas is not None:
+                self.formulas.set_attribute(axis, value)
+        if name in (TANGO_ATTR, EVENT_TYPE):
+            self.update_subscription(axis)
+
+    def update_subscription(self, axis):
+        tango_attr = self.devsExtraAttributes[axis][TANGO_ATTR]
+        event_type = self.devsExtraAttributes[axis][EVENT_TYPE]
+        if self.events is None:
+            if event_type:
+                self._log.warning('TangoAttrLib not found, %s will be read '
+                                  'instead of using %s events' %
+                                  (tango_attr, event_type))
+            return
+        try:
+            self.events.subscribe(axis, tango_attr, event_type)
+        except PyTango.DevFailed, e:
+            self._log.error('Could not subscribe to %s events of %s, it '
+                            'will be read: %r' % (event_type, tango_attr, e))
 
 
 class TangoAttrZeroDController(ZeroDController, ReadTangoAttributes):